@@ -0,0 +1,231 @@
+"""Batched, prefetching frame reader for analysis code.
+
+    with BatchReader('session.mjpeg', batch_size=64, step=2, min_width=320) as reader:
+        for frames, timestamps in reader:
+            ... # frames is a (B, H, W, C) uint8 array, timestamps the matching log records
+
+Reads .mjpeg, .raw and .zraw recordings and segmented recordings (by base name).
+Frames are decoded on a thread pool (simplejpeg and the zstd/lz4 decompressors
+release the GIL) into one contiguous array per batch, and up to prefetch batches are
+decoded ahead of the one being used. A batch of .zraw frames is split on chunk
+boundaries, so each chunk is decompressed once, by one thread. Color frames are RGB whatever the recording's
+mode; Mono8 frames have one channel.
+
+With min_height or min_width, JPEG frames are decoded straight to the smallest size
+libjpeg-turbo's scaled IDCT offers (a multiple of 1/8 of the full size) that is at
+least that big, so full resolution pixels are never produced. Uncompressed frames are
+subsampled by the largest power of two (up to 8) that keeps them at least that big.
+"""
+import collections
+import concurrent.futures
+import os
+
+import numpy as np
+
+try:
+    from cherubim.mjpeg_index import MJPEGReader, index_filename, rebuild_index
+    from cherubim.raw_container import RawRecording, read_header
+    from cherubim.segments import manifest_filename, read_manifest
+    from cherubim.timestamp_log import read_timestamps
+except ModuleNotFoundError:
+    from mjpeg_index import MJPEGReader, index_filename, rebuild_index
+    from raw_container import RawRecording, read_header
+    from segments import manifest_filename, read_manifest
+    from timestamp_log import read_timestamps
+
+VIDEO_EXTENSIONS = ('.mjpeg', '.raw', '.zraw')
+
+
+def recording_files(recording):
+    """Base name and video files of a recording (its segments, in order, for a segmented recording)."""
+    base = os.path.splitext(recording)[0] if recording.endswith(VIDEO_EXTENSIONS) else recording
+    if not os.path.exists(recording) and os.path.exists(manifest_filename(base)):
+        directory = os.path.dirname(base)
+        return base, [os.path.join(directory, os.path.basename(segment['filename']))
+                      for segment in read_manifest(base)]
+    if not os.path.exists(recording):
+        raise FileNotFoundError('{} not found.'.format(recording))
+    return base, [recording]
+
+
+def open_video(filename, num_threads=1):
+    """MJPEGReader, RawRecording or ChunkedRecording for a video file."""
+    if filename.endswith('.mjpeg'):
+        if not os.path.exists(index_filename(filename)):
+            print('Indexing {}'.format(filename))
+            rebuild_index(filename)
+        return MJPEGReader(filename)
+    if filename.endswith('.zraw'):
+        try:
+            from cherubim.chunked_container import ChunkedRecording
+        except ModuleNotFoundError:
+            from chunked_container import ChunkedRecording
+        return ChunkedRecording(filename, num_threads=num_threads)
+    return RawRecording(filename)
+
+
+def video_info(filename):
+    """(number of frames, frame shape, mode) of a video file."""
+    if filename.endswith('.mjpeg'):
+        import simplejpeg
+        with open_video(filename) as reader:
+            if len(reader) == 0:
+                return 0, None, None
+            height, width, colorspace, _ = simplejpeg.decode_jpeg_header(reader.read_jpeg(0))
+            return len(reader), (height, width, 1 if colorspace == 'Gray' else 3), \
+                'Mono8' if colorspace == 'Gray' else 'RGB8'
+    if filename.endswith('.zraw'):
+        try:
+            from cherubim.chunked_container import read_header as read_zraw_header
+        except ModuleNotFoundError:
+            from chunked_container import read_header as read_zraw_header
+        header = read_zraw_header(filename)
+    else:
+        header = read_header(filename)
+    if header is None:
+        raise ValueError('{} has no header (recorded with RawHeader: False?).'.format(filename))
+    shape = tuple(header['shape'])
+    mode = header.get('mode', None) or ('Mono8' if shape[-1] == 1 else 'RGB8')
+    video = open_video(filename)
+    count = len(video)
+    if hasattr(video, 'close'):
+        video.close()
+    return count, shape, mode
+
+
+def subsample_step(shape, min_height=None, min_width=None):
+    """Largest power of two step (up to 8) that keeps frames of shape at least min_height x min_width."""
+    step = 1
+    if not (min_height or min_width):
+        return step
+    while step < 8 and shape[0] // (step * 2) >= (min_height or 0) and shape[1] // (step * 2) >= (min_width or 0):
+        step *= 2
+    return step
+
+
+class BatchReader():
+    """Iterates over frames start, start + step, ... (before stop) of a recording in batches
+    of (frames, timestamps). timestamps holds the recording's timestamp log records for
+    the frames (None without a log)."""
+    def __init__(self, recording, batch_size=32, start=0, stop=None, step=1, min_height=None, min_width=None,
+                 num_threads=None, prefetch=2):
+        self.base, files = recording_files(recording)
+        infos = [video_info(filename) for filename in files]
+        self._videos = [open_video(filename) for filename in files]
+        self._first_frames = np.cumsum([0] + [count for count, _, _ in infos]) # of each file
+        self.num_recorded = int(self._first_frames[-1])
+        self.indices = np.arange(self.num_recorded)[start:stop:step]
+        self.batch_size = batch_size
+        self.prefetch = max(prefetch, 1)
+
+        shapes = set(shape for count, shape, _ in infos if count)
+        if len(shapes) > 1:
+            raise ValueError('{}: segments have different frame shapes.'.format(recording))
+        full_shape = shapes.pop() if shapes else (0, 0, 1)
+        self.mode = next((mode for count, _, mode in infos if count), None)
+        self.full_shape = full_shape
+
+        # Every file is read the same way, so frames from each come out the same size
+        self._jpeg = files[0].endswith('.mjpeg')
+        self._chunked = files[0].endswith('.zraw')
+        if self._chunked: # first frame (in the whole recording) of each chunk of each file
+            self._chunk_starts = np.concatenate([first + video.index['first_frame'].astype(np.int64)
+                                                 for first, video in zip(self._first_frames, self._videos)])
+            self._chunk_files = np.concatenate([np.full(len(video.index), file)
+                                                for file, video in enumerate(self._videos)])
+        if self._jpeg and self.num_recorded:
+            import simplejpeg
+            self._colorspace = 'GRAY' if self.mode == 'Mono8' else 'RGB'
+            self._decode = simplejpeg.decode_jpeg
+            height, width, _, _ = simplejpeg.decode_jpeg_header(self._videos[0].read_jpeg(0), min_height or 0,
+                                                                min_width or 0)
+            self.shape = (height, width, full_shape[2])
+            self._scale = {'min_height': min_height or 0, 'min_width': min_width or 0}
+        else:
+            self._step = subsample_step(full_shape, min_height, min_width)
+            self.shape = (-(-full_shape[0] // self._step), -(-full_shape[1] // self._step), full_shape[2])
+            self._bgr = self.mode == 'Bayer_RG8' # demosaiced frames are stored BGR
+
+        self.timestamps = read_timestamps(self.base)
+        if self.timestamps is not None and len(self.timestamps) != self.num_recorded:
+            print('Warning: {} frames but {} timestamps for {}.'.format(self.num_recorded, len(self.timestamps),
+                                                                       recording))
+            self.timestamps = None
+
+        self._num_threads = num_threads or os.cpu_count()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads)
+
+    @property
+    def num_frames(self):
+        return len(self.indices)
+
+    def __len__(self):
+        return -(-self.num_frames // self.batch_size)
+
+    def _read_chunk_into(self, chunk, indices, out):
+        """Frames indices (all in chunk, of the whole recording) into out."""
+        file = int(self._chunk_files[chunk])
+        video = self._videos[file]
+        first = int(self._chunk_starts[chunk])
+        frames = video.read_chunk(chunk - int(np.searchsorted(self._chunk_files, file)))
+        for n, frame in zip(indices, out):
+            source = frames[n - first][::self._step, ::self._step]
+            frame[...] = source[..., ::-1] if self._bgr else source
+
+    def _read_into(self, indices, out):
+        for n, frame in zip(indices, out):
+            file = int(np.searchsorted(self._first_frames, n, side='right')) - 1
+            video, n = self._videos[file], int(n - self._first_frames[file])
+            if self._jpeg:
+                self._decode(video.read_jpeg(n), colorspace=self._colorspace, buffer=frame, **self._scale)
+            else:
+                source = video[n][::self._step, ::self._step]
+                frame[...] = source[..., ::-1] if self._bgr else source
+
+    def _submit(self, indices):
+        """Decode a batch, split across the threads. Returns (frames, timestamps, futures)."""
+        frames = np.empty((len(indices),) + self.shape, np.uint8)
+        if self._chunked: # one piece per chunk
+            chunks = np.searchsorted(self._chunk_starts, indices, side='right') - 1
+            pieces = np.split(np.arange(len(indices)), np.flatnonzero(np.diff(chunks)) + 1)
+            futures = [self._executor.submit(self._read_chunk_into, int(chunks[piece[0]]), indices[piece],
+                                             frames[piece[0]:piece[-1] + 1]) for piece in pieces if len(piece)]
+        else:
+            pieces = np.array_split(np.arange(len(indices)), min(self._num_threads, len(indices)))
+            futures = [self._executor.submit(self._read_into, indices[piece], frames[piece[0]:piece[-1] + 1])
+                       for piece in pieces if len(piece)]
+        timestamps = self.timestamps[indices] if self.timestamps is not None else None
+        return frames, timestamps, futures
+
+    def __iter__(self):
+        pending = collections.deque()
+        batches = (self.indices[i:i + self.batch_size] for i in range(0, self.num_frames, self.batch_size))
+        try:
+            for indices in batches:
+                pending.append(self._submit(indices))
+                if len(pending) > self.prefetch:
+                    yield self._finish(pending.popleft())
+            while pending:
+                yield self._finish(pending.popleft())
+        finally: # stopped early - let decoding in progress finish
+            for _, _, futures in pending:
+                concurrent.futures.wait(futures)
+
+    def _finish(self, batch):
+        frames, timestamps, futures = batch
+        for future in futures:
+            future.result() # raises any decoding error
+        return frames, timestamps
+
+    def close(self):
+        self._executor.shutdown()
+        for video in self._videos:
+            if hasattr(video, 'close'):
+                video.close()
+        self._videos = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
@@ -1,9 +1,15 @@
 import setproctitle
 import multiprocessing
+import os
 
-def start_camera(config, display_queue, write_queue, stop_signal, write_queue_signal):
+def start_camera(config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                 preview_buffer=None, journal=None, metrics_queue=None, health=None):
     multiprocessing.current_process().name = "python3 Camera Iface"
+    if config.get('Name', None):
+        multiprocessing.current_process().name += " {}".format(config['Name'])
     setproctitle.setproctitle(multiprocessing.current_process().name)
+    if config.get('CPUs', None):
+        os.sched_setaffinity(0, config['CPUs'])
 
     if config.get('Interface', 'WebCam') == 'GigE':
         try:
@@ -15,14 +21,41 @@ def start_camera(config, display_queue, write_queue, stop_signal, write_queue_si
             from cherubim.opencv_interface import OpenCVCameraInterface as CameraInterface
         except ModuleNotFoundError:
             from opencv_interface import OpenCVCameraInterface as CameraInterface
+    elif config.get('Interface', 'WebCam') == 'Synthetic':
+        try:
+            from cherubim.synthetic_interface import SyntheticCameraInterface as CameraInterface
+        except ModuleNotFoundError:
+            from synthetic_interface import SyntheticCameraInterface as CameraInterface
+    elif config.get('Interface', 'WebCam') == 'Replay':
+        try:
+            from cherubim.synthetic_interface import ReplayCameraInterface as CameraInterface
+        except ModuleNotFoundError:
+            from synthetic_interface import ReplayCameraInterface as CameraInterface
     else:
         print('Unsupported Interface')
 
+    metrics = None
+    if metrics_queue is not None:
+        try:
+            from cherubim.metrics import ProcessMetrics
+        except ModuleNotFoundError:
+            from metrics import ProcessMetrics
+        metrics = ProcessMetrics('camera', config.get('Name', None), metrics_queue,
+                                 config.get('MetricsInterval', 1.0))
+
     camera = CameraInterface(config, display_queue=display_queue, 
                              stop_signal=stop_signal, 
                              write_queue=write_queue,
-                             write_queue_signal=write_queue_signal)
+                             write_queue_signal=write_queue_signal,
+                             frame_buffer=frame_buffer,
+                             preview_buffer=preview_buffer,
+                             journal=journal,
+                             metrics=metrics,
+                             health=health)
     camera.run()
+    frame_buffer.close()
+    if preview_buffer is not None:
+        preview_buffer.close()
     print('Ended run')
     print('Done in camera exit.')
 
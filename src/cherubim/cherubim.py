@@ -1,69 +1,142 @@
 #!/usr/bin/env python3
 
-from PySide6.QtCore import QSize, QTimer, Qt
-from PySide6.QtGui import QImage, QPixmap, QShortcut, QKeySequence
+from PySide6.QtCore import QSize, QTimer, QRect
+from PySide6.QtGui import QImage, QPainter, QShortcut, QKeySequence
 from PySide6.QtWidgets import QApplication, QWidget, QLabel, \
-  QPushButton, QVBoxLayout, QHBoxLayout, QSizePolicy, \
+  QPushButton, QVBoxLayout, QHBoxLayout, QGridLayout, QSizePolicy, \
   QStatusBar
 
 import multiprocessing
-import multiprocessing.queues
-import queue
 
 import sys
 import shutil
 import os.path
+import math
+import collections
 
 import datetime, time
 
-import yaml
+import cv2
+import numpy as np
 
 try:
-    from cherubim.videowriter import start_writer
-    from cherubim.camera_interface import start_camera
+    from cherubim.pipeline import CameraPipeline, configure_camera, read_config_file
+    from cherubim.multicamera import camera_configs, recording_filename, recording_basename, merge_timestamps
+    from cherubim.metrics import MetricsCollector, ProcessMetrics
+    from cherubim.frame_buffer import frame_shape
+    from cherubim.stream_health import COUNT_NAMES as STREAM_COUNT_NAMES
 except ModuleNotFoundError:
-    from videowriter import start_writer
-    from camera_interface import start_camera
-
-
-# https://stackoverflow.com/questions/72188903/pyside6-how-do-i-resize-a-qlabel-without-loosing-the-size-aspect-ratio
-class ScaledLabel(QLabel):
+    from pipeline import CameraPipeline, configure_camera, read_config_file
+    from multicamera import camera_configs, recording_filename, recording_basename, merge_timestamps
+    from metrics import MetricsCollector, ProcessMetrics
+    from frame_buffer import frame_shape
+    from stream_health import COUNT_NAMES as STREAM_COUNT_NAMES
+
+
+class PreviewWidget(QWidget):
+    """Draws the latest preview frame, scaled to fit the widget (keeping its aspect ratio).
+
+    Frames are scaled with cv2.resize into preallocated images of exactly the size they
+    are drawn at, so painting doesn't scale or allocate. The images are only reallocated
+    when the widget (or frame) size changes, and the widget is only repainted when a new
+    frame arrives. There are two: set_frame() fills the one not on screen and present()
+    swaps them, so a frame that turns out to be torn can be dropped. With PreviewMaxWidth
+    near the widget's width, the camera process does most of the shrinking.
+    """
     def __init__(self, *args, **kwargs):
-        QLabel.__init__(self)
-        self._pixmap = self.pixmap()
-    
+        QWidget.__init__(self, *args, **kwargs)
+        self._frame_shape = None
+        self._buffers = [] # two (array, QImage sharing its memory) - drawn and being filled
+        self._front = 0 # index of the one drawn
+        self._target = QRect()
+        self._rendered = 0
+        self._render_ns = 0
+        self._rate_start = time.monotonic()
+
+    def _layout(self, frame_shape):
+        """Allocate the scaled images for frames of frame_shape at the current widget size."""
+        rows, cols, channels = frame_shape
+        scale = min(self.width() / cols, self.height() / rows)
+        width, height = max(round(cols * scale), 1), max(round(rows * scale), 1)
+        previous = self._buffers[self._front][0] if self._buffers else None
+        self._frame_shape = frame_shape
+        self._interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        self._target = QRect((self.width() - width) // 2, (self.height() - height) // 2, width, height)
+        self._buffers = []
+        for _ in range(2):
+            scaled = np.zeros((height, width, channels), np.uint8)
+            self._buffers.append((scaled, QImage(scaled, width, height, scaled.strides[0],
+                                  QImage.Format_Grayscale8 if channels == 1 else QImage.Format_RGB888)))
+        self._front = 0
+        if previous is not None and previous.shape[2] == channels: # until the next frame arrives
+            self._resize(previous, self._buffers[self._front][0])
+
+    def _resize(self, frame, scaled):
+        if frame.shape[:2] == scaled.shape[:2]: # already the right size
+            np.copyto(scaled, frame)
+        else: # 2D views, or cv2 would drop the channel axis of Mono8 frames
+            cv2.resize(frame[..., 0] if frame.shape[2] == 1 else frame, scaled.shape[1::-1],
+                       dst=scaled[..., 0] if frame.shape[2] == 1 else scaled, interpolation=self._interpolation)
+
+    def set_frame(self, frame):
+        """Copy (scaled) frame into the image not on screen - the caller can release frame
+        afterwards, and present() it unless it changed while it was being copied."""
+        start = time.perf_counter_ns()
+        if frame.shape != self._frame_shape:
+            self._layout(frame.shape)
+        self._resize(frame, self._buffers[1 - self._front][0])
+        self._render_ns += time.perf_counter_ns() - start
+
+    def present(self):
+        """Show the frame from the last set_frame()."""
+        self._front = 1 - self._front
+        self.update()
+
     def resizeEvent(self, event):
-        self.setPixmap(self._pixmap)
-        print(self.frameSize())
+        if self._frame_shape is not None:
+            self._layout(self._frame_shape)
 
-    def setPixmap(self, pixmap): #overiding setPixmap
-        if not pixmap:return 
-        self._pixmap = pixmap
-        # return QLabel.setPixmap(self,self._pixmap)
-        return QLabel.setPixmap(self,self._pixmap.scaled(
-            self.frameSize(),
-            Qt.KeepAspectRatio))
+    def paintEvent(self, event):
+        if not self._buffers:
+            return
+        start = time.perf_counter_ns()
+        painter = QPainter(self)
+        painter.drawImage(self._target, self._buffers[self._front][1])
+        painter.end()
+        self._rendered += 1
+        self._render_ns += time.perf_counter_ns() - start
+
+    def render_rate(self):
+        """(frames drawn per second, ms spent per frame) since the last call."""
+        now = time.monotonic()
+        rate = self._rendered / max(now - self._rate_start, 1e-9)
+        cost = self._render_ns / self._rendered / 1e6 if self._rendered else 0
+        self._rendered, self._render_ns, self._rate_start = 0, 0, now
+        return rate, cost
 
 
 class MainApp(QWidget):
 
-    def __init__(self, config):
+    def __init__(self, config, cameras=None):
         QWidget.__init__(self)
-        self.config = config # Needed by start_writer - TODO remove or refactor everywhere to use!
+        self.config = config
+        # One config per camera (see multicamera.camera_configs)
+        self.camera_configs = cameras if cameras is not None else camera_configs(config)
 
-        self.video_size = QSize(config.get('ResX'), config.get('ResY'))
+        self.video_size = QSize(frame_shape(self.camera_configs[0])[1], frame_shape(self.camera_configs[0])[0])
 
         # Initialization related to file saving
         self.recording_directory = config.get('LogDirectory', os.getcwd())
-        if not os.path.isdir(self.recording_directory):
-            raise(ValueError('VideoWriter LogDirectory [{}] not found.'.format(self.recording_directory)))
+        for camera_config in self.camera_configs:
+            log_directory = camera_config.get('LogDirectory', os.getcwd())
+            if not os.path.isdir(log_directory):
+                raise(ValueError('VideoWriter LogDirectory [{}] not found.'.format(log_directory)))
         self.filename_header = config.get('FilenameHeader', None)
         self.writer_filename = None
         self.recording_active = False
         self.recording_time_start = 0
     
         # stuff specifically to help with quitting
-        self.display_queue_empty = False # This only is set when quitting
         self.writer_finalizing_counter = 0
 
         self.setup_ui()
@@ -96,12 +169,52 @@ class MainApp(QWidget):
             self.recording_time_label.setStyleSheet("QLabel { background-color : white; color : black; }");
 
 
+    def update_frame_counts(self):
+        """Show frames that overflowed to the journal (or were dropped) while recording."""
+        if not self.recording_active or self.writer_finalizing_counter:
+            return
+        totals = collections.Counter()
+        for pipeline in self.pipelines:
+            totals.update(pipeline.frame_counts() or {})
+        if any(totals.values()):
+            message = "Recording to {}. Deferred {}, recovered {}, dropped {} frames.".format(
+                self.writer_filename, totals['FramesDeferred'], totals['FramesRecovered'], totals['FramesDropped'])
+            if any(totals[name] for name in STREAM_COUNT_NAMES): # lost before reaching the frame ring
+                message += " Camera lost {} frames ({} incomplete, {} underruns, {} packets missing, " \
+                           "{} resent).".format(
+                    totals['FramesLost'], totals['BuffersFailed'], totals['BufferUnderruns'],
+                    totals['PacketsMissing'], totals['PacketsResent'])
+            self.status_bar.showMessage(message)
+
+
+    def update_metrics(self):
+        if self.metrics is None:
+            return
+        self.metrics.poll()
+        self.metrics_label.setText(self.metrics.summary())
+
+
+    def update_render_rate(self):
+        """Preview frames actually drawn per second, and the GUI time each one took."""
+        rates = [preview.render_rate() for preview in self.previews]
+        self.render_rate_label.setText("Preview {} fps ({} ms)".format(
+            "/".join("{:.0f}".format(rate) for rate, _ in rates), "/".join("{:.1f}".format(cost) for _, cost in rates)))
+
+
     def setup_ui(self):
         """Initialize widgets.
         """
-        self.image_label = ScaledLabel()
-        self.image_label.setSizePolicy( QSizePolicy.Ignored, QSizePolicy.Ignored )
-        # self.image_label.setScaledContents(True)
+        # One preview per camera, tiled in a grid
+        self.previews = []
+        self.preview_layout = QGridLayout()
+        columns = math.ceil(math.sqrt(len(self.camera_configs)))
+        for i, camera_config in enumerate(self.camera_configs):
+            preview = PreviewWidget()
+            preview.setSizePolicy( QSizePolicy.Ignored, QSizePolicy.Ignored )
+            if camera_config.get('Name', None):
+                preview.setToolTip(camera_config['Name'])
+            self.preview_layout.addWidget(preview, i // columns, i % columns)
+            self.previews.append(preview)
 
         # Top Row
         self.record_button = QPushButton("⏺ REC")
@@ -123,6 +236,9 @@ class MainApp(QWidget):
         self.update_recording_time()
         self.recording_time_timer = QTimer()
         self.recording_time_timer.timeout.connect(self.update_recording_time)
+        self.recording_time_timer.timeout.connect(self.update_frame_counts)
+        self.recording_time_timer.timeout.connect(self.update_metrics)
+        self.recording_time_timer.timeout.connect(self.update_render_rate)
         self.recording_time_timer.start(1000) # Update disk space every second
 
         # self.quit_button = QPushButton("Quit")
@@ -137,9 +253,13 @@ class MainApp(QWidget):
 
         self.main_layout = QVBoxLayout()
         self.main_layout.addLayout(self.top_row_layout, stretch=0)
-        self.main_layout.addWidget(self.image_label, stretch=1)
+        self.main_layout.addLayout(self.preview_layout, stretch=1)
 
         self.status_bar = QStatusBar()
+        self.metrics_label = QLabel("")
+        self.status_bar.addPermanentWidget(self.metrics_label)
+        self.render_rate_label = QLabel("")
+        self.status_bar.addPermanentWidget(self.render_rate_label)
         self.status_bar.addPermanentWidget(QLabel("Ctrl-Q to Exit"))
         self.main_layout.addWidget(self.status_bar, stretch=0)
 
@@ -152,23 +272,29 @@ class MainApp(QWidget):
 
 
     def setup_camera(self, config):
-        """Initialize camera.
+        """Initialize cameras - one camera process (and writer, when recording) per camera.
         """
-        self.display_queue = multiprocessing.Queue()
-        self.writer_queue = multiprocessing.Queue()
-        self.acqusition_stop_signal = multiprocessing.Value('b', False)
-        self.writer_stop_signal = multiprocessing.Value('b', False)
-        self.writer_done_signal = multiprocessing.Value('b', False)
-        self.writer_queue_active_signal = multiprocessing.Value('b', False)
+        # Shared by all cameras so that recording starts and stops on the same frame period
+        self.record_signal = multiprocessing.Value('b', False)
+        # Every process reports its stage latencies and rates here (Metrics: False turns this off)
+        self.metrics_queue = None
+        self.metrics = None
+        self.display_metrics = {}
+        if config.get('Metrics', True):
+            self.metrics_queue = multiprocessing.Queue()
+            self.metrics = MetricsCollector(self.metrics_queue, filename=config.get('MetricsFile', None),
+                                            port=config.get('MetricsPort', None))
+            self.display_metrics = {pipeline_config.get('Name', None): ProcessMetrics(
+                                        'display', pipeline_config.get('Name', None), self.metrics_queue,
+                                        config.get('MetricsInterval', 1.0))
+                                    for pipeline_config in self.camera_configs}
+        self.pipelines = [CameraPipeline(camera_config, self.record_signal, self.metrics_queue)
+                          for camera_config in self.camera_configs]
 
         self.recording_active = False
 
-        self.camera_process = multiprocessing.Process(target=start_camera, 
-            args=(config, self.display_queue, self.writer_queue, 
-                    self.acqusition_stop_signal, self.writer_queue_active_signal))
-        self.camera_process.start()
-
-        self.writer_process = None
+        for pipeline in self.pipelines:
+            pipeline.start()
 
         if config['RecordVideo']:
             self.record_button.click()
@@ -180,15 +306,14 @@ class MainApp(QWidget):
 
     def handle_record_button(self):
         if self.recording_active: # stop writing
-            self.writer_queue_active_signal.value = False # triggers end of write by sending None on queue
+            self.record_signal.value = False # triggers end of write by sending None on queue
             self.writer_finalizing_counter += 1
             self.status_bar.showMessage("Finalizing writing." + '.' * (self.writer_finalizing_counter % 5))
-            if not self.writer_done_signal.value: 
+            if not all(pipeline.writer_finished() for pipeline in self.pipelines):
                 QTimer.singleShot(10, self.handle_record_button) # Come back to this close event again in a 10 ms!
                 return
             else:
-                self.writer_process.join()
-                self.recording_active = False
+                self.stop_record()
                 self.writer_finalizing_counter = 0
                 self.status_bar.showMessage("Stopped recording.")
                 self.record_button.setText("⏺ REC")
@@ -202,80 +327,67 @@ class MainApp(QWidget):
 
 
     def start_record(self):
-        self.writer_done_signal.value = False
-        now = datetime.datetime.now()
-        if self.filename_header is None:
-            self.writer_filename = 'ExperimentVideo_{}'.format(now.strftime("%Y-%m-%d_%H%M"))
-        else:
-            self.writer_filename = '{}_{}'.format(self.filename_header, now.strftime("%Y-%m-%d_%H%M"))
+        self.writer_filename = recording_basename(self.filename_header)
 
-        self.writer_process = multiprocessing.Process(target=start_writer,
-            args=(self.config, self.writer_queue, self.writer_done_signal, self.writer_filename))
-        self.writer_process.start()
-        self.writer_queue_active_signal.value = True
+        for pipeline in self.pipelines:
+            pipeline.start_writer(recording_filename(self.writer_filename, pipeline.config))
+        self.record_signal.value = True
         self.recording_active = True
 
 
+    def stop_record(self):
+        for pipeline in self.pipelines:
+            pipeline.join_writer()
+        self.recording_active = False
+        if len(self.pipelines) > 1:
+            merge_timestamps(self.camera_configs, self.writer_filename)
+
+
     def display_video_stream(self):
-        """Read frame from camera and repaint QLabel widget.
+        """Hand the newest frame from each camera to its preview.
         """
-        queued_data_recevied = False
-        while True: # always drain queue
-            try:
-                queued_data = self.display_queue.get(block=False) #(block=True, timeout=0.1)
-                queued_data_recevied = True
-            except queue.Empty:
-                break
-
-        # 3 options here - (1) we got some data, (2) we got a None, or (3) we got no data
-        if not queued_data_recevied:
-            return
-        
-        if queued_data is None: # If we pushed a None onto the queue, that means the camera process has finished
-            self.display_queue_empty = True
-            return
-
-        (img, timestamp) = queued_data
-        image = QImage(img, img.shape[1], img.shape[0], 
-                       img.strides[0], QImage.Format_RGB888)
-        self.image_label.setPixmap(QPixmap.fromImage(image))
+        for pipeline, preview in zip(self.pipelines, self.previews):
+            slot = pipeline.poll_display()
+            if slot is None: # no new frame (or the camera process has finished)
+                continue
+
+            start = time.perf_counter_ns()
+            display_buffer = pipeline.display_buffer
+            seq = display_buffer.seq(slot)
+            preview.set_frame(display_buffer.frame(slot)) # copies out of the slot
+            if seq < 0 or display_buffer.seq(slot) != seq:
+                # Display claims don't hold the camera back, so it reused the slot meanwhile
+                pipeline.release_display(slot)
+                continue
+            preview.present()
+            metrics = self.display_metrics.get(pipeline.name, None)
+            if metrics is not None:
+                metrics.record('render', time.perf_counter_ns() - start)
+                metrics.record('display', time.monotonic_ns() - pipeline.display_buffer.published(slot))
+                metrics.frame()
+            pipeline.release_display(slot)
 
     def closeEvent(self, event):
-        self.acqusition_stop_signal.value = True # This should trigger a None, causing writer to exit
+        for pipeline in self.pipelines:
+            pipeline.stop() # This should trigger a None, causing writer to exit
         if self.recording_active:  # stop writing
             self.writer_finalizing_counter += 1
             self.status_bar.showMessage("Finalizing writing." + '.' * (self.writer_finalizing_counter % 5))
-            if not self.writer_done_signal.value: 
+            if not all(pipeline.writer_finished() for pipeline in self.pipelines):
                 QTimer.singleShot(10, self.close) # Come back to this close event again in a 10 ms!
                 event.ignore()
                 return
             else:
-                self.writer_process.join()
-                self.recording_active = False
-
-        if not self.display_queue_empty:
-            while True:
-                queued_data = self.display_queue.get(block=True) #(block=True, timeout=0.1)
-                if queued_data is None:
-                    print('Cleared display queue to None')
-                    break
-
-        if self.camera_process is not None:
-            self.camera_process.join()
+                self.stop_record()
+
+        for pipeline in self.pipelines:
+            pipeline.close()
+        if self.metrics is not None:
+            self.metrics.close()
         
         event.accept()
 
 
-def read_config_file(file_path):
-    with open(file_path, 'r') as file:
-        try:
-            data = yaml.safe_load(file)
-            return data
-        except yaml.YAMLError as e:
-            print(f"Error reading YAML file: {e}")
-            return None
-
-
 def main():
     app = QApplication(sys.argv)
 
@@ -307,34 +419,12 @@ def main():
             print(key, ":", value)
         config = default_config
 
-    interface_style = config.get('Interface', 'WebCam')
-    if interface_style == 'GigE':
-        try:
-            from cherubim.gige_interface import check_camera
-        except ModuleNotFoundError:
-            from gige_interface import check_camera
-
-        pass
-    elif interface_style == 'WebCam':
-        try:
-            from cherubim.opencv_interface import check_camera
-        except:
-            from opencv_interface import check_camera
-
-        retval = check_camera(config)
-        if retval:
-            frame_width, frame_height = retval[1], retval[0]
-            print(frame_width, frame_height)
-            config['ResX'] = frame_width
-            config['ResY'] = frame_height
-        else:
-            print('Looking for a camera but no web camera found.')
-            sys.exit(app.exec())
-    else:
-        print('Unsupported Interface')    
-        sys.exit(app.exec())
+    cameras = camera_configs(config)
+    for camera_config in cameras:
+        if not configure_camera(camera_config):
+            sys.exit(1)
 
-    win = MainApp(config)
+    win = MainApp(config, cameras)
     win.show()
     sys.exit(app.exec())
 
@@ -0,0 +1,245 @@
+"""Losslessly compressed recordings (Codec: 'zstd' or 'lz4').
+
+Frames are grouped into chunks of chunk_frames consecutive frames and each chunk is
+compressed independently on a thread pool (both codecs release the GIL). The
+.zraw file has the same 4096 byte header as a raw container (see raw_container.py,
+with RAW_MAGIC replaced by ZRAW_MAGIC and 'codec' and 'chunk_frames' added to the
+description) followed by the compressed chunks back to back. A <name>_chunks.bin
+sidecar holds one CHUNK_INDEX_DTYPE record per chunk, so any range of frames can
+be found and decompressed (in parallel) without reading the rest of the file.
+
+zstandard and lz4 are optional dependencies (pip install cherubim[lossless]).
+"""
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+ZRAW_MAGIC = b'CHRBZRW1'
+HEADER_SIZE = 4096
+CHUNK_INDEX_MAGIC = b'CHRBCHK1'
+CHUNK_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8'),
+                              ('first_frame', '<u8'), ('num_frames', '<u4')])
+
+LOSSLESS_CODECS = ['zstd', 'lz4']
+
+
+def chunk_index_filename(filename):
+    return '{}_chunks.bin'.format(os.path.splitext(filename)[0])
+
+
+def _compress_function(codec, level):
+    if codec == 'zstd':
+        import zstandard
+        compressors = threading.local() # a ZstdCompressor must not be shared between threads
+        def compress(data):
+            if not hasattr(compressors, 'compressor'):
+                compressors.compressor = zstandard.ZstdCompressor(level=level)
+            return compressors.compressor.compress(data)
+        return compress
+    elif codec == 'lz4':
+        import lz4.frame
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError('Unsupported Codec. ({})'.format(codec))
+
+
+def _decompress_function(codec):
+    if codec == 'zstd':
+        import zstandard
+        decompressors = threading.local()
+        def decompress(data):
+            if not hasattr(decompressors, 'decompressor'):
+                decompressors.decompressor = zstandard.ZstdDecompressor()
+            return decompressors.decompressor.decompress(data)
+        return decompress
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress
+    raise ValueError('Unsupported Codec. ({})'.format(codec))
+
+
+class ChunkedContainerWriter():
+    """Compresses frames chunk by chunk on num_threads threads and writes the chunks
+    (and their index records) in order. write() returns 0 - frames are only sized
+    once their chunk has been compressed."""
+    def __init__(self, filename, shape, dtype=np.uint8, mode=None, frame_rate=None, start_time=None,
+                 codec='zstd', level=1, chunk_frames=16, num_threads=2):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.chunk_frames = chunk_frames
+        self._compress = _compress_function(codec, level)
+        if start_time is None:
+            start_time = datetime.datetime.now().isoformat()
+
+        description = json.dumps({'shape': self.shape, 'dtype': self.dtype.str, 'mode': mode,
+                                  'frame_rate': frame_rate, 'start_time': start_time,
+                                  'codec': codec, 'chunk_frames': chunk_frames}).encode()
+        header = ZRAW_MAGIC + struct.pack('<QI', 0, len(description)) + description
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Container description is too long.')
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.pwrite(self._fd, header.ljust(HEADER_SIZE, b'\0'), 0)
+        self._offset = HEADER_SIZE
+        self._index_file = open(chunk_index_filename(filename), 'wb')
+        self._index_file.write(CHUNK_INDEX_MAGIC)
+
+        # Chunk buffers are recycled; their number bounds the chunks in flight
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self._max_in_flight = 2 * num_threads
+        self._free_chunks = [np.empty(chunk_frames * self.frame_nbytes, np.uint8)
+                             for _ in range(self._max_in_flight + 1)]
+        self._in_flight = collections.deque() # (future, chunk buffer, first frame, num frames)
+        self._chunk = self._free_chunks.pop()
+        self._chunk_count = 0 # frames in self._chunk
+        self.frame_count = 0
+
+    def write(self, frame):
+        start = self._chunk_count * self.frame_nbytes
+        self._chunk[start:start + self.frame_nbytes] = frame.reshape(-1).view(np.uint8)
+        self._chunk_count += 1
+        self.frame_count += 1
+        if self._chunk_count == self.chunk_frames:
+            self._submit_chunk()
+        return 0
+
+    def _submit_chunk(self):
+        data = memoryview(self._chunk)[:self._chunk_count * self.frame_nbytes]
+        self._in_flight.append((self._executor.submit(self._compress, data), self._chunk,
+                                self.frame_count - self._chunk_count, self._chunk_count))
+        self._write_finished(wait=len(self._in_flight) >= self._max_in_flight)
+        self._chunk = self._free_chunks.pop()
+        self._chunk_count = 0
+
+    def _write_finished(self, wait=False):
+        """Write compressed chunks from the head of the queue (waiting for the first if wait)."""
+        while self._in_flight and (wait or self._in_flight[0][0].done()):
+            future, chunk, first_frame, num_frames = self._in_flight.popleft()
+            compressed = future.result()
+            os.pwrite(self._fd, compressed, self._offset)
+            np.array([(self._offset, len(compressed), first_frame, num_frames)],
+                     dtype=CHUNK_INDEX_DTYPE).tofile(self._index_file)
+            self._index_file.flush()
+            self._offset += len(compressed)
+            self._free_chunks.append(chunk)
+            os.pwrite(self._fd, struct.pack('<Q', first_frame + num_frames), len(ZRAW_MAGIC))
+            wait = False
+
+    def close(self):
+        if self._fd is not None:
+            if self._chunk_count:
+                self._submit_chunk()
+            while self._in_flight:
+                self._write_finished(wait=True)
+            self._executor.shutdown()
+            os.close(self._fd)
+            self._fd = None
+            self._index_file.close()
+
+
+def read_header(filename):
+    """Returns the description dict (with 'frame_count') or None if filename isn't a .zraw file."""
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(ZRAW_MAGIC)] != ZRAW_MAGIC:
+        return None
+    frame_count, description_length = struct.unpack_from('<QI', header, len(ZRAW_MAGIC))
+    start = len(ZRAW_MAGIC) + 12
+    description = json.loads(header[start:start + description_length])
+    description['shape'] = tuple(description['shape'])
+    description['frame_count'] = frame_count
+    return description
+
+
+def load_chunk_index(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(CHUNK_INDEX_MAGIC)) != CHUNK_INDEX_MAGIC:
+            raise ValueError('{} is not a cherubim chunk index.'.format(filename))
+    return np.fromfile(filename, dtype=CHUNK_INDEX_DTYPE, offset=len(CHUNK_INDEX_MAGIC))
+
+
+class ChunkedRecording():
+    """Random access to a .zraw recording.
+
+    recording[n] returns frame n (the last decompressed chunk is cached, so sequential
+    access decompresses each chunk once). recording.read(start, stop) returns frames
+    start..stop-1 as an (N, H, W, C) array, decompressing the chunks in parallel.
+    Threads sharing a recording should use read_chunk() (frames are decompressed a
+    whole chunk at a time, so each thread should work on its own chunks).
+    """
+    def __init__(self, filename, num_threads=None):
+        self.header = read_header(filename)
+        if self.header is None:
+            raise ValueError('{} is not a compressed cherubim recording.'.format(filename))
+        self.shape = self.header['shape']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.index = load_chunk_index(chunk_index_filename(filename))
+        self._decompress = _decompress_function(self.header['codec'])
+        self._num_threads = num_threads or os.cpu_count()
+        self._fd = os.open(filename, os.O_RDONLY)
+        self._cached = (None, None) # (chunk, frames), replaced as a whole
+
+    def __len__(self):
+        if len(self.index) == 0:
+            return 0
+        return int(self.index['first_frame'][-1] + self.index['num_frames'][-1])
+
+    def _chunk_frames(self, n):
+        """Decompressed frames of chunk n as an array."""
+        record = self.index[n]
+        data = self._decompress(os.pread(self._fd, int(record['length']), int(record['offset'])))
+        return np.frombuffer(data, self.dtype).reshape((int(record['num_frames']),) + self.shape)
+
+    def read_chunk(self, n):
+        """Frames of chunk n, i.e., frames index['first_frame'][n] on."""
+        return self._chunk_frames(n)
+
+    def _find_chunk(self, frame):
+        if frame < 0 or frame >= len(self):
+            raise IndexError('Frame {} out of range.'.format(frame))
+        return int(np.searchsorted(self.index['first_frame'], frame, side='right')) - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            start, stop, step = n.indices(len(self))
+            return self.read(start, stop)[::step]
+        n = int(n) + len(self) if n < 0 else int(n)
+        chunk = self._find_chunk(n)
+        cached_chunk, frames = self._cached
+        if chunk != cached_chunk:
+            frames = self._chunk_frames(chunk)
+            self._cached = (chunk, frames)
+        return frames[n - int(self.index['first_frame'][chunk])]
+
+    def read(self, start, stop):
+        stop = min(stop, len(self))
+        out = np.empty((max(stop - start, 0),) + self.shape, self.dtype)
+        if stop <= start:
+            return out
+        first, last = self._find_chunk(start), self._find_chunk(stop - 1)
+
+        def decompress_into(chunk):
+            frames = self._chunk_frames(chunk)
+            chunk_start = int(self.index['first_frame'][chunk])
+            lo, hi = max(start, chunk_start), min(stop, chunk_start + len(frames))
+            out[lo - start:hi - start] = frames[lo - chunk_start:hi - chunk_start]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+            list(executor.map(decompress_into, range(first, last + 1)))
+        return out
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
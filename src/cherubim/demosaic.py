@@ -0,0 +1,140 @@
+import collections
+import concurrent.futures
+import queue
+import time
+
+import numpy as np
+import cv2
+
+# Note that cv2's "BayerRG" conversions put the top-left (R) sample of an RGGB sensor
+# in channel 0. The numpy conversions below follow the same channel order.
+_CV2_DEMOSAIC_CODES = {
+    'bilinear': cv2.COLOR_BayerRG2BGR,
+    'vng': cv2.COLOR_BayerRG2BGR_VNG,
+    'ea': cv2.COLOR_BayerRG2BGR_EA,
+}
+
+
+def demosaic_nearest(raw, dst):
+    """Nearest-neighbor demosaic: each 2x2 RGGB block is filled with its own samples."""
+    for dy in (0, 1):
+        for dx in (0, 1):
+            dst[dy::2, dx::2, 0] = raw[0::2, 0::2]
+            dst[dy::2, dx::2, 1] = raw[dy::2, 1 - dy::2] # green from the same row of the block
+            dst[dy::2, dx::2, 2] = raw[1::2, 1::2]
+    return dst
+
+
+def demosaic_superpixel(raw, dst):
+    """Half resolution: each 2x2 RGGB block becomes one pixel of dst (the greens averaged)."""
+    height, width = dst.shape[:2]
+    raw = raw[:2 * height, :2 * width]
+    dst[..., 0] = raw[0::2, 0::2]
+    dst[..., 1] = (raw[0::2, 1::2].astype(np.uint16) + raw[1::2, 0::2] + 1) >> 1
+    dst[..., 2] = raw[1::2, 1::2]
+    return dst
+
+
+def bin_2x2(raw, dst):
+    """Software 2x2 binning of a Mono8 frame into dst (the rounded mean of each block)."""
+    height, width = dst.shape[:2]
+    raw = raw.reshape(raw.shape[:2])[:2 * height, :2 * width]
+    total = raw[0::2, 0::2].astype(np.uint16)
+    total += raw[0::2, 1::2]
+    total += raw[1::2, 0::2]
+    total += raw[1::2, 1::2]
+    total += 2
+    total >>= 2
+    dst.reshape(height, width)[...] = total
+    return dst
+
+
+def demosaic_function(algorithm):
+    """Return f(raw, dst) that demosaics an RGGB frame into the preallocated dst
+    (which is half the size of raw for 'superpixel')."""
+    algorithm = algorithm.lower()
+    if algorithm == 'nearest':
+        return demosaic_nearest
+    elif algorithm == 'superpixel':
+        return demosaic_superpixel
+    elif algorithm in _CV2_DEMOSAIC_CODES:
+        code = _CV2_DEMOSAIC_CODES[algorithm]
+        return lambda raw, dst: cv2.cvtColor(raw, code, dst=dst)
+    else:
+        raise ValueError('Unsupported demosaic algorithm. ({})'.format(algorithm))
+
+
+class DemosaicStage():
+    """Demosaics raw Bayer frames on a small thread pool (cv2 releases the GIL).
+
+    submit() never blocks the acquisition loop. Converted frames are written into
+    a fixed pool of preallocated destination arrays and handed back by pop() in
+    submission order. A destination must be given back with release() once the
+    frame has been published. Callers must not submit while full(), i.e., with a
+    frame in flight for every destination - pop() (with timeout=None) first.
+    """
+    def __init__(self, shape, algorithm='bilinear', num_threads=2, num_buffers=None, latency=None):
+        self._convert = demosaic_function(algorithm)
+        self._latency = latency # optional LatencyHistogram of the conversions (see metrics.py), updated by pop()
+        if num_buffers is None:
+            num_buffers = 2 * num_threads + 2
+        # Workers take a destination when they start a frame. At least num_threads
+        # destinations are needed so the oldest frame in flight can always finish.
+        num_buffers = max(num_buffers, num_threads)
+        self.num_buffers = num_buffers
+        self._free = queue.Queue()
+        for i in range(num_buffers):
+            self._free.put(np.empty(shape, np.uint8))
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(num_threads, thread_name_prefix='demosaic')
+        self._in_flight = collections.deque() # (future, timestamp) in submission order
+
+    def submit(self, raw, timestamp, on_done=None):
+        """Queue raw for conversion. on_done() is called (from a worker) once raw has been read."""
+        future = self._executor.submit(self._run, raw, on_done)
+        self._in_flight.append((future, timestamp))
+
+    def _run(self, raw, on_done):
+        dst = self._free.get()
+        start = time.perf_counter_ns()
+        self._convert(raw, dst)
+        elapsed = time.perf_counter_ns() - start
+        if on_done is not None:
+            on_done()
+        return dst, elapsed
+
+    def pop(self, timeout=0):
+        """Oldest converted frame as (frame, timestamp), or None if it isn't ready yet."""
+        if not self._in_flight:
+            return None
+        future, timestamp = self._in_flight[0]
+        try:
+            dst, elapsed = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+        self._in_flight.popleft()
+        if self._latency is not None: # recorded here, so only one thread updates the histogram
+            self._latency.add(elapsed)
+        return dst, timestamp
+
+    def release(self, dst):
+        self._free.put(dst)
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def full(self):
+        """True if every destination belongs to a frame in flight (submit() could wait forever)."""
+        return len(self._in_flight) >= self.num_buffers
+
+    def shutdown(self):
+        """Finish the conversions in progress and drop the rest (their on_done isn't called)."""
+        for future, _ in self._in_flight:
+            if not future.cancel(): # converted frames that are never popped give back their
+                future.add_done_callback(self._release_result) # destination to the workers waiting
+        self._in_flight.clear()
+        self._executor.shutdown(wait=True)
+
+    def _release_result(self, future):
+        if future.exception() is None:
+            self._free.put(future.result()[0])
@@ -0,0 +1,74 @@
+"""Video encoding in an ffmpeg subprocess.
+
+Raw frames are streamed to ffmpeg's stdin, which encodes them with libx264
+('h264') or losslessly with FFV1 ('ffv1') into a Matroska file. ffmpeg runs in its
+own process with its own threads, so encoding never blocks the camera. If it falls
+behind, the pipe fills and the writer's backlog grows as it would with a slow disk.
+"""
+import fcntl
+import shutil
+import subprocess
+
+import numpy as np
+
+# Pixel formats of the frames in the frame ring (see VideoWriter for MJPEG)
+_PIXEL_FORMATS = {'Mono8': 'gray', 'Bayer_RG8': 'bgr24', 'RGB8': 'rgb24'}
+
+FFMPEG_CODECS = ['h264', 'ffv1']
+
+_F_SETPIPE_SZ = 1031 # Linux fcntl - larger pipe means fewer context switches per frame
+
+
+def codec_arguments(codec, mode, threads=0, preset='veryfast', crf=23):
+    if codec == 'h264':
+        return ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf),
+                '-pix_fmt', 'gray' if mode == 'Mono8' else 'yuv420p', '-threads', str(threads)]
+    elif codec == 'ffv1': # lossless; slices let the encoder use several threads
+        return ['-c:v', 'ffv1', '-level', '3', '-slices', '16', '-slicecrc', '1', '-g', '1',
+                '-threads', str(threads)]
+    raise ValueError('Unsupported Codec. ({})'.format(codec))
+
+
+class FFmpegWriter():
+    """Pipes frames to an ffmpeg process. write() returns 0 - the size of each
+    encoded frame is only known to ffmpeg."""
+    def __init__(self, filename, shape, mode, codec, frame_rate, threads=0, preset='veryfast', crf=23,
+                 ffmpeg='ffmpeg', output_arguments=()):
+        if mode not in _PIXEL_FORMATS:
+            raise ValueError('Unsupported video mode. ({})'.format(mode))
+        if shutil.which(ffmpeg) is None:
+            raise ValueError('Codec {} needs ffmpeg, but [{}] was not found.'.format(codec, ffmpeg))
+        self.shape = tuple(shape)
+
+        command = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', _PIXEL_FORMATS[mode],
+                   '-s', '{}x{}'.format(self.shape[1], self.shape[0]), '-r', str(frame_rate),
+                   '-i', 'pipe:0'] \
+                  + codec_arguments(codec, mode, threads, preset, crf) + list(output_arguments) + [filename]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=0)
+        try:
+            fcntl.fcntl(self._process.stdin.fileno(), _F_SETPIPE_SZ, 1 << 20)
+        except OSError:
+            pass
+
+    def write(self, frame):
+        self._process.stdin.write(np.ascontiguousarray(frame).data)
+        return 0
+
+    def abort(self):
+        """Stop ffmpeg without finishing the file."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def close(self):
+        """Finish the file. Returns ffmpeg's exit code (0 if the file is complete)."""
+        if self._process is None:
+            return None
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        if returncode != 0:
+            print('ffmpeg exited with code {}'.format(returncode))
+        self._process = None
+        return returncode
@@ -0,0 +1,234 @@
+from multiprocessing import shared_memory
+import math
+import time
+
+import numpy as np
+
+# Per-slot bookkeeping that lives in shared memory next to the frames.
+# seq is the camera's frame counter (-1 means the slot was never written, or is being rewritten).
+# published is when the frame was written into the slot (time.monotonic_ns).
+# hardware_timestamp is the camera's own clock (0 for interfaces that don't have one)
+SLOT_METADATA_DTYPE = np.dtype([('seq', '<i8'), ('timestamp', '<i8'), ('published', '<i8'),
+                                ('hardware_timestamp', '<i8')])
+
+_PAGE_SIZE = 4096
+
+
+def output_binning(config):
+    """2 if the camera process halves the frames from the sensor (Demosaic: 'superpixel'
+    in Bayer_RG8 mode, SoftwareBinning: 2 in Mono8 mode), otherwise 1."""
+    if config.get('Interface', 'WebCam') not in ['GigE', 'Synthetic']:
+        return 1
+    mode = config.get('Mode', 'Mono8')
+    if mode == 'Bayer_RG8' and str(config.get('Demosaic', 'bilinear')).lower() == 'superpixel':
+        return 2
+    if mode == 'Mono8':
+        binning = config.get('SoftwareBinning', 1)
+        if binning not in [1, 2]:
+            raise ValueError('SoftwareBinning must be 1 or 2. ({})'.format(binning))
+        return binning
+    return 1
+
+
+def frame_shape(config):
+    """Shape (rows, cols, channels) of frames published by the camera process."""
+    binning = output_binning(config)
+    sy, sx = config['ResY'] // binning, config['ResX'] // binning
+    if config.get('Interface', 'WebCam') != 'WebCam' and config.get('Mode', 'Mono8') == 'Mono8':
+        return (sy, sx, 1)
+    return (sy, sx, 3) # Color frames are demosaiced/converted in the camera process
+
+
+def pretrigger_frames(config):
+    """Frames kept from before recording starts (PreTriggerSeconds)."""
+    return int(round(config.get('PreTriggerSeconds', 0) * config.get('FrameRate', 30)))
+
+
+def motion_window_frames(config):
+    """Frames kept from before motion starts (MotionPreSeconds, with MotionThreshold set)."""
+    if config.get('MotionThreshold', None) is None:
+        return 0
+    return int(round(config.get('MotionPreSeconds', 1) * config.get('FrameRate', 30)))
+
+
+def default_slot_count(config):
+    """Number of ring slots: FrameBufferSlots, or ~2 s of frames (plus an uncompressed
+    pre-trigger window and the motion gate's window) capped by FrameBufferMB."""
+    if config.get('FrameBufferSlots', None):
+        return int(config['FrameBufferSlots'])
+    frame_nbytes = int(np.prod(frame_shape(config)))
+    budget_slots = int(config.get('FrameBufferMB', 1024) * 1024**2 // frame_nbytes)
+    wanted = int(2 * config.get('FrameRate', 30))
+    if not config.get('PreTriggerCompress', False): # the pre-trigger window is kept in the ring
+        wanted += pretrigger_frames(config)
+    wanted += motion_window_frames(config)
+    return max(4, min(wanted, budget_slots))
+
+
+def preview_decimation(config):
+    """Integer step that brings frames down to at most PreviewMaxWidth columns (1 if unset)."""
+    max_width = config.get('PreviewMaxWidth', None)
+    if not max_width:
+        return 1
+    return max(1, math.ceil(frame_shape(config)[1] / max_width))
+
+
+def preview_shape(config):
+    sy, sx, channels = frame_shape(config)
+    step = preview_decimation(config)
+    return (math.ceil(sy / step), math.ceil(sx / step), channels)
+
+
+class SharedFrameBuffer():
+    """Fixed-size ring of frame slots in shared memory.
+
+    The camera process writes each frame once into a slot and hands the slot
+    index to readers over their (small) queues. Each reader holds a claim on a
+    slot until it calls release(). The camera never reuses a slot while a
+    blocking reader (e.g., the writer) still holds it. Claims from the display
+    are advisory - the camera will overwrite a slot the display is slow to
+    release, and the display can detect this by comparing sequence numbers.
+    """
+    DISPLAY_READER = 0
+    WRITER_READER = 1
+
+    def __init__(self, shape, num_slots, num_readers=2, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = num_slots
+        self.num_readers = num_readers
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._slot_stride = -(-self.frame_nbytes // _PAGE_SIZE) * _PAGE_SIZE # page aligned slots
+
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=self._total_nbytes())
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._map_arrays()
+
+        if self._owner:
+            self._metadata['seq'] = -1
+            self._metadata['timestamp'] = 0
+            self._metadata['published'] = 0
+            self._metadata['hardware_timestamp'] = 0
+            self._claims[:] = 0
+
+        self._next_slot = 0 # Only used in the (single) camera process
+        self._next_seq = 0
+
+    def _total_nbytes(self):
+        return (self.num_slots * self._slot_stride
+                + self.num_slots * SLOT_METADATA_DTYPE.itemsize
+                + self.num_slots * self.num_readers)
+
+    def _map_arrays(self):
+        buf = self._shm.buf
+        frame_strides = np.empty(self.shape, self.dtype).strides
+        self._frames = np.ndarray((self.num_slots,) + self.shape, dtype=self.dtype,
+                                  buffer=buf, strides=(self._slot_stride,) + frame_strides)
+        offset = self.num_slots * self._slot_stride
+        self._metadata = np.ndarray((self.num_slots,), dtype=SLOT_METADATA_DTYPE,
+                                    buffer=buf, offset=offset)
+        offset += self.num_slots * SLOT_METADATA_DTYPE.itemsize
+        self._claims = np.ndarray((self.num_slots, self.num_readers), dtype=np.uint8,
+                                  buffer=buf, offset=offset)
+
+    # Pickle by name so the buffer can be handed to spawned processes.
+    def __getstate__(self):
+        return {'shape': self.shape, 'num_slots': self.num_slots, 'num_readers': self.num_readers,
+                'dtype': self.dtype.str, 'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['num_slots'], state['num_readers'],
+                      np.dtype(state['dtype']), name=state['name'])
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def slot_nbytes(self):
+        """Bytes available in each slot (frames are page aligned, so this can exceed frame_nbytes)."""
+        return self._slot_stride
+
+    # Camera (producer) side
+    def acquire(self, stop_signal=None):
+        """Return the next slot in the ring, waiting while a blocking reader holds it.
+
+        Returns None if stop_signal is raised while waiting.
+        """
+        slot = self._next_slot
+        while self.held(slot):
+            if stop_signal is not None and stop_signal.value:
+                return None
+            time.sleep(0.0005)
+        self._claims[slot, self.DISPLAY_READER] = 0 # display claims never block the camera
+        self.invalidate(slot)
+        self._next_slot = (slot + 1) % self.num_slots
+        return slot
+
+    def invalidate(self, slot):
+        """Mark slot as about to be overwritten. Readers that don't block the camera (the
+        display) compare seq() before and after copying a frame to detect this."""
+        self._metadata['seq'][slot] = -1
+
+    def full(self):
+        """True if acquire() would have to wait for a blocking reader."""
+        return self.held(self._next_slot)
+
+    def upcoming_seq(self):
+        """Sequence number the next frame will get."""
+        return self._next_seq
+
+    def next_seq(self):
+        """Number a frame that is passed on outside of the ring (see journal.py)."""
+        self._next_seq += 1
+        return self._next_seq - 1
+
+    def write(self, slot, frame, timestamp, hardware_timestamp=0):
+        """Copy frame into slot (pass None if it was written in place) and stamp it."""
+        if frame is not None:
+            self._frames[slot][...] = frame.reshape(self.shape)
+        self._metadata[slot] = (self._next_seq, timestamp, time.monotonic_ns(), hardware_timestamp)
+        self._next_seq += 1
+        return self._next_seq - 1
+
+    def claim(self, slot, reader):
+        self._claims[slot, reader] = 1
+
+    def held(self, slot):
+        """True while a blocking reader still holds slot."""
+        return bool(self._claims[slot, self.WRITER_READER:].any())
+
+    # Reader side
+    def frame(self, slot):
+        """Numpy view of the frame stored in slot (valid until released)."""
+        return self._frames[slot]
+
+    def timestamp(self, slot):
+        return int(self._metadata['timestamp'][slot])
+
+    def hardware_timestamp(self, slot):
+        return int(self._metadata['hardware_timestamp'][slot])
+
+    def published(self, slot):
+        return int(self._metadata['published'][slot])
+
+    def seq(self, slot):
+        return int(self._metadata['seq'][slot])
+
+    def release(self, slot, reader):
+        self._claims[slot, reader] = 0
+
+    def pending(self, reader):
+        """Number of slots currently claimed by reader (i.e., its backlog)."""
+        return int(np.count_nonzero(self._claims[:, reader]))
+
+    def close(self):
+        self._frames = self._metadata = self._claims = None
+        self._shm.close()
+
+    def unlink(self):
+        if self._owner:
+            self._shm.unlink()
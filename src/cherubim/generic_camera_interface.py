@@ -1,15 +1,106 @@
 import queue
+import time
+
+try:
+    from cherubim.frame_buffer import SharedFrameBuffer, preview_decimation
+    from cherubim.pretrigger import PreTriggerBuffer, EncodedFrame
+    from cherubim.motion_gate import MotionGate
+    from cherubim.streams import stream_configs, stream_crop
+    from cherubim.journal import DEFERRED, RECOVERED
+    from cherubim.stream_health import COUNT_NAMES
+except ModuleNotFoundError:
+    from frame_buffer import SharedFrameBuffer, preview_decimation
+    from pretrigger import PreTriggerBuffer, EncodedFrame
+    from motion_gate import MotionGate
+    from streams import stream_configs, stream_crop
+    from journal import DEFERRED, RECOVERED
+    from stream_health import COUNT_NAMES
+
+
+class _OutputStream():
+    """The camera's side of one output stream: its writer queue, its reader of the
+    frame ring and its overflow journal (see streams.py)."""
+    def __init__(self, config, write_queue, journal, frame_buffer, budget):
+        self.name = config.get('StreamName', None)
+        self.reader = config['StreamReader']
+        self.queue = write_queue
+        self.journal = journal
+        self.crop = stream_crop(config)
+        self.decimation = int(config.get('FrameDecimation', 1))
+        self.budget = config.get('WriterBacklogFrames', budget)
+        self._frame_buffer = frame_buffer
+
+    def takes(self, seq):
+        return seq % self.decimation == 0
+
+    def backlogged(self):
+        return self._frame_buffer.pending(self.reader) >= self.budget
+
+    def put(self, slot):
+        self._frame_buffer.claim(slot, self.reader)
+        self.queue.put(slot) # needs to block because we want every frame saved!
+
+    def spill(self, frame, seq, timestamp, hardware_timestamp=0):
+        if self.crop is not None:
+            frame = frame[self.crop] # only the stream's pixels go to its journal
+        record = self.journal.spill(frame, seq, timestamp, hardware_timestamp)
+        if record is not None: # otherwise the journal is full and the frame was dropped
+            self.queue.put(record)
+
 
 class GenericCameraInterface():
-    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal):
+    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                 preview_buffer=None, journal=None, metrics=None, health=None):
         self._display_queue = display_queue
-        self._write_queue = write_queue
         self._stop_signal = stop_signal
         self._write_queue_signal = write_queue_signal
         self._write_queue_is_active = False
+        self._frame_buffer = frame_buffer # shared memory ring - queues only carry slot indices
+        # Frames from before recording starts are flushed to the writer first (PreTriggerSeconds)
+        self._pretrigger = PreTriggerBuffer(config, frame_buffer) if config.get('PreTriggerSeconds', 0) else None
+        ring_window = self._pretrigger.num_frames if self._pretrigger and not self._pretrigger.compressed else 0
+        # While recording, idle frames are skipped (MotionThreshold, see motion_gate.py)
+        self._motion_gate = None
+        if config.get('MotionThreshold', None) is not None:
+            self._motion_gate = MotionGate(config, frame_buffer)
+            ring_window += self._motion_gate.num_frames
+        # One writer per output stream (write_queue and journal are lists with Streams).
+        # Once a writer's backlog reaches WriterBacklogFrames (or the whole ring), its frames
+        # go to its overflow journal instead of waiting for a free slot.
+        write_queues = write_queue if isinstance(write_queue, list) else [write_queue]
+        journals = journal if isinstance(journal, list) else [journal] * len(write_queues)
+        self._streams = [_OutputStream(stream_config, stream_queue, stream_journal, frame_buffer,
+                                       ring_window + (frame_buffer.num_slots - ring_window) * 3 // 4)
+                         for stream_config, stream_queue, stream_journal
+                         in zip(stream_configs(config), write_queues, journals)]
+
+        # Preview: at most PreviewFPS frames go to the display. If PreviewMaxWidth is set they
+        # are decimated into the (small) preview_buffer ring before leaving this process.
+        self._preview_buffer = preview_buffer
+        self._preview_step = preview_decimation(config)
+        self._preview_period = 1 / config['PreviewFPS'] if config.get('PreviewFPS', None) else 0
+        self._next_preview_time = 0
+
+        # Stage latencies, frame rate and queue depths (ProcessMetrics, see metrics.py)
+        self.metrics = metrics
+        if metrics is not None:
+            for stream in self._streams:
+                suffix = '' if stream.name is None else '_' + stream.name
+                metrics.gauge('writer_backlog' + suffix, lambda reader=stream.reader: frame_buffer.pending(reader))
+                if stream.journal is not None:
+                    metrics.gauge('journal_backlog' + suffix, lambda counts=stream.journal.counters:
+                                  counts[DEFERRED] - counts[RECOVERED])
+
+        # Lost frames and packets (StreamHealth, see stream_health.py) - for interfaces that know
+        self.health = health
+        if metrics is not None and health is not None:
+            for index, name in enumerate(COUNT_NAMES):
+                metrics.counter(name, lambda index=index: health.counters[index])
 
         self.current_frame_data = None
         self.current_frame_timestamp = None
+        self.current_frame_hardware_timestamp = 0 # set by interfaces with a camera clock
+        self.current_frame_slot = None # set by interfaces that acquire straight into the frame ring
 
     def start_acquisition(self):
         print('Acquisiton')
@@ -23,39 +114,142 @@ class GenericCameraInterface():
     def post_queue(self):
         return
 
+    def publish_preview(self, slot):
+        now = time.monotonic()
+        if now < self._next_preview_time:
+            return
+        self._next_preview_time = now + self._preview_period
+
+        display_buffer = self._frame_buffer
+        if self._preview_buffer is not None: # decimate into the preview ring
+            display_buffer = self._preview_buffer
+            preview_slot = display_buffer.acquire()
+            step = self._preview_step
+            display_buffer.frame(preview_slot)[...] = self._frame_buffer.frame(slot)[::step, ::step]
+            display_buffer.write(preview_slot, None, self._frame_buffer.timestamp(slot))
+            slot = preview_slot
+
+        try:
+            display_buffer.claim(slot, SharedFrameBuffer.DISPLAY_READER)
+            self._display_queue.put(slot, block=False) # doesn't need to block because we don't care about dropping frames
+        except queue.Full:
+            display_buffer.release(slot, SharedFrameBuffer.DISPLAY_READER)
+
+    def _put_streams(self, item):
+        """Queue a frame from earlier (a slot still in the ring, or an EncodedFrame)."""
+        for stream in self._streams:
+            if isinstance(item, EncodedFrame): # only without Streams
+                stream.queue.put(item)
+            elif stream.takes(self._frame_buffer.seq(item)):
+                stream.put(item)
+
+    def _flush_pretrigger(self):
+        """Queue the pre-trigger window to the writers (ahead of the current frame)."""
+        for item in self._pretrigger.flush():
+            self._put_streams(item)
+
     def run(self):
         self.start_acquisition()
 
+        metrics = self.metrics
         while not self._stop_signal.value:
+            start = time.perf_counter_ns()
             capture_success = self.get_frame() # This should get an convert a video frame
 
             if not capture_success  or self._stop_signal.value:
                 break
+            if metrics is not None:
+                captured = time.perf_counter_ns()
+                metrics.record('get_frame', captured - start)
+
+            recording = self._write_queue_signal.value
+            takers, spilling, gated = [], [], False
+            if recording and self._motion_gate is not None:
+                if not self._write_queue_is_active:
+                    self._motion_gate.reset()
+                frame = self._frame_buffer.frame(self.current_frame_slot) if self.current_frame_slot is not None \
+                        else self.current_frame_data.reshape(self._frame_buffer.shape)
+                held = self._motion_gate.update(frame)
+                gated = held is None
+                for item in held or []: # frames from just before motion started
+                    self._put_streams(item)
+            if recording and not gated: # streams recording this frame, and those that have to journal it
+                seq = self._frame_buffer.upcoming_seq()
+                takers = [stream for stream in self._streams if stream.takes(seq)]
+                # Frames received straight into the ring (zero copy) already have their slot,
+                # so only the writers' backlogs count
+                ring_full = self.current_frame_slot is None and self._frame_buffer.full()
+                spilling = [stream for stream in takers
+                            if stream.journal is not None and (ring_full or stream.backlogged())]
+            if self.current_frame_slot is not None: # frame is already in the ring (zero copy)
+                slot = self.current_frame_slot
+                self._frame_buffer.write(slot, None, self.current_frame_timestamp,
+                                         self.current_frame_hardware_timestamp)
+            elif takers and len(spilling) == len(takers):
+                slot = None # frame goes straight to the journal(s)
+            elif gated and self._frame_buffer.full():
+                slot = None # not recorded, and there's no room to hold it
+            else:
+                slot = self._frame_buffer.acquire(self._stop_signal) # waits if the writer is behind
+                if slot is None:
+                    break
+                self._frame_buffer.write(slot, self.current_frame_data, self.current_frame_timestamp,
+                                         self.current_frame_hardware_timestamp)
+            if metrics is not None:
+                written = time.perf_counter_ns()
+                metrics.record('ring', written - captured)
+
+            if recording and not self._write_queue_is_active and self._pretrigger is not None:
+                self._flush_pretrigger()
 
-            if self._write_queue_signal.value:
-                self._write_queue.put((self.current_frame_data, 
-                                       self.current_frame_timestamp)) # needs to block because we want every frame saved!
+            if recording and gated:
+                if slot is None:
+                    self._frame_buffer.next_seq() # the frame is missing from the recording
+                else:
+                    self._motion_gate.hold(slot)
                 self._write_queue_is_active = True
+            elif recording:
+                if slot is None:
+                    frame, seq = self.current_frame_data, self._frame_buffer.next_seq()
+                else:
+                    frame, seq = self._frame_buffer.frame(slot), self._frame_buffer.seq(slot)
+                for stream in takers:
+                    if stream in spilling:
+                        stream.spill(frame, seq, self.current_frame_timestamp,
+                                     self.current_frame_hardware_timestamp)
+                    else:
+                        stream.put(slot)
+                self._write_queue_is_active = True
+                if metrics is not None:
+                    metrics.record('queue_put', time.perf_counter_ns() - written)
             elif self._write_queue_is_active: # We've recently toggled recording off
-                self._write_queue.put(None)
+                for stream in self._streams:
+                    stream.queue.put(None)
                 self._write_queue_is_active = False
+            elif self._pretrigger is not None and slot is not None:
+                self._pretrigger.add(slot)
 
-            try:
-                self._display_queue.put((self.current_frame_data, 
-                                         self.current_frame_timestamp),
-                                         block=False) # doesn't need to block because we don't care about dropping frames
-            except queue.Full:
-                continue
+            if slot is not None:
+                self.publish_preview(slot)
                 
             self.post_queue() # This might, for example allow for a buffer to be reallocated
+            if metrics is not None:
+                metrics.frame()
 
         self.stop_acquisition()
+        if metrics is not None:
+            metrics.close()
+        for stream in self._streams:
+            if stream.journal is not None:
+                stream.journal.close()
+        if self._pretrigger is not None:
+            self._pretrigger.close()
 
         if self._write_queue_is_active:
-            self._write_queue.put(None) # Sentinel that we're done!
+            for stream in self._streams:
+                stream.queue.put(None) # Sentinel that we're done!
             print('Pushed a None onto write queue')
 
         self._display_queue.put(None) # Sentinel that we're done!
 
         print ("Stopped acquisition")
-
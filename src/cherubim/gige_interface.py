@@ -1,10 +1,21 @@
+import collections
+import math
+import time
+
 import numpy as np
-import cv2
 
 try:
     from cherubim.generic_camera_interface import GenericCameraInterface
+    from cherubim.demosaic import DemosaicStage, bin_2x2
+    from cherubim.frame_buffer import frame_shape
+    from cherubim.stream_health import StreamHealth, frame_id_gap, FRAMES_LOST, BUFFERS_FAILED, \
+        BUFFER_UNDERRUNS, PACKETS_MISSING, PACKETS_RESENT, COUNT_NAMES
 except ModuleNotFoundError:
     from generic_camera_interface import GenericCameraInterface
+    from demosaic import DemosaicStage, bin_2x2
+    from frame_buffer import frame_shape
+    from stream_health import StreamHealth, frame_id_gap, FRAMES_LOST, BUFFERS_FAILED, \
+        BUFFER_UNDERRUNS, PACKETS_MISSING, PACKETS_RESENT, COUNT_NAMES
 
 import gi
 gi.require_version ('Aravis', '0.8')
@@ -48,9 +59,38 @@ def check_camera(config):
     return (width, height)
 
 
+def stream_buffer_count(config, payload):
+    """StreamBuffers, or enough buffers for StreamBufferSeconds (default 0.5 s) of frames,
+    bounded by StreamBufferMB of memory."""
+    if config.get('StreamBuffers', None):
+        return int(config['StreamBuffers'])
+    wanted = math.ceil(config.get('FrameRate', 30) * config.get('StreamBufferSeconds', 0.5))
+    budget = config.get('StreamBufferMB', 512) * 1024**2 // payload
+    return int(max(8, min(max(wanted, 16), budget)))
+
+
+def stream_statistics(stream):
+    """Aravis' own counters for a stream, by name (e.g., 'n_underruns', 'n_missing_packets')."""
+    if hasattr(stream, 'get_n_infos'): # Aravis >= 0.8.11 lists all of them
+        statistics = {}
+        for i in range(stream.get_n_infos()):
+            try:
+                statistics[stream.get_info_name(i)] = stream.get_info_uint64(i)
+            except (TypeError, ValueError): # not a counter
+                pass
+        return statistics
+    completed, failures, underruns = Aravis.Stream.get_statistics(stream)
+    statistics = {'n_completed_buffers': completed, 'n_failures': failures, 'n_underruns': underruns}
+    if isinstance(stream, Aravis.GvStream):
+        statistics['n_resent_packets'], statistics['n_missing_packets'] = Aravis.GvStream.get_statistics(stream)
+    return statistics
+
+
 class GigECameraInterface(GenericCameraInterface):
-    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal):
-        super().__init__(config, display_queue, write_queue, stop_signal, write_queue_signal)
+    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                 preview_buffer=None, journal=None, metrics=None, health=None):
+        super().__init__(config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                         preview_buffer, journal, metrics, health)
 
         try:
             self.camera = Aravis.Camera.new (config.get('CameraID', None))
@@ -91,14 +131,28 @@ class GigECameraInterface(GenericCameraInterface):
         else:
             raise ValueError('Unsupported video mode.')
 
-        self.camera.gv_set_packet_size(9000) # Assumes we have set the MTU on the GigE Interface
-        # self.camera.gv_auto_packet_size() # This will set packet size to max. Very important
+        # PacketSize: 9000 (default) assumes jumbo frames (MTU 9000) on the GigE interface.
+        # 'auto' has Aravis find the largest packet size that gets through.
+        if config.get('PacketSize', 9000) == 'auto':
+            self.camera.gv_auto_packet_size()
+        else:
+            self.camera.gv_set_packet_size(int(config.get('PacketSize', 9000)))
+        print ("Packet size   : %d" %(self.camera.gv_get_packet_size ()))
 
         [x,y,width,height] = self.camera.get_region ()
 
-        # Initialize numpy buffer for deBayer'ing
-        # self.rgb_img = np.zeros((height, width,3))  # converted image data is RGB
-        self.frame = None # will be for data from camera
+        # Color conversion runs on its own threads, into preallocated frames
+        self._demosaic = None
+        if self.mode == 'Bayer_RG8':
+            self._demosaic = DemosaicStage(frame_shape(config), # half size for 'superpixel'
+                                           algorithm=config.get('Demosaic', 'bilinear'),
+                                           num_threads=config.get('DemosaicThreads', 2),
+                                           latency=self.metrics.histogram('demosaic') if self.metrics else None)
+        self._demosaiced_frame = None # destination buffer to give back in post_queue
+        # SoftwareBinning: 2 halves Mono8 frames (after any binning in the camera itself)
+        self._binned = None
+        if self.mode == 'Mono8' and frame_shape(config)[0] < self.sy:
+            self._binned = np.empty(frame_shape(config), np.uint8)
 
         payload = self.camera.get_payload ()
 
@@ -110,19 +164,93 @@ class GigECameraInterface(GenericCameraInterface):
         print ("Pixel format  : %s" %(self.camera.get_pixel_format_as_string ()))
 
         self._stream = self.camera.create_stream (None, None)
-
-        for i in range(0,50): # Is 50 enough?
-            self._stream.push_buffer (Aravis.Buffer.new_allocate (payload))
+        # A larger socket buffer (SocketBufferSize, bytes) rides out scheduling hiccups
+        # that otherwise show up as missing or resent packets
+        if config.get('SocketBufferSize', None):
+            self._stream.set_property('socket-buffer', Aravis.GvStreamSocketBuffer.FIXED)
+            self._stream.set_property('socket-buffer-size', int(config['SocketBufferSize']))
+        if config.get('PacketResend', None) is not None:
+            self._stream.set_property('packet-resend', Aravis.GvStreamPacketResend.ALWAYS
+                                      if config['PacketResend'] else Aravis.GvStreamPacketResend.NEVER)
+
+        # Lost frames (gaps in the camera's frame IDs) and the stream's packet statistics
+        if self.health is None:
+            self.health = StreamHealth()
+        self._last_frame_id = None
+        self._statistics_interval = config.get('StreamStatisticsInterval', 1.0)
+        self._next_statistics = 0
+        self._reported = self.health.totals
+
+        # Aravis writes frames straight into memory we own, which we then view with numpy
+        # (no get_data() copy). For Mono8 the stream buffers are the slots of the shared frame
+        # ring itself, and a buffer only goes back to the stream once the writer releases it.
+        # (Not with an uncompressed pre-trigger window or a motion gate, which rely on slots
+        # staying untouched until the ring comes back around to them.)
+        self._buffer_memory = {} # Aravis buffer -> (numpy array it writes into, ring slot or None)
+        ring_window = (config.get('PreTriggerSeconds', 0) and not config.get('PreTriggerCompress', False)) \
+                      or config.get('MotionThreshold', None) is not None
+        if self.mode == 'Mono8' and self._binned is None and payload <= self._frame_buffer.slot_nbytes \
+                and not ring_window:
+            for slot in range(self._frame_buffer.num_slots):
+                self._add_stream_buffer(self._frame_buffer.frame(slot).reshape(-1), payload, slot)
+        else:
+            for i in range(stream_buffer_count(config, payload)):
+                self._add_stream_buffer(np.empty(payload, np.uint8), payload, None)
+        print ("Buffers       : %d" %(len(self._buffer_memory)))
 
         self.image_buffer = None
+        self._held_buffers = collections.deque() # published ring slots waiting on the writer
         
 
+    def _add_stream_buffer(self, memory, payload, slot):
+        image_buffer = Aravis.Buffer.new(payload, memory.ctypes.data) # preallocated - no copy
+        self._buffer_memory[image_buffer] = (memory, slot)
+        self._stream.push_buffer(image_buffer)
+
+    def _return_released_buffers(self):
+        # The writer releases slots in order
+        while self._held_buffers and not self._frame_buffer.held(self._held_buffers[0][1]):
+            image_buffer, slot = self._held_buffers.popleft()
+            self._frame_buffer.invalidate(slot) # the display may still be copying it
+            self._stream.push_buffer(image_buffer)
+
+    def _check_frame_id(self, image_buffer):
+        """Count the frames missing before image_buffer (by the camera's frame IDs)."""
+        frame_id = image_buffer.get_frame_id()
+        if self._last_frame_id is not None:
+            lost = frame_id_gap(self._last_frame_id, frame_id)
+            if lost:
+                self.health.count(FRAMES_LOST, lost)
+        self._last_frame_id = frame_id
+
+    def _update_stream_statistics(self):
+        """Copy the stream's statistics into the shared counters (every StreamStatisticsInterval
+        seconds), and report anything that was lost since the last report."""
+        now = time.monotonic()
+        if now < self._next_statistics:
+            return
+        self._next_statistics = now + self._statistics_interval
+        statistics = stream_statistics(self._stream)
+        for index, name in [(BUFFER_UNDERRUNS, 'n_underruns'), (PACKETS_MISSING, 'n_missing_packets'),
+                            (PACKETS_RESENT, 'n_resent_packets')]:
+            if name in statistics:
+                self.health.set(index, statistics[name])
+        totals = self.health.totals
+        new = {name: totals[name] - self._reported[name] for name in COUNT_NAMES
+               if totals[name] > self._reported[name]}
+        if new:
+            print('Stream: ' + ', '.join('{} +{}'.format(name, n) for name, n in new.items()))
+        self._reported = totals
+
     def start_acquisition(self):
+        self._last_frame_id = None # the camera may restart its frame IDs
         self.camera.start_acquisition ()
         print('Acquisiton')
         return
 
-    def stop_acquisiton(self):
+    def stop_acquisition(self):
+        if self._demosaic is not None:
+            self._demosaic.shutdown() # lets conversions in progress return their Aravis buffers
         self.camera.stop_acquisition ()
         self.camera = None
         return
@@ -130,31 +258,63 @@ class GigECameraInterface(GenericCameraInterface):
     def get_frame(self):
         self.image_buffer = None
         while not self._stop_signal.value:
-            self.image_buffer = self._stream.timeout_pop_buffer (500) # timeout is us
-            if self.image_buffer:
-                if (self.image_buffer.get_status() != Aravis.BufferStatus.SUCCESS):
-                    print(self.image_buffer.get_status())
-                    continue # If we get a frame error, we'll print out and keep going
-                else:
-                    break
-
-        if self._stop_signal.value:
-            return False
-        else:
-            self.frame = self.image_buffer.get_data()
-            self.current_frame_timestamp = self.image_buffer.get_system_timestamp()
+            if self._demosaic is not None: # hand out any conversion that has finished
+                # (waiting for one if all destinations are taken - more frames stay in the stream)
+                converted = self._demosaic.pop(timeout=None if self._demosaic.full() else 0)
+                if converted is not None:
+                    self._demosaiced_frame, timestamps = converted
+                    self.current_frame_timestamp, self.current_frame_hardware_timestamp = timestamps
+                    self.current_frame_data = self._demosaiced_frame
+                    return True
+
+            image_buffer = self._stream.timeout_pop_buffer (500) # timeout is us
+            if not image_buffer:
+                self._return_released_buffers() # the stream may be starved while the writer catches up
+                self._update_stream_statistics()
+                continue
+            self._check_frame_id(image_buffer)
+            if (image_buffer.get_status() != Aravis.BufferStatus.SUCCESS):
+                print(image_buffer.get_status())
+                self.health.count(BUFFERS_FAILED)
+                self._stream.push_buffer(image_buffer)
+                continue # If we get a frame error, we'll print out and keep going
+
+            memory, slot = self._buffer_memory[image_buffer]
+            timestamp = image_buffer.get_system_timestamp()
+            hardware_timestamp = image_buffer.get_timestamp() # the camera's clock
 
             # De-Bayer / convert as needed
             if self.mode == 'Mono8': # no need!
-                self.current_frame_data = np.frombuffer(self.frame, np.uint8).reshape(self.sy, self.sx,1) # this is a cast!
+                self.image_buffer = image_buffer
+                self.current_frame_slot = slot
+                self.current_frame_data = memory[:self.sy*self.sx].reshape(self.sy, self.sx,1) # this is a view!
+                if self._binned is not None: # the stream buffer goes back in post_queue
+                    self.current_frame_data = bin_2x2(self.current_frame_data, self._binned)
+                self.current_frame_timestamp = timestamp
+                self.current_frame_hardware_timestamp = hardware_timestamp
+                return True
             elif self.mode == 'Bayer_RG8':
-                img_np = np.frombuffer(self.frame, np.uint8).reshape(self.sy, self.sx) # this is a cast
-                self.current_frame_data = cv2.cvtColor(img_np, cv2.COLOR_BayerRG2BGR)
+                img_np = memory[:self.sy*self.sx].reshape(self.sy, self.sx) # this is a view
+                # The Aravis buffer goes back to the stream as soon as it has been converted
+                # (both timestamps ride along with the frame)
+                self._demosaic.submit(img_np, (timestamp, hardware_timestamp),
+                                      on_done=lambda b=image_buffer: self._stream.push_buffer(b))
 
-            return True
+        return False
 
     def post_queue(self):
-        self._stream.push_buffer(self.image_buffer)
+        if self.image_buffer is not None:
+            if self.current_frame_slot is None:
+                self._stream.push_buffer(self.image_buffer) # frame has been copied out
+            else:
+                self._held_buffers.append((self.image_buffer, self.current_frame_slot))
+            self.image_buffer = None
+            self.current_frame_slot = None
+        self._return_released_buffers()
+        self._update_stream_statistics()
+        if self._demosaiced_frame is not None:
+            self._demosaic.release(self._demosaiced_frame)
+            self._demosaiced_frame = None
         return
 
 
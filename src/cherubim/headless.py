@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Recording without a display (cherubim-record).
+
+Runs the same camera and writer processes as the GUI, but never imports Qt. The
+camera interfaces (cv2, Aravis) are only imported in the camera processes, so
+startup is quick. Recording starts right away (or on SIGUSR1 with --wait) and stops
+after --duration seconds or on SIGUSR2. SIGINT/SIGTERM finish the current recording
+and exit.
+
+    cherubim-record config.yaml --duration 3600
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+try:
+    from cherubim.pipeline import CameraPipeline, configure_camera, read_config_file
+    from cherubim.multicamera import camera_configs, recording_filename, recording_basename, merge_timestamps
+    from cherubim.metrics import MetricsCollector
+except ModuleNotFoundError:
+    from pipeline import CameraPipeline, configure_camera, read_config_file
+    from multicamera import camera_configs, recording_filename, recording_basename, merge_timestamps
+    from metrics import MetricsCollector
+
+
+class HeadlessRecorder():
+    """Camera pipelines driven from a polling loop instead of GUI timers."""
+    def __init__(self, config, cameras, status_interval=10):
+        self.config = config
+        self.cameras = cameras
+        self.filename_header = config.get('FilenameHeader', None)
+        self.writer_filename = None
+        self.recording_active = False
+        self._status_interval = status_interval
+        self._next_status = 0
+
+        self.record_signal = multiprocessing.Value('b', False)
+        self.metrics_queue = None
+        self.metrics = None
+        if config.get('Metrics', True):
+            self.metrics_queue = multiprocessing.Queue()
+            self.metrics = MetricsCollector(self.metrics_queue, filename=config.get('MetricsFile', None),
+                                            port=config.get('MetricsPort', None))
+        self.pipelines = [CameraPipeline(camera_config, self.record_signal, self.metrics_queue)
+                          for camera_config in cameras]
+        for pipeline in self.pipelines:
+            pipeline.start()
+
+    def poll(self):
+        """Drain the (unused) previews and collect metrics. Call every few ms."""
+        for pipeline in self.pipelines:
+            slot = pipeline.poll_display()
+            if slot is not None:
+                pipeline.release_display(slot)
+        if self.metrics is not None:
+            self.metrics.poll()
+            if self._status_interval and time.monotonic() >= self._next_status:
+                self._next_status = time.monotonic() + self._status_interval
+                summary = self.metrics.summary()
+                if summary:
+                    print(summary)
+
+    def start_record(self):
+        self.writer_filename = recording_basename(self.filename_header)
+        for pipeline in self.pipelines:
+            pipeline.start_writer(recording_filename(self.writer_filename, pipeline.config))
+        self.record_signal.value = True
+        self.recording_active = True
+        print('Recording to {}.'.format(self.writer_filename))
+
+    def stop_record(self):
+        self.record_signal.value = False # triggers end of write by sending None on queue
+        while not all(pipeline.writer_finished() for pipeline in self.pipelines):
+            self.poll()
+            time.sleep(0.01)
+        for pipeline in self.pipelines:
+            pipeline.join_writer()
+        self.recording_active = False
+        if len(self.pipelines) > 1:
+            merge_timestamps(self.cameras, self.writer_filename)
+        totals = {}
+        for pipeline in self.pipelines:
+            for key, value in (pipeline.frame_counts() or {}).items():
+                totals[key] = totals.get(key, 0) + value
+        print('Stopped recording {}.{}'.format(self.writer_filename,
+              ''.join(' {} {}.'.format(key, value) for key, value in totals.items() if value)))
+
+    def close(self):
+        if self.recording_active:
+            self.stop_record()
+        for pipeline in self.pipelines:
+            pipeline.stop()
+        for pipeline in self.pipelines:
+            pipeline.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record from the cameras in a cherubim config without a display.')
+    parser.add_argument('config', help='YAML config file')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Seconds to record (default: until SIGUSR2, SIGINT or SIGTERM)')
+    parser.add_argument('--wait', action='store_true',
+                        help="Don't record until SIGUSR1 (then record for --duration, and wait again)")
+    parser.add_argument('--status-interval', type=float, default=10,
+                        help='Seconds between metrics summaries (0 for none)')
+    args = parser.parse_args()
+
+    config = read_config_file(args.config)
+    if config is None:
+        sys.exit(1)
+    cameras = camera_configs(config)
+    for camera_config in cameras:
+        if not os.path.isdir(camera_config.get('LogDirectory', os.getcwd())):
+            print('LogDirectory [{}] not found.'.format(camera_config.get('LogDirectory')))
+            sys.exit(1)
+        if not configure_camera(camera_config):
+            sys.exit(1)
+
+    # The camera and writer processes ignore Ctrl-C - this process stops them in order
+    for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2]:
+        signal.signal(signum, signal.SIG_IGN)
+    recorder = HeadlessRecorder(config, cameras, args.status_interval)
+
+    # Signal handlers only set flags; the loop below acts on them
+    requests = {'start': not args.wait, 'stop': False, 'exit': False}
+    def request(name):
+        def handler(signum, frame):
+            requests[name] = True
+        return handler
+    signal.signal(signal.SIGUSR1, request('start'))
+    signal.signal(signal.SIGUSR2, request('stop'))
+    signal.signal(signal.SIGINT, request('exit'))
+    signal.signal(signal.SIGTERM, request('exit'))
+    print('Camera process(es) started (pid {}).{}'.format(os.getpid(),
+          ' Send SIGUSR1 to start recording.' if args.wait else ''))
+    stop_time = None
+    try:
+        while not requests['exit']:
+            if requests['start'] and not recorder.recording_active:
+                recorder.start_record()
+                stop_time = time.monotonic() + args.duration if args.duration else None
+            requests['start'] = False
+
+            if recorder.recording_active and (requests['stop'] or (stop_time and time.monotonic() >= stop_time)):
+                recorder.stop_record()
+                if not args.wait: # a single recording
+                    break
+            requests['stop'] = False
+
+            if any(pipeline.display_finished for pipeline in recorder.pipelines):
+                print('A camera process has stopped.')
+                break
+            recorder.poll()
+            time.sleep(0.02)
+    finally:
+        recorder.close()
+
+
+if __name__ == "__main__":
+    main()
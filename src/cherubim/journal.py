@@ -0,0 +1,95 @@
+"""Overflow journal for frames the writer can't keep up with.
+
+While recording, the frame ring is the in-memory budget for frames waiting to be
+written. When the writer's backlog fills it, the camera process appends further
+frames to a journal file (sequential raw writes) and queues a JournalFrame in their
+place. The writer reads them back in order, so the recording is unchanged - it just
+finishes later. Frames that don't fit in the journal either (JournalMB) are dropped.
+Every deferred, recovered and dropped frame is counted in shared memory.
+"""
+import collections
+import multiprocessing
+import os
+
+import numpy as np
+
+# Indices into FrameJournal.counters
+DEFERRED, RECOVERED, DROPPED = range(3)
+
+# Queued to the writer in place of a slot index
+JournalFrame = collections.namedtuple('JournalFrame', ['offset', 'seq', 'timestamp', 'hardware_timestamp'],
+                                      defaults=[0])
+
+
+class FrameJournal():
+    """Journal file and frame counters shared by a camera process and its writer.
+
+    Only the camera process writes to the journal (and counts deferred and dropped
+    frames); only the writer reads it (and counts recovered frames). The file is
+    rewound whenever everything in it has been recovered.
+    """
+    def __init__(self, filename, shape, dtype=np.uint8, max_bytes=2 * 1024**3):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.max_bytes = max_bytes
+        self.counters = multiprocessing.Array('q', 3, lock=False)
+        self._fd = None
+        self._offset = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None # each process opens the file itself
+        return state
+
+    @property
+    def counts(self):
+        return {'FramesDeferred': self.counters[DEFERRED], 'FramesRecovered': self.counters[RECOVERED],
+                'FramesDropped': self.counters[DROPPED]}
+
+    def reset_counts(self):
+        """Only call while no recording is in progress."""
+        self.counters[:] = [0, 0, 0]
+
+    # Camera process side
+    def spill(self, frame, seq, timestamp, hardware_timestamp=0):
+        """Append frame to the journal. Returns a JournalFrame for the writer, or None
+        if the frame had to be dropped."""
+        if self.counters[RECOVERED] == self.counters[DEFERRED]:
+            self._offset = 0 # journal fully drained - start over
+        if self._offset + self.frame_nbytes > self.max_bytes:
+            self.counters[DROPPED] += 1
+            return None
+        if self._fd is None:
+            self._fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        data = np.ascontiguousarray(frame, dtype=self.dtype).reshape(-1).view(np.uint8)
+        os.pwrite(self._fd, data, self._offset)
+        record = JournalFrame(self._offset, seq, timestamp, hardware_timestamp)
+        self._offset += self.frame_nbytes
+        self.counters[DEFERRED] += 1
+        return record
+
+    # Writer side
+    def read(self, record, out=None):
+        """Read the frame stored for record (into out if given)."""
+        if self._fd is None:
+            self._fd = os.open(self.filename, os.O_RDONLY)
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        os.preadv(self._fd, [out.reshape(-1).view(np.uint8)], record.offset)
+        return out
+
+    def recovered(self):
+        self.counters[RECOVERED] += 1
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def unlink(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
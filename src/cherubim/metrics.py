@@ -0,0 +1,261 @@
+"""Per-stage latency and throughput metrics of the camera, writer and display.
+
+Each process keeps a ProcessMetrics: latency histograms of its stages (power of two
+microsecond buckets, so recording a sample is a few integer operations), frame and
+byte counters, gauges such as queue depths, event counters such as frames the camera
+lost (see stream_health.py), and its CPU use. Every MetricsInterval
+seconds a snapshot is sent (without blocking) over a shared metrics queue to the
+MetricsCollector in the GUI process, which shows a summary in the status bar,
+rewrites MetricsFile and, with MetricsPort set, serves the same Prometheus text
+format at http://127.0.0.1:<MetricsPort>/metrics.
+
+Stages:
+    camera  get_frame  - waiting for and converting the next frame
+            demosaic   - Bayer conversion on the demosaic threads
+            ring       - waiting for a free slot and copying the frame into the ring
+            queue_put  - handing the slot to the writer
+    writer  queue      - from the frame being published in the ring to the writer taking it
+            encode     - JPEG encoding (MJPEG written in the writer process)
+            write      - writing the (encoded) frame to the file or encoder
+    display display    - from the frame being published to it being shown
+            render     - converting and painting the preview
+"""
+import http.server
+import os
+import queue
+import threading
+import time
+
+_NUM_BUCKETS = 24 # bucket i holds latencies below 2**i us; the last one everything longer
+
+
+class LatencyHistogram():
+    """Not thread safe: add() must always be called from the same thread."""
+    def __init__(self):
+        self.counts = [0] * _NUM_BUCKETS
+        self.sum_ns = 0
+
+    def add(self, ns):
+        self.counts[min((ns // 1000).bit_length(), _NUM_BUCKETS - 1)] += 1
+        self.sum_ns += ns
+
+    @staticmethod
+    def upper_bounds():
+        """Upper bound of each bucket in seconds (the last one is unbounded)."""
+        return [2**i * 1e-6 for i in range(_NUM_BUCKETS - 1)] + [float('inf')]
+
+
+def histogram_quantile(counts, q):
+    """Upper bound (s) of the bucket holding quantile q of a histogram's counts."""
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+    running = 0
+    bounds = LatencyHistogram.upper_bounds()
+    for count, bound in zip(counts, bounds):
+        running += count
+        if running >= q * total:
+            return bound
+    return bounds[-1]
+
+
+class ProcessMetrics():
+    """Metrics of one process (process is 'camera', 'writer' or 'display')."""
+    def __init__(self, process, camera=None, metrics_queue=None, interval=1.0):
+        self.process = process
+        self.camera = camera or ''
+        self._queue = metrics_queue
+        if hasattr(metrics_queue, 'cancel_join_thread'):
+            metrics_queue.cancel_join_thread() # an unread snapshot must never keep this process from exiting
+        self._interval = interval
+        self._histograms = {}
+        self._gauges = {}
+        self._counters = {}
+        self._byte_count = None
+        self.frames = 0
+        self.bytes = 0
+        self._last_time = time.monotonic()
+        self._last_cpu = time.process_time()
+        self._last_frames = 0
+        self._last_bytes = 0
+        self._next_report = self._last_time + interval
+
+    def histogram(self, stage):
+        if stage not in self._histograms:
+            self._histograms[stage] = LatencyHistogram()
+        return self._histograms[stage]
+
+    def record(self, stage, ns):
+        self.histogram(stage).add(ns)
+
+    def gauge(self, name, callback):
+        """callback() is sampled at every report (e.g., a queue depth)."""
+        self._gauges[name] = callback
+
+    def counter(self, name, callback):
+        """callback() is sampled at every report - a count that only goes up (e.g., lost frames)."""
+        self._counters[name] = callback
+
+    def byte_count(self, callback):
+        """For processes that can't size each frame: callback() gives the bytes written so far."""
+        self._byte_count = callback
+
+    def frame(self, nbytes=0):
+        """Count a frame (of nbytes bytes) through this process, reporting when due."""
+        self.frames += 1
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now >= self._next_report:
+            self.report(now)
+
+    def snapshot(self, now=None, running=True):
+        now = time.monotonic() if now is None else now
+        cpu = time.process_time()
+        if self._byte_count is not None:
+            self.bytes = self._byte_count()
+        elapsed = max(now - self._last_time, 1e-9)
+        snapshot = {'process': self.process, 'camera': self.camera, 'running': running,
+                    'frames': self.frames, 'bytes': self.bytes,
+                    'fps': (self.frames - self._last_frames) / elapsed if running else 0.0,
+                    'bytes_per_second': (self.bytes - self._last_bytes) / elapsed if running else 0.0,
+                    'cpu_percent': 100 * (cpu - self._last_cpu) / elapsed if running else 0.0,
+                    'gauges': {name: callback() for name, callback in self._gauges.items()},
+                    'counters': {name: callback() for name, callback in self._counters.items()},
+                    'histograms': {stage: (list(h.counts), h.sum_ns) for stage, h in self._histograms.items()}}
+        self._last_time, self._last_cpu = now, cpu
+        self._last_frames, self._last_bytes = self.frames, self.bytes
+        return snapshot
+
+    def report(self, now=None, running=True):
+        now = time.monotonic() if now is None else now
+        self._next_report = now + self._interval
+        if self._queue is None:
+            return
+        try:
+            self._queue.put(self.snapshot(now, running), block=False) # never hold up frames for metrics
+        except queue.Full:
+            pass
+
+    def close(self):
+        """Send the final totals (rates drop to zero)."""
+        self.report(running=False)
+
+
+def _labels(snapshot, **extra):
+    labels = {'process': snapshot['process'], 'camera': snapshot['camera']}
+    labels.update(extra)
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels.items()) + '}'
+
+
+class MetricsCollector():
+    """Gathers the snapshots sent by every process (call poll() periodically)."""
+    def __init__(self, metrics_queue, filename=None, port=None):
+        self._queue = metrics_queue
+        self._filename = filename
+        self._latest = {} # (process, camera) -> newest snapshot
+        self._lock = threading.Lock()
+        self._server = None
+        if port:
+            collector = self
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = collector.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True, name='metrics-http').start()
+
+    def poll(self):
+        """Take in the snapshots that have arrived; rewrites the metrics file if any did."""
+        updated = False
+        while True:
+            try:
+                snapshot = self._queue.get(block=False)
+            except queue.Empty:
+                break
+            with self._lock:
+                self._latest[(snapshot['process'], snapshot['camera'])] = snapshot
+            updated = True
+        if updated and self._filename:
+            temporary = self._filename + '.tmp'
+            with open(temporary, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(temporary, self._filename) # readers never see a half written file
+        return updated
+
+    def snapshots(self):
+        with self._lock:
+            return list(self._latest.values())
+
+    def prometheus_text(self):
+        lines = []
+        snapshots = self.snapshots()
+        for name, key, kind, help_text in [
+                ('cherubim_frames_total', 'frames', 'counter', 'Frames through the process.'),
+                ('cherubim_bytes_total', 'bytes', 'counter', 'Encoded bytes written.'),
+                ('cherubim_fps', 'fps', 'gauge', 'Frames per second over the last interval.'),
+                ('cherubim_bytes_per_second', 'bytes_per_second', 'gauge', 'Encoded bytes per second.'),
+                ('cherubim_cpu_percent', 'cpu_percent', 'gauge', 'CPU use of the process (100 = one core).')]:
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+            lines += ['{}{} {}'.format(name, _labels(s), s[key]) for s in snapshots]
+
+        lines += ['# HELP cherubim_queue_depth Frames waiting in a queue.', '# TYPE cherubim_queue_depth gauge']
+        for s in snapshots:
+            lines += ['cherubim_queue_depth{} {}'.format(_labels(s, queue=name), value)
+                      for name, value in s['gauges'].items()]
+
+        lines += ['# HELP cherubim_events_total Frames and packets the camera lost or had resent.',
+                  '# TYPE cherubim_events_total counter']
+        for s in snapshots:
+            lines += ['cherubim_events_total{} {}'.format(_labels(s, event=name), value)
+                      for name, value in s.get('counters', {}).items()]
+
+        lines += ['# HELP cherubim_stage_latency_seconds Latency of each pipeline stage.',
+                  '# TYPE cherubim_stage_latency_seconds histogram']
+        bounds = LatencyHistogram.upper_bounds()
+        for s in snapshots:
+            for stage, (counts, sum_ns) in s['histograms'].items():
+                running = 0
+                for count, bound in zip(counts, bounds):
+                    running += count
+                    le = '+Inf' if bound == float('inf') else '{:g}'.format(bound)
+                    lines.append('cherubim_stage_latency_seconds_bucket{} {}'.format(
+                        _labels(s, stage=stage, le=le), running))
+                lines.append('cherubim_stage_latency_seconds_sum{} {}'.format(_labels(s, stage=stage), sum_ns / 1e9))
+                lines.append('cherubim_stage_latency_seconds_count{} {}'.format(_labels(s, stage=stage), running))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line for the status bar: rates per process and the slowest stage (by p99)."""
+        parts = []
+        slowest = None
+        for s in sorted(self.snapshots(), key=lambda s: (s['camera'], s['process'])):
+            if not s['running']:
+                continue
+            text = '{}{} {:.1f} fps'.format(s['camera'] + ' ' if s['camera'] else '', s['process'], s['fps'])
+            if s['bytes_per_second']:
+                text += ' {:.1f} MB/s'.format(s['bytes_per_second'] / 1024**2)
+            parts.append(text + ' {:.0f}% CPU'.format(s['cpu_percent']))
+            events = ['{} {}'.format(name, value) for name, value in s.get('counters', {}).items() if value]
+            if events:
+                parts.append('{}{}'.format(s['camera'] + ' ' if s['camera'] else '', ', '.join(events)))
+            for stage, (counts, _) in s['histograms'].items():
+                p99 = histogram_quantile(counts, 0.99)
+                if slowest is None or p99 > slowest[0]:
+                    slowest = (p99, s['process'], stage)
+        if slowest is not None and slowest[0] > 0:
+            parts.append('slowest {}/{} p99 < {:.1f} ms'.format(slowest[1], slowest[2], slowest[0] * 1e3))
+        return ' | '.join(parts)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
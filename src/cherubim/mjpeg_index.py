@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Frame index for .mjpeg recordings.
+
+The index is a small binary sidecar (<name>_index.bin) written by VideoWriter: an
+8 byte magic followed by one INDEX_DTYPE record per frame. It can be loaded with
+    np.fromfile(filename, dtype=INDEX_DTYPE, offset=len(INDEX_MAGIC))
+"""
+import argparse
+import mmap
+import os
+import sys
+
+import numpy as np
+
+try:
+    from cherubim.timestamp_log import read_timestamps
+except ModuleNotFoundError:
+    from timestamp_log import read_timestamps
+
+INDEX_MAGIC = b'CHRBIDX1'
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'),
+                        ('camera_timestamp', '<i8'), ('write_timestamp', '<i8')])
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+
+# Colorspace that decodes each mode's JPEGs back to the layout of the frame ring
+JPEG_COLORSPACES = {'Mono8': 'GRAY', 'Bayer_RG8': 'BGR', 'RGB8': 'RGB'}
+
+
+def jpeg_encode_kwargs(mode, quality):
+    """simplejpeg.encode_jpeg arguments for frames published in mode."""
+    if mode == 'Mono8':
+        return dict(quality=quality, colorspace='Gray', colorsubsampling='Gray')
+    elif mode == 'Bayer_RG8':
+        return dict(quality=quality, colorspace='BGR', colorsubsampling='444')
+    elif mode == 'RGB8':
+        return dict(quality=quality, colorspace='RGB', colorsubsampling='444')
+    raise ValueError('Unsupported video mode. ({})'.format(mode))
+
+
+def index_filename(video_filename):
+    return '{}_index.bin'.format(os.path.splitext(video_filename)[0])
+
+
+def load_index(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError('{} is not a cherubim frame index.'.format(filename))
+    return np.fromfile(filename, dtype=INDEX_DTYPE, offset=len(INDEX_MAGIC))
+
+
+class MJPEGIndexWriter():
+    """Appends index records as frames are written; records are flushed in blocks."""
+    def __init__(self, filename, block_size=256):
+        self._file = open(filename, 'wb')
+        self._file.write(INDEX_MAGIC)
+        self._records = np.zeros(block_size, dtype=INDEX_DTYPE)
+        self._count = 0
+        self._offset = 0
+
+    def append(self, length, camera_timestamp, write_timestamp):
+        self._records[self._count] = (self._offset, length, camera_timestamp, write_timestamp)
+        self._offset += length
+        self._count += 1
+        if self._count == len(self._records):
+            self.flush()
+
+    def flush(self):
+        self._records[:self._count].tofile(self._file)
+        self._file.flush()
+        self._count = 0
+
+    def close(self):
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+class MJPEGReader():
+    """Random access to the frames of an indexed .mjpeg recording.
+
+    reader[n] decodes frame n, reader.read_jpeg(n) returns its encoded bytes and
+    reader.frame_at_time(t) finds the last frame with camera timestamp <= t.
+    """
+    def __init__(self, filename, index=None):
+        if index is None:
+            if not os.path.exists(index_filename(filename)):
+                raise FileNotFoundError('No index for {}. Create one with cherubim-index.'.format(filename))
+            index = load_index(index_filename(filename))
+        self.index = index
+        self._file = open(filename, 'rb')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index['camera_timestamp']
+
+    def read_jpeg(self, n):
+        record = self.index[n]
+        return os.pread(self._file.fileno(), int(record['length']), int(record['offset']))
+
+    def read_frame(self, n, colorspace='RGB'):
+        import simplejpeg
+        return simplejpeg.decode_jpeg(self.read_jpeg(n), colorspace=colorspace)
+
+    def __getitem__(self, n):
+        return self.read_frame(n)
+
+    def frame_at_time(self, timestamp):
+        n = int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1
+        return max(n, 0)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+def rebuild_index(video_filename, timestamps_filename=None):
+    """Scan an .mjpeg file for frame boundaries and write its index sidecar.
+
+    Timestamps are taken from the recording's _timestamps.bin or _timestamps.csv
+    file if there is one.
+    """
+    timestamps = read_timestamps(timestamps_filename or video_filename)
+
+    # Entropy coded data never contains an unstuffed 0xFFD9, so EOI markers delimit frames
+    frames = []
+    with open(video_filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = data.find(JPEG_SOI)
+        while start >= 0:
+            end = data.find(JPEG_EOI, start + 2)
+            if end < 0:
+                print('Truncated frame at byte {} ignored.'.format(start))
+                break
+            frames.append((start, end + 2 - start))
+            start = data.find(JPEG_SOI, end + 2)
+
+    if timestamps is not None and len(timestamps) != len(frames):
+        print('Warning: {} frames but {} timestamps for {}.'.format(len(frames), len(timestamps), video_filename))
+
+    index = np.zeros(len(frames), dtype=INDEX_DTYPE)
+    if frames:
+        index['offset'], index['length'] = zip(*frames)
+    if timestamps is not None:
+        n = min(len(frames), len(timestamps))
+        index['camera_timestamp'][:n] = timestamps['camera_timestamp'][:n]
+        index['write_timestamp'][:n] = timestamps['host_timestamp'][:n]
+
+    with open(index_filename(video_filename), 'wb') as f:
+        f.write(INDEX_MAGIC)
+        index.tofile(f)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the frame index of cherubim .mjpeg recordings.')
+    parser.add_argument('recordings', nargs='+', help='.mjpeg files')
+    args = parser.parse_args()
+
+    for filename in args.recordings:
+        if not os.path.exists(filename):
+            print('{} not found.'.format(filename))
+            sys.exit(1)
+        index = rebuild_index(filename)
+        print('{}: indexed {} frames.'.format(filename, len(index)))
+
+
+if __name__ == "__main__":
+    main()
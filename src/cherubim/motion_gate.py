@@ -0,0 +1,101 @@
+"""Motion gate: record at full rate only while something moves.
+
+With MotionThreshold set, the camera process scores each frame while recording by
+the mean absolute difference (in gray levels) from the previous frame, over a grid
+of every MotionGridStep-th pixel of MotionRegion ([x, y, width, height], default the
+whole frame). Frames are recorded while the score is at least MotionThreshold and
+for MotionPostSeconds after it drops below. While idle, one frame is recorded every
+1/MotionKeepAliveFPS seconds (0 for none), and the last MotionPreSeconds of frames
+are kept in the frame ring (like the pre-trigger window), so the frames leading up
+to a movement are recorded when it starts.
+
+Frames that aren't recorded are simply missing from the recording. The binary
+timestamp log keeps the camera's frame numbers (camera_frame), which mark exactly which
+frames exist, so it is always written with MotionThreshold set (see timestamp_log.py).
+"""
+import collections
+import time
+
+import numpy as np
+
+try:
+    from cherubim.frame_buffer import frame_shape, motion_window_frames
+except ModuleNotFoundError:
+    from frame_buffer import frame_shape, motion_window_frames
+
+
+class MotionGate():
+    def __init__(self, config, frame_buffer):
+        self._frame_buffer = frame_buffer
+        self.threshold = float(config['MotionThreshold'])
+        height, width, channels = frame_shape(config)
+        x, y, w, h = config.get('MotionRegion', None) or [0, 0, width, height]
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+            raise ValueError('MotionRegion {} is outside the {}x{} frame.'.format([x, y, w, h], width, height))
+        step = max(1, int(config.get('MotionGridStep', 8)))
+        self._grid = (slice(y, y + h, step), slice(x, x + w, step))
+        grid_shape = (len(range(y, y + h, step)), len(range(x, x + w, step)), channels)
+        self._previous = np.zeros(grid_shape, np.int16)
+        self._current = np.zeros(grid_shape, np.int16)
+        self._primed = False
+
+        self.num_frames = motion_window_frames(config)
+        # Leave room for the frames that arrive while the window is being queued
+        available = frame_buffer.num_slots - 2
+        if available < self.num_frames:
+            print('Motion gate window limited to {} frames by the frame buffer size.'.format(available))
+            self.num_frames = available
+        self._post_ns = int(config.get('MotionPostSeconds', 2) * 1e9)
+        keepalive_fps = config.get('MotionKeepAliveFPS', 1)
+        self._keepalive_ns = int(1e9 / keepalive_fps) if keepalive_fps else None
+        self._window = collections.deque() # (slot, seq) of the idle frames not recorded yet
+        self._active_until = 0
+        self._next_keepalive = 0
+        self.activity = 0.0
+
+    def score(self, frame):
+        """Mean absolute difference of frame's grid from the previous frame's."""
+        np.copyto(self._current, frame[self._grid], casting='unsafe')
+        if self._primed:
+            np.subtract(self._current, self._previous, out=self._previous)
+            self.activity = float(np.abs(self._previous, out=self._previous).mean())
+        self._primed = True
+        self._previous, self._current = self._current, self._previous
+        return self.activity
+
+    def update(self, frame, now=None):
+        """Score the newest frame (shaped like the ring's frames).
+
+        Returns None if it isn't to be recorded, otherwise the slots of the held frames
+        (oldest first) to record ahead of it - those still in the ring when motion
+        starts. Held slots must be claimed before the camera acquires its next slot.
+        """
+        now = time.monotonic_ns() if now is None else now
+        held = []
+        if self.score(frame) >= self.threshold:
+            if now >= self._active_until: # motion starts
+                held = [slot for slot, seq in self._window if self._frame_buffer.seq(slot) == seq]
+            self._active_until = now + self._post_ns
+        elif now >= self._active_until and (self._keepalive_ns is None or now < self._next_keepalive):
+            return None
+        # Held frames older than a recorded one can't be recorded later
+        self._window.clear()
+        if self._keepalive_ns is not None:
+            self._next_keepalive = now + self._keepalive_ns
+        return held
+
+    def hold(self, slot):
+        """Remember an idle frame (just published in slot) that wasn't recorded."""
+        if self.num_frames == 0:
+            return
+        self._window.append((slot, self._frame_buffer.seq(slot)))
+        while len(self._window) > self.num_frames:
+            self._window.popleft()
+
+    def reset(self):
+        """Start a new recording idle, with an empty window."""
+        self._window.clear()
+        self._primed = False
+        self.activity = 0.0
+        self._active_until = 0
+        self._next_keepalive = 0
@@ -0,0 +1,123 @@
+import datetime
+import os
+import time
+
+import numpy as np
+
+try:
+    from cherubim.timestamp_log import read_timestamps
+    from cherubim.streams import stream_configs, stream_filename
+except ModuleNotFoundError:
+    from timestamp_log import read_timestamps
+    from streams import stream_configs, stream_filename
+
+
+def camera_configs(config):
+    """Expand a config into one config per camera.
+
+    A multi-camera config has a 'Cameras' list. Each entry holds the keys specific to
+    that camera (Name, Interface, CameraID, ...). Every other top-level key is a
+    default shared by all cameras. A config without 'Cameras' describes one camera.
+    """
+    if 'Cameras' not in config:
+        return [config]
+
+    defaults = {key: value for key, value in config.items() if key != 'Cameras'}
+    configs = []
+    for i, camera in enumerate(config['Cameras']):
+        camera_config = dict(defaults)
+        camera_config.update(camera)
+        camera_config.setdefault('Name', 'Camera{}'.format(i))
+        configs.append(camera_config)
+
+    names = [c['Name'] for c in configs]
+    if len(set(names)) != len(names):
+        raise ValueError('Camera names must be unique. ({})'.format(names))
+
+    if config.get('PinProcesses', False):
+        assign_cpus(configs)
+    return configs
+
+
+def assign_cpus(configs):
+    """Give each camera without an explicit 'CPUs' list its own share of the cores.
+
+    The camera process and writer (and its encoder pool) of a camera are pinned to
+    that share, so cameras don't compete with each other for cores.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    share = max(1, len(cpus) // len(configs))
+    for i, config in enumerate(configs):
+        if not config.get('CPUs', None):
+            start = (i * share) % len(cpus)
+            config['CPUs'] = cpus[start:start + share]
+
+
+def recording_basename(filename_header=None, now=None):
+    """Base name of a new recording: <FilenameHeader or ExperimentVideo>_<date>_<HHMM>."""
+    now = now or datetime.datetime.now()
+    return '{}_{}'.format(filename_header or 'ExperimentVideo', now.strftime("%Y-%m-%d_%H%M"))
+
+
+def recording_filename(base_filename, config):
+    """Per-camera file name for a recording (unchanged for a single unnamed camera)."""
+    if config.get('Name', None) is None:
+        return base_filename
+    return '{}_{}'.format(base_filename, config['Name'])
+
+
+def timestamp_clock(config):
+    """Clock of a camera's frame timestamps (ns): Aravis stamps GigE frames with the
+    system's wall clock ('realtime'), the other interfaces use CLOCK_MONOTONIC."""
+    return 'realtime' if config.get('Interface', 'WebCam') == 'GigE' else 'monotonic'
+
+
+def merge_timestamps(configs, base_filename, realtime_offset=None):
+    """Write <base_filename>_merged_timestamps.csv matching frames across cameras.
+
+    There is one row per frame of the first camera. For each camera, the row holds
+    the index and timestamp of its frame closest in time, or -1 if no frame is
+    within half a frame period. Timestamps are given in the first camera's clock (see
+    timestamp_clock()). Cameras on the other clock are moved by realtime_offset (wall
+    clock minus CLOCK_MONOTONIC, by default as it is now), which is right as long as
+    the wall clock wasn't stepped since the recording. For cameras with Streams, the
+    stream with the highest frame rate is used.
+    """
+    if realtime_offset is None:
+        realtime_offset = time.time_ns() - time.monotonic_ns()
+    reference_clock = timestamp_clock(configs[0])
+    names, timestamps = [], []
+    for config in configs:
+        stream = min(stream_configs(config), key=lambda stream: stream.get('FrameDecimation', 1))
+        recorded = read_timestamps(os.path.join(config.get('LogDirectory', os.getcwd()),
+                                                 stream_filename(recording_filename(base_filename, config), stream)))
+        if recorded is None:
+            print('No timestamps found for {}'.format(config.get('Name')))
+            continue
+        names.append(config.get('Name'))
+        ts = recorded['camera_timestamp']
+        if timestamp_clock(config) != reference_clock:
+            ts = ts + (realtime_offset if reference_clock == 'realtime' else -realtime_offset)
+        timestamps.append(ts)
+    if not timestamps:
+        return None
+
+    reference = timestamps[0]
+    tolerance = 0.5e9 / configs[0].get('FrameRate', 30)
+    columns = []
+    for ts in timestamps:
+        if len(ts) == 0:
+            columns.append((np.full(len(reference), -1), np.full(len(reference), -1)))
+            continue
+        after = np.clip(np.searchsorted(ts, reference), 0, len(ts) - 1)
+        before = np.clip(after - 1, 0, len(ts) - 1)
+        nearest = np.where(np.abs(ts[before] - reference) < np.abs(ts[after] - reference), before, after)
+        matched = np.abs(ts[nearest] - reference) <= tolerance
+        columns.append((np.where(matched, nearest, -1), np.where(matched, ts[nearest], -1)))
+
+    out_filename = os.path.join(configs[0].get('LogDirectory', os.getcwd()),
+                                '{}_merged_timestamps.csv'.format(base_filename))
+    header = ','.join(field.format(name) for name in names for field in ['{}_frame', '{}_timestamp'])
+    np.savetxt(out_filename, np.column_stack([column for pair in columns for column in pair]),
+               fmt='%d', delimiter=',', header=header, comments='')
+    return out_filename
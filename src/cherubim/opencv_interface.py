@@ -45,8 +45,10 @@ def check_camera(config):
 
 
 class OpenCVCameraInterface(GenericCameraInterface):
-    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal):
-        super().__init__(config, display_queue, write_queue, stop_signal, write_queue_signal)
+    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                 preview_buffer=None, journal=None, metrics=None, health=None):
+        super().__init__(config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                         preview_buffer, journal, metrics, health)
 
         try:
             self._capture = cv2.VideoCapture(config.get('CameraID', 0))
@@ -80,7 +82,7 @@ class OpenCVCameraInterface(GenericCameraInterface):
     def get_frame(self):
         ret, self.frame = self._capture.read() # blocking
         self.current_frame_data = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
-        self.current_frame_timestamp = time.monotonic()
+        self.current_frame_timestamp = time.monotonic_ns() # CLOCK_MONOTONIC (see multicamera.timestamp_clock)
         if not ret: #
             print('Error in OpenCV capture.')
             return False
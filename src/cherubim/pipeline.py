@@ -0,0 +1,200 @@
+import multiprocessing
+import os
+import queue
+
+import yaml
+
+try:
+    from cherubim.videowriter import start_writer
+    from cherubim.camera_interface import start_camera
+    from cherubim.frame_buffer import SharedFrameBuffer, frame_shape, default_slot_count, \
+        preview_shape, preview_decimation
+    from cherubim.journal import FrameJournal
+    from cherubim.stream_health import StreamHealth
+    from cherubim.streams import stream_configs, stream_filename, cropped_shape, num_ring_readers
+except ModuleNotFoundError:
+    from videowriter import start_writer
+    from camera_interface import start_camera
+    from frame_buffer import SharedFrameBuffer, frame_shape, default_slot_count, \
+        preview_shape, preview_decimation
+    from journal import FrameJournal
+    from stream_health import StreamHealth
+    from streams import stream_configs, stream_filename, cropped_shape, num_ring_readers
+
+
+def read_config_file(file_path):
+    with open(file_path, 'r') as file:
+        try:
+            data = yaml.safe_load(file)
+            return data
+        except yaml.YAMLError as e:
+            print(f"Error reading YAML file: {e}")
+            return None
+
+
+def configure_camera(config):
+    """Check the camera described by config and fill in ResX/ResY where the
+    interface decides them. Returns False if the camera can't be used."""
+    interface_style = config.get('Interface', 'WebCam')
+    if interface_style == 'GigE':
+        pass # the camera is checked when the camera process opens it (Aravis is only loaded there)
+    elif interface_style == 'WebCam':
+        try:
+            from cherubim.opencv_interface import check_camera
+        except ModuleNotFoundError:
+            from opencv_interface import check_camera
+
+        retval = check_camera(config)
+        if retval:
+            frame_width, frame_height = retval[1], retval[0]
+            print(frame_width, frame_height)
+            config['ResX'] = frame_width
+            config['ResY'] = frame_height
+        else:
+            print('Looking for a camera but no web camera found.')
+            return False
+    elif interface_style in ['Synthetic', 'Replay']:
+        try:
+            from cherubim.synthetic_interface import check_camera
+        except ModuleNotFoundError:
+            from synthetic_interface import check_camera
+
+        retval = check_camera(config)
+        if retval:
+            config['ResX'], config['ResY'] = retval
+        else:
+            return False
+    else:
+        print('Unsupported Interface')
+        return False
+    return True
+
+
+class CameraPipeline():
+    """The camera process, its shared frame ring and (while recording) its writer process
+    (one per output stream, see streams.py).
+
+    record_signal is shared by every pipeline so that all cameras start and stop
+    sending frames to their writers together. Likewise metrics_queue (if given) is
+    shared by every pipeline's processes to report to one MetricsCollector.
+    """
+    def __init__(self, config, record_signal, metrics_queue=None):
+        self.config = config
+        self.metrics_queue = metrics_queue
+        self.name = config.get('Name', None)
+
+        self.streams = stream_configs(config)
+
+        self.display_queue = multiprocessing.Queue()
+        self.writer_queues = [multiprocessing.Queue() for stream in self.streams]
+        self.acquisition_stop_signal = multiprocessing.Value('b', False)
+        self.writer_done_signals = [multiprocessing.Value('b', False) for stream in self.streams]
+        self.record_signal = record_signal
+        # Frames live in shared memory; the queues above only carry slot indices
+        self.frame_buffer = SharedFrameBuffer(frame_shape(config), default_slot_count(config),
+                                              num_readers=num_ring_readers(config))
+        # Downscaled previews get their own small ring; otherwise the display reads the frame ring
+        self.preview_buffer = None
+        if preview_decimation(config) > 1:
+            self.preview_buffer = SharedFrameBuffer(preview_shape(config), 4, num_readers=1)
+        self.display_buffer = self.preview_buffer or self.frame_buffer
+        # Frames that don't fit in the ring while recording spill to a journal file
+        # (JournalMB: None makes the camera wait for the writer instead)
+        self.journals = [None] * len(self.streams)
+        for i, stream in enumerate(self.streams):
+            if stream.get('JournalMB', 2048) is not None:
+                journal_directory = stream.get('JournalDirectory', stream.get('LogDirectory', os.getcwd()))
+                journal_filename = os.path.join(journal_directory, '.cherubim_journal_{}_{}.bin'.format(
+                    os.getpid(), stream_filename(self.name or 'camera', stream)))
+                self.journals[i] = FrameJournal(journal_filename, cropped_shape(stream),
+                                                max_bytes=int(stream.get('JournalMB', 2048) * 1024**2))
+
+        # Frames and packets lost before they reach the ring (GigE cameras count them)
+        self.health = StreamHealth() if config.get('Interface', 'WebCam') == 'GigE' else None
+
+        self.camera_process = None
+        self.writer_processes = []
+        self.writer_filename = None
+        self.display_finished = False # set once the camera's end sentinel has been seen
+
+    def start(self):
+        self.camera_process = multiprocessing.Process(target=start_camera,
+            args=(self.config, self.display_queue, self.writer_queues,
+                  self.acquisition_stop_signal, self.record_signal, self.frame_buffer,
+                  self.preview_buffer, self.journals, self.metrics_queue, self.health))
+        self.camera_process.start()
+
+    def start_writer(self, filename):
+        self.writer_filename = filename
+        if self.health is not None:
+            self.health.start_recording()
+        for stream, writer_queue, done_signal, journal in zip(self.streams, self.writer_queues,
+                                                               self.writer_done_signals, self.journals):
+            done_signal.value = False
+            if journal is not None:
+                journal.reset_counts()
+            writer_process = multiprocessing.Process(target=start_writer,
+                args=(stream, writer_queue, done_signal, stream_filename(filename, stream),
+                      self.frame_buffer, journal, self.metrics_queue, self.health))
+            writer_process.start()
+            self.writer_processes.append(writer_process)
+
+    def frame_counts(self):
+        """Deferred/recovered/dropped frame counts of the current (or last) recording
+        (summed over the streams), and the frames and packets the camera lost."""
+        totals = {}
+        for journal in self.journals:
+            for key, value in (journal.counts if journal is not None else {}).items():
+                totals[key] = totals.get(key, 0) + value
+        if self.health is not None:
+            totals.update(self.health.counts)
+        return totals or None
+
+    def writer_finished(self):
+        return not self.writer_processes or all(signal.value for signal in self.writer_done_signals)
+
+    def join_writer(self):
+        for writer_process in self.writer_processes:
+            writer_process.join()
+        self.writer_processes = []
+
+    def poll_display(self):
+        """Drain the display queue. Returns the newest slot (release it with
+        release_display) or None if no new frame has arrived."""
+        newest = None
+        while True:
+            try:
+                slot = self.display_queue.get(block=False)
+            except queue.Empty:
+                break
+            if newest is not None: # skipped frame
+                self.release_display(newest)
+            if slot is None: # camera process has finished
+                self.display_finished = True
+            newest = slot
+        return newest
+
+    def release_display(self, slot):
+        self.display_buffer.release(slot, SharedFrameBuffer.DISPLAY_READER)
+
+    def stop(self):
+        self.acquisition_stop_signal.value = True # This should trigger a None, causing writer to exit
+
+    def close(self):
+        if not self.display_finished:
+            while self.display_queue.get(block=True) is not None:
+                pass
+            print('Cleared display queue to None')
+            self.display_finished = True
+
+        if self.camera_process is not None:
+            self.camera_process.join()
+            self.camera_process = None
+
+        for frame_buffer in [self.frame_buffer, self.preview_buffer]:
+            if frame_buffer is not None:
+                frame_buffer.close()
+                frame_buffer.unlink()
+        for journal in self.journals:
+            if journal is not None:
+                journal.unlink()
@@ -0,0 +1,86 @@
+"""Pre-trigger window: the frames from just before recording starts.
+
+While not recording, the camera process remembers the last PreTriggerSeconds of
+frames. When recording starts they are queued to the (new) writer ahead of the
+live frames, with their original sequence numbers and timestamps.
+
+By default the window is kept in the frame ring itself (which is made larger to
+hold it), so nothing is copied: only the slot indices are remembered, and a slot
+is queued if it hasn't been overwritten since. With PreTriggerCompress: True the
+frames are instead JPEG compressed as they arrive (on PreTriggerThreads threads)
+and the window is kept as encoded bytes, which bounds memory for long windows.
+"""
+import collections
+import concurrent.futures
+
+import simplejpeg
+
+try:
+    from cherubim.frame_buffer import SharedFrameBuffer, pretrigger_frames
+    from cherubim.mjpeg_index import jpeg_encode_kwargs
+except ModuleNotFoundError:
+    from frame_buffer import SharedFrameBuffer, pretrigger_frames
+    from mjpeg_index import jpeg_encode_kwargs
+
+# Queued to the writer in place of a slot index for compressed pre-trigger frames
+EncodedFrame = collections.namedtuple('EncodedFrame', ['jpeg', 'seq', 'timestamp', 'hardware_timestamp'],
+                                      defaults=[0])
+
+
+class PreTriggerBuffer():
+    def __init__(self, config, frame_buffer):
+        self._frame_buffer = frame_buffer
+        self.num_frames = pretrigger_frames(config)
+        self.compressed = config.get('PreTriggerCompress', False)
+        if self.compressed:
+            self._encode_kwargs = jpeg_encode_kwargs(config.get('Mode', 'Mono8'),
+                                                     config.get('CompressionQuality', 85))
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.get('PreTriggerThreads', 1))
+        else:
+            self._executor = None
+            # Leave room for the frames that arrive while the window is being written
+            available = frame_buffer.num_slots - 2
+            if available < self.num_frames:
+                print('Pre-trigger window limited to {} frames by the frame buffer size.'.format(available))
+                self.num_frames = available
+        self._frames = collections.deque() # (slot, encoding future or None, seq, timestamps...)
+
+    def add(self, slot):
+        """Remember the frame just published in slot (call only while not recording)."""
+        seq, timestamp = self._frame_buffer.seq(slot), self._frame_buffer.timestamp(slot)
+        hardware_timestamp = self._frame_buffer.hardware_timestamp(slot)
+        future = None
+        if self.compressed:
+            # The slot is held (like a writer would) until it has been encoded
+            self._frame_buffer.claim(slot, SharedFrameBuffer.WRITER_READER)
+            future = self._executor.submit(self._encode, slot)
+        self._frames.append((slot, future, seq, timestamp, hardware_timestamp))
+        while len(self._frames) > self.num_frames:
+            oldest_slot, oldest_future = self._frames.popleft()[:2]
+            if oldest_future is not None and oldest_future.cancel(): # never started - release its claim
+                self._frame_buffer.release(oldest_slot, SharedFrameBuffer.WRITER_READER)
+
+    def _encode(self, slot):
+        try:
+            return simplejpeg.encode_jpeg(self._frame_buffer.frame(slot), **self._encode_kwargs)
+        finally:
+            self._frame_buffer.release(slot, SharedFrameBuffer.WRITER_READER)
+
+    def flush(self):
+        """Items (slot indices or EncodedFrames) for the frames in the window, oldest first.
+        The window is emptied. Slots must be claimed for the writer(s) before the camera
+        acquires its next slot."""
+        items = []
+        for slot, future, seq, timestamp, hardware_timestamp in self._frames:
+            if future is not None:
+                items.append(EncodedFrame(future.result(), seq, timestamp, hardware_timestamp))
+            elif self._frame_buffer.seq(slot) == seq: # slot not overwritten since
+                items.append(slot)
+        self._frames.clear()
+        return items
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,127 @@
+"""Adaptive JPEG quality: keep an MJPEG writer real time when it falls behind.
+
+With AdaptiveQuality set, the writer checks its backlog every QualityInterval seconds
+(default 0.5): the frames it has been handed in the frame ring but not written yet,
+plus any waiting in its overflow journal. While the backlog is at least
+QualityBacklogFrames (default a quarter of the ring), or above a quarter of that and
+still growing, JPEG quality is lowered by QualityStep (default 5) at a time, down to
+MinCompressionQuality (default 50). After that, color frames switch to
+AdaptiveSubsampling (e.g., '420') if it is set. Once the backlog is back below a
+quarter of QualityBacklogFrames, the writer (its encoders or its disk writes) was busy
+for less than QualityHeadroom (default 0.75) of the interval and nothing was lowered
+for QualityRestoreSeconds (default 5), the steps are undone one at a time, back to
+CompressionQuality.
+
+Each frame's quality (and subsampling, with AdaptiveSubsampling) is logged with it in
+the timestamp logs, as the jpeg_quality (and jpeg_subsampling) fields.
+"""
+import time
+
+try:
+    from cherubim.mjpeg_index import jpeg_encode_kwargs
+    from cherubim.journal import DEFERRED, RECOVERED
+except ModuleNotFoundError:
+    from mjpeg_index import jpeg_encode_kwargs
+    from journal import DEFERRED, RECOVERED
+
+SUBSAMPLINGS = ['444', '422', '440', '420', '411'] # simplejpeg's colorsubsampling values
+
+
+class QualityController():
+    def __init__(self, config, mode, frame_buffer, reader, journal=None, workers=1):
+        self._mode = mode
+        self.max_quality = int(config.get('CompressionQuality', 85))
+        self.min_quality = int(config.get('MinCompressionQuality', min(50, self.max_quality)))
+        if not 1 <= self.min_quality <= self.max_quality <= 100:
+            raise ValueError('MinCompressionQuality ({}) must be between 1 and CompressionQuality ({}).'.format(
+                self.min_quality, self.max_quality))
+        self._step = max(1, int(config.get('QualityStep', 5)))
+        self._full_subsampling = jpeg_encode_kwargs(mode, self.max_quality)['colorsubsampling']
+        self._reduced_subsampling = None
+        if config.get('AdaptiveSubsampling', None) and mode != 'Mono8':
+            self._reduced_subsampling = str(config['AdaptiveSubsampling'])
+            if self._reduced_subsampling not in SUBSAMPLINGS:
+                raise ValueError('Unsupported AdaptiveSubsampling. ({})'.format(self._reduced_subsampling))
+        # Extra timestamp log fields
+        self.fields = [('jpeg_quality', '<u1')]
+        if self._reduced_subsampling is not None:
+            self.fields.append(('jpeg_subsampling', '<u2'))
+
+        self._frame_buffer = frame_buffer
+        self._reader = reader
+        self._journal = journal
+        self._workers = max(1, workers)
+        self._high = int(config.get('QualityBacklogFrames', max(frame_buffer.num_slots // 4, 4)))
+        self._low = self._high // 4
+        self._interval_ns = int(config.get('QualityInterval', 0.5) * 1e9)
+        self._headroom = config.get('QualityHeadroom', 0.75)
+        self._restore_ns = int(config.get('QualityRestoreSeconds', 5) * 1e9)
+
+        self._interval_start = None
+        self._encode_ns = 0
+        self._write_ns = 0
+        self._backlog = 0
+        self._lowered = 0 # when quality was last lowered
+        self._set(self.max_quality, self._full_subsampling)
+        self.full_setting = self.setting # e.g., for pre-trigger frames encoded by the camera process
+
+    def _set(self, quality, subsampling):
+        self.quality, self.subsampling = quality, subsampling
+        encode_kwargs = jpeg_encode_kwargs(self._mode, quality)
+        encode_kwargs['colorsubsampling'] = subsampling
+        log_fields = {'jpeg_quality': quality}
+        if self._reduced_subsampling is not None:
+            log_fields['jpeg_subsampling'] = int(subsampling)
+        # (simplejpeg arguments, timestamp log fields) - replaced as a whole, so it can be
+        # read from the thread that feeds the encoder pool
+        self.setting = (encode_kwargs, log_fields)
+
+    def backlog(self):
+        backlog = self._frame_buffer.pending(self._reader)
+        if self._journal is not None:
+            backlog += self._journal.counters[DEFERRED] - self._journal.counters[RECOVERED]
+        return backlog
+
+    def frame(self, encode_ns, write_ns=0, now=None):
+        """Count a written frame (the time spent encoding and writing it). Returns True
+        when the setting changes."""
+        now = time.monotonic_ns() if now is None else now
+        if self._interval_start is None:
+            self._interval_start = now
+        self._encode_ns += encode_ns
+        self._write_ns += write_ns
+        elapsed = now - self._interval_start
+        if elapsed < self._interval_ns:
+            return False
+
+        backlog = self.backlog()
+        growing = backlog > self._backlog
+        busy = max(self._encode_ns / self._workers, self._write_ns) / elapsed
+        self._interval_start, self._encode_ns, self._write_ns, self._backlog = now, 0, 0, backlog
+
+        if backlog >= self._high or (backlog > self._low and growing):
+            self._lowered = now
+            return self._lower(backlog)
+        if backlog <= self._low and busy < self._headroom and now - self._lowered >= self._restore_ns:
+            return self._raise(backlog)
+        return False
+
+    def _lower(self, backlog):
+        if self.quality > self.min_quality:
+            self._set(max(self.quality - self._step, self.min_quality), self.subsampling)
+        elif self._reduced_subsampling is not None and self.subsampling != self._reduced_subsampling:
+            self._set(self.quality, self._reduced_subsampling)
+        else:
+            return False
+        print('Writer backlog {} frames: JPEG quality {} ({}).'.format(backlog, self.quality, self.subsampling))
+        return True
+
+    def _raise(self, backlog):
+        if self.subsampling != self._full_subsampling:
+            self._set(self.quality, self._full_subsampling)
+        elif self.quality < self.max_quality:
+            self._set(min(self.quality + self._step, self.max_quality), self.subsampling)
+        else:
+            return False
+        print('Writer backlog {} frames: JPEG quality {} ({}).'.format(backlog, self.quality, self.subsampling))
+        return True
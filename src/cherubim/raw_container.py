@@ -0,0 +1,128 @@
+"""Self-describing container for uncompressed recordings.
+
+A 4096 byte header is followed by the frames back to back:
+    bytes 0-7    RAW_MAGIC
+    bytes 8-15   frame count (little endian uint64, updated as batches are written)
+    bytes 16-19  length of the JSON description that follows
+    JSON         {"shape": [rows, cols, channels], "dtype": "|u1", "mode": ..., "frame_rate": ...,
+                  "start_time": ...}
+so a recording can be opened as an (N, H, W, C) array without any other metadata.
+"""
+import datetime
+import json
+import os
+import struct
+
+import numpy as np
+
+RAW_MAGIC = b'CHRBRAW1'
+HEADER_SIZE = 4096
+_ALIGNMENT = 4096
+
+
+class RawContainerWriter():
+    """Writes frames into a raw container.
+
+    Frames are gathered into a staging buffer and written in large, page aligned
+    batches. File space is reserved ahead of the writes in preallocate_bytes chunks.
+    """
+    def __init__(self, filename, shape, dtype=np.uint8, mode=None, frame_rate=None, start_time=None,
+                 batch_bytes=8 * 1024**2, preallocate_bytes=1024**3):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if start_time is None:
+            start_time = datetime.datetime.now().isoformat()
+
+        description = json.dumps({'shape': self.shape, 'dtype': self.dtype.str, 'mode': mode,
+                                  'frame_rate': frame_rate, 'start_time': start_time}).encode()
+        header = RAW_MAGIC + struct.pack('<QI', 0, len(description)) + description
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Raw container description is too long.')
+
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.pwrite(self._fd, header.ljust(HEADER_SIZE, b'\0'), 0)
+
+        self._batch_bytes = max(batch_bytes, _ALIGNMENT)
+        self._staging = np.empty(self._batch_bytes + self.frame_nbytes, np.uint8)
+        self._staged = 0 # bytes in the staging buffer
+        self._offset = HEADER_SIZE # file offset of the staging buffer
+        self._preallocate_bytes = preallocate_bytes
+        self._allocated = HEADER_SIZE
+        self.frame_count = 0
+
+    def write(self, frame):
+        self._staging[self._staged:self._staged + self.frame_nbytes] = frame.reshape(-1).view(np.uint8)
+        self._staged += self.frame_nbytes
+        self.frame_count += 1
+        if self._staged >= self._batch_bytes:
+            self._write_staged(self._staged // _ALIGNMENT * _ALIGNMENT)
+        return self.frame_nbytes
+
+    def _write_staged(self, nbytes):
+        end = self._offset + nbytes
+        if end > self._allocated and hasattr(os, 'posix_fallocate'):
+            grow = max(self._preallocate_bytes, end - self._allocated)
+            os.posix_fallocate(self._fd, self._allocated, grow)
+            self._allocated += grow
+
+        os.pwrite(self._fd, self._staging[:nbytes], self._offset)
+        self._offset = end
+        remainder = self._staged - nbytes # less than one page is carried over
+        self._staging[:remainder] = self._staging[nbytes:self._staged]
+        self._staged = remainder
+
+        frames_on_disk = (self._offset - HEADER_SIZE) // self.frame_nbytes
+        os.pwrite(self._fd, struct.pack('<Q', frames_on_disk), len(RAW_MAGIC))
+
+    def close(self):
+        if self._fd is not None:
+            self._write_staged(self._staged)
+            os.pwrite(self._fd, struct.pack('<Q', self.frame_count), len(RAW_MAGIC))
+            os.ftruncate(self._fd, HEADER_SIZE + self.frame_count * self.frame_nbytes) # drop unused preallocation
+            os.close(self._fd)
+            self._fd = None
+
+
+def read_header(filename):
+    """Returns the description dict (with 'frame_count') or None for a headerless .raw file."""
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(RAW_MAGIC)] != RAW_MAGIC:
+        return None
+    frame_count, description_length = struct.unpack_from('<QI', header, len(RAW_MAGIC))
+    start = len(RAW_MAGIC) + 12
+    description = json.loads(header[start:start + description_length])
+    description['shape'] = tuple(description['shape'])
+    description['frame_count'] = frame_count
+    return description
+
+
+class RawRecording():
+    """Memory-mapped access to a raw recording: recording.frames is an (N, H, W, C) array.
+
+    Headerless .raw files from older versions can be opened by passing their frame shape.
+    """
+    def __init__(self, filename, shape=None, dtype=np.uint8):
+        self.header = read_header(filename)
+        if self.header is not None:
+            shape, dtype = self.header['shape'], np.dtype(self.header['dtype'])
+            offset, count = HEADER_SIZE, self.header['frame_count']
+        elif shape is None:
+            raise ValueError('{} has no header - its frame shape must be given.'.format(filename))
+        else:
+            offset = 0
+            count = os.path.getsize(filename) // (int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+        self.shape = tuple(shape)
+        if count > 0:
+            self.frames = np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                                    shape=(count,) + self.shape)
+        else:
+            self.frames = np.zeros((0,) + self.shape, dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, n):
+        return self.frames[n]
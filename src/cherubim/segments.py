@@ -0,0 +1,47 @@
+"""Manifest of a recording split into segments (SegmentDuration / SegmentSize).
+
+Each segment <name>_0000, <name>_0001, ... is a complete recording of its own (video
+file, frame index and timestamp logs). <name>_segments.csv gets one row per segment
+as it is closed, giving the segment's video file, the first and last frame numbers
+(counted from the start of the recording) and the first and last camera timestamps.
+"""
+import csv
+import os
+
+MANIFEST_FIELDS = ['segment', 'filename', 'first_frame', 'last_frame', 'first_timestamp', 'last_timestamp']
+
+
+def manifest_filename(base_filename):
+    return '{}_segments.csv'.format(base_filename)
+
+
+def segment_filename(base_filename, segment):
+    return '{}_{:04d}'.format(base_filename, segment)
+
+
+class SegmentManifest():
+    def __init__(self, filename):
+        self._file = open(filename, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=MANIFEST_FIELDS)
+        self._writer.writeheader()
+        self._file.flush()
+
+    def add(self, segment, filename, first_frame, last_frame, first_timestamp, last_timestamp):
+        self._writer.writerow({'segment': segment, 'filename': os.path.basename(filename),
+                               'first_frame': first_frame, 'last_frame': last_frame,
+                               'first_timestamp': first_timestamp, 'last_timestamp': last_timestamp})
+        self._file.flush() # rows of finished segments survive a crash
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def read_manifest(filename):
+    """List of segment dicts; filename is the manifest or the recording's base name."""
+    if not filename.endswith('_segments.csv'):
+        filename = manifest_filename(filename)
+    with open(filename, 'r', newline='') as f:
+        return [{field: (row[field] if field == 'filename' else int(row[field])) for field in MANIFEST_FIELDS}
+                for row in csv.DictReader(f)]
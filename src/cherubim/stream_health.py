@@ -0,0 +1,60 @@
+"""Camera stream health: frames and packets lost before they reach the frame ring.
+
+The camera process counts gaps in the camera's frame IDs (frames that never
+arrived), buffers the stream gave back incomplete, and copies the stream's own
+statistics (Aravis counts missing and resent packets and buffer underruns). The
+counters live in shared memory, like the journal's, so the GUI can show them live
+and the writer can save each recording's share of them in <name>_metadata.yaml.
+"""
+import multiprocessing
+
+# Indices into StreamHealth.counters, and their names in the metadata
+FRAMES_LOST, BUFFERS_FAILED, BUFFER_UNDERRUNS, PACKETS_MISSING, PACKETS_RESENT = range(5)
+COUNT_NAMES = ['FramesLost', 'BuffersFailed', 'BufferUnderruns', 'PacketsMissing', 'PacketsResent']
+
+# GigE Vision 1.x frame (block) IDs count 1..65535 and then wrap back to 1
+FRAME_ID_WRAP = 65535
+
+
+def frame_id_gap(previous, frame_id):
+    """Number of frames missing between two consecutive frame IDs.
+
+    A repeated ID or a step back is the camera resetting its counter (or acquisition
+    restarting), not lost frames - unless it is a wrap from the top of the 16 bit range.
+    """
+    if frame_id > previous:
+        return frame_id - previous - 1
+    if previous <= FRAME_ID_WRAP and frame_id != previous:
+        wrapped = frame_id + FRAME_ID_WRAP - previous - 1 # 0 is never used
+        if wrapped < FRAME_ID_WRAP // 2:
+            return wrapped
+    return 0 # reset - extended (64 bit) IDs never wrap
+
+
+class StreamHealth():
+    """Counters shared by a camera process (which updates them) and everything else."""
+    def __init__(self):
+        self.counters = multiprocessing.Array('q', len(COUNT_NAMES), lock=False)
+        self._baseline = multiprocessing.Array('q', len(COUNT_NAMES), lock=False)
+
+    @property
+    def totals(self):
+        """Counts since the camera started."""
+        return dict(zip(COUNT_NAMES, self.counters[:]))
+
+    @property
+    def counts(self):
+        """Counts since the current (or last) recording started."""
+        return {name: total - start for name, total, start
+                in zip(COUNT_NAMES, self.counters[:], self._baseline[:])}
+
+    def start_recording(self):
+        self._baseline[:] = self.counters[:]
+
+    # Camera process side
+    def count(self, index, n=1):
+        self.counters[index] += n
+
+    def set(self, index, value):
+        """For counts the stream keeps itself (e.g., Aravis statistics)."""
+        self.counters[index] = value
@@ -0,0 +1,115 @@
+"""Several output streams (recordings) from one camera.
+
+A camera config with a 'Streams' list records each stream with its own writer
+process, e.g., a full rate crop around a lick port and a low rate view of the whole
+arena. Each entry can set:
+    Name            appended to the camera's file names (default Stream<n>)
+    Crop            [x, y, width, height] of the frame to record (default: all of it)
+    FrameDecimation record every Nth frame of the camera (default 1)
+    Mode            'Mono8' records a color camera's stream in grayscale
+and any writer key (Codec, CompressionQuality, EncoderWorkers, SegmentDuration, ...).
+Other keys are inherited from the camera's config.
+
+All streams read the camera's frame ring: each writer claims slots as its own ring
+reader, and crops with a numpy slice of the slot, so only the stream's pixels are
+encoded. Frames are cropped before they spill to a stream's overflow journal.
+"""
+try:
+    from cherubim.frame_buffer import SharedFrameBuffer, frame_shape
+except ModuleNotFoundError:
+    from frame_buffer import SharedFrameBuffer, frame_shape
+
+
+def stream_configs(config):
+    """One writer config per output stream of a camera config.
+
+    A camera without 'Streams' has a single stream recording every whole frame.
+    Each stream config has 'StreamReader' (its reader in the frame ring) and
+    'OutputMode' (the mode of the frames it writes) filled in.
+    """
+    if not config.get('Streams', None):
+        stream = dict(config)
+        stream.setdefault('StreamReader', SharedFrameBuffer.WRITER_READER)
+        stream.setdefault('OutputMode', config.get('Mode', 'Mono8'))
+        return [stream]
+
+    if config.get('PreTriggerSeconds', 0) and config.get('PreTriggerCompress', False):
+        raise ValueError('PreTriggerCompress is not supported with Streams.')
+    height, width, _ = frame_shape(config)
+    defaults = {key: value for key, value in config.items() if key != 'Streams'}
+    streams = []
+    for i, entry in enumerate(config['Streams']):
+        stream = dict(defaults)
+        stream.update({key: value for key, value in entry.items() if key not in ['Name', 'Mode']})
+        stream['StreamName'] = entry.get('Name', 'Stream{}'.format(i))
+        stream['StreamReader'] = SharedFrameBuffer.WRITER_READER + i
+        stream['OutputMode'] = entry.get('Mode', config.get('Mode', 'Mono8'))
+        if stream['OutputMode'] != config.get('Mode', 'Mono8') and stream['OutputMode'] != 'Mono8':
+            raise ValueError('Stream {} can only change Mode to Mono8.'.format(stream['StreamName']))
+        x, y, w, h = entry.get('Crop', [0, 0, width, height])
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+            raise ValueError('Crop {} of stream {} is outside the {}x{} frame.'.format(
+                entry['Crop'], stream['StreamName'], width, height))
+        stream['Crop'] = [x, y, w, h]
+        if int(stream.get('FrameDecimation', 1)) < 1:
+            raise ValueError('FrameDecimation of stream {} must be at least 1.'.format(stream['StreamName']))
+        streams.append(stream)
+
+    names = [stream['StreamName'] for stream in streams]
+    if len(set(names)) != len(names):
+        raise ValueError('Stream names must be unique. ({})'.format(names))
+    return streams
+
+
+def num_ring_readers(config):
+    """Readers of the camera's frame ring: the display and one per stream."""
+    return SharedFrameBuffer.WRITER_READER + len(stream_configs(config))
+
+
+def stream_crop(config):
+    """(row slice, column slice) of the frame recorded by a stream, or None for the whole frame."""
+    if not config.get('Crop', None):
+        return None
+    x, y, w, h = config['Crop']
+    return (slice(y, y + h), slice(x, x + w))
+
+
+def cropped_shape(config):
+    """Shape of a stream's crop of the camera's frames (as spilled to its journal)."""
+    height, width, channels = frame_shape(config)
+    if config.get('Crop', None):
+        width, height = config['Crop'][2], config['Crop'][3]
+    return (height, width, channels)
+
+
+def stream_shape(config):
+    """Shape of the frames written by a stream (see stream_configs)."""
+    height, width, channels = cropped_shape(config)
+    if config.get('OutputMode', config.get('Mode', 'Mono8')) == 'Mono8':
+        channels = 1
+    return (height, width, channels)
+
+
+def stream_filename(filename, config):
+    """File name of a stream's recording (unchanged for a camera without Streams)."""
+    if config.get('StreamName', None) is None:
+        return filename
+    return '{}_{}'.format(filename, config['StreamName'])
+
+
+def stream_converter(config, crop=True):
+    """f(frame) -> the stream's part of a frame from the ring: a view of the crop (or the
+    frame itself for crop=False, i.e., frames from the journal), converted to gray if
+    the stream's mode asks for it. None if there is nothing to do."""
+    crop = stream_crop(config) if crop else None
+    to_gray = frame_shape(config)[2] == 3 and stream_shape(config)[2] == 1
+    if crop is None and not to_gray:
+        return None
+    if not to_gray:
+        return lambda frame: frame[crop]
+
+    import cv2 # only in writers that convert
+    # Bayer_RG8 frames are in 'BGR' channel order (see JPEG_COLORSPACES); webcam frames are RGB
+    code = cv2.COLOR_BGR2GRAY if config.get('Mode', 'Mono8') == 'Bayer_RG8' else cv2.COLOR_RGB2GRAY
+    crop = crop or (slice(None), slice(None))
+    return lambda frame: cv2.cvtColor(frame[crop], code)[..., None]
@@ -0,0 +1,255 @@
+import os
+import time
+
+import numpy as np
+
+try:
+    from cherubim.generic_camera_interface import GenericCameraInterface
+    from cherubim.demosaic import DemosaicStage, bin_2x2
+    from cherubim.frame_buffer import frame_shape
+    from cherubim.mjpeg_index import MJPEGReader, index_filename, rebuild_index, JPEG_COLORSPACES
+    from cherubim.timestamp_log import read_timestamps
+    from cherubim.raw_container import RawRecording, read_header
+    from cherubim import chunked_container
+except ModuleNotFoundError:
+    from generic_camera_interface import GenericCameraInterface
+    from demosaic import DemosaicStage, bin_2x2
+    from frame_buffer import frame_shape
+    from mjpeg_index import MJPEGReader, index_filename, rebuild_index, JPEG_COLORSPACES
+    from timestamp_log import read_timestamps
+    from raw_container import RawRecording, read_header
+    import chunked_container
+
+def check_camera(config):
+    """Returns (width, height) of the frames the Synthetic/Replay interface will produce.
+
+    For a .raw or .zraw file with a header, config's Mode is set to the recording's. For
+    a .mjpeg file, it is set to Mono8 for grayscale JPEGs and, unless config's Mode is
+    already a color mode, to RGB8 for color ones.
+    """
+    if config.get('Interface') == 'Replay':
+        filename = config['ReplayFile']
+        if not os.path.exists(filename):
+            print('Replay file {} not found.'.format(filename))
+            return None
+        if os.path.splitext(filename)[1] == '.mjpeg':
+            import simplejpeg
+            with open(filename, 'rb') as f:
+                height, width, colorspace, _ = simplejpeg.decode_jpeg_header(f.read(1 << 16))
+            mode = config.get('Mode', 'Mono8')
+            if colorspace == 'Gray':
+                mode = 'Mono8'
+            elif mode == 'Mono8': # color JPEGs don't say whether frames were RGB8 or demosaiced
+                mode = 'RGB8'
+            if config.get('Mode', 'Mono8') != mode:
+                print('{} was recorded in {} mode - replaying it as such.'.format(filename, mode))
+            config['Mode'] = mode
+            return (width, height)
+        header = chunked_container.read_header(filename) or read_header(filename)
+        if header is not None:
+            mode = header.get('mode', None) or ('Mono8' if header['shape'][2] == 1 else 'RGB8')
+            if config.get('Mode', 'Mono8') != mode:
+                print('{} was recorded in {} mode - replaying it as such.'.format(filename, mode))
+            config['Mode'] = mode
+            return (header['shape'][1], header['shape'][0])
+    return (config['ResX'], config['ResY']) # Synthetic frames and headerless raw files follow the config
+
+
+class SyntheticCameraInterface(GenericCameraInterface):
+    """Generates a moving test pattern at any resolution, mode and frame rate.
+
+    Mono8 and RGB8 frames are published directly. Bayer_RG8 frames are generated as
+    raw mosaics and go through the same DemosaicStage as a GigE camera. With
+    ReplayRate: 'max' frames are produced as fast as the pipeline accepts them, so
+    the reported rate is the maximum sustainable frame rate.
+    """
+    _raw_bayer = True # frames need demosaicing in Bayer_RG8 mode
+
+    def __init__(self, config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                 preview_buffer=None, journal=None, metrics=None, health=None):
+        super().__init__(config, display_queue, write_queue, stop_signal, write_queue_signal, frame_buffer,
+                         preview_buffer, journal, metrics, health)
+
+        self.sy = config['ResY']
+        self.sx = config['ResX']
+        self.mode = config.get('Mode', 'Mono8')
+        if self.mode not in JPEG_COLORSPACES:
+            raise ValueError('Unsupported video mode. ({})'.format(self.mode))
+        self.frame_rate = config.get('FrameRate', 30)
+        self._free_run = (config.get('ReplayRate', None) == 'max')
+
+        self._demosaic = None
+        if self.mode == 'Bayer_RG8' and self._raw_bayer:
+            num_threads = config.get('DemosaicThreads', 2)
+            self._demosaic = DemosaicStage(frame_shape(config), # half size for 'superpixel'
+                                           algorithm=config.get('Demosaic', 'bilinear'),
+                                           num_threads=num_threads,
+                                           latency=self.metrics.histogram('demosaic') if self.metrics else None)
+        self._demosaiced_frame = None
+        self._binned = None # SoftwareBinning: 2 halves Mono8 frames as a GigE camera would
+        if self.mode == 'Mono8' and frame_shape(config)[0] < self.sy:
+            self._binned = np.empty(frame_shape(config), np.uint8)
+
+        self._open_source(config)
+
+        self._next_frame_time = None
+        self._frames_published = 0
+        self._frames_late = 0 # frames a real camera would have dropped
+        self._report_time = time.monotonic()
+        self._report_frames = 0
+
+    def _open_source(self, config):
+        self._frames = self._make_frames(config.get('SyntheticFrames', 16))
+        self._frame_index = 0
+
+    def _make_frames(self, num_frames):
+        yy, xx = np.mgrid[0:self.sy, 0:self.sx].astype(np.float32)
+        rng = np.random.default_rng(0)
+        radius = min(self.sx, self.sy) / 8
+        frames = []
+        for i in range(num_frames):
+            phase = 2 * np.pi * i / num_frames
+            cx, cy = self.sx * (0.5 + 0.3 * np.cos(phase)), self.sy * (0.5 + 0.3 * np.sin(phase))
+            blob = np.exp(-((xx - cx)**2 + (yy - cy)**2) / (2 * radius**2))
+            img = 60 * xx / self.sx + 40 * yy / self.sy + 150 * blob + rng.normal(0, 4, blob.shape)
+            img = np.clip(img, 0, 255).astype(np.uint8)
+            if self.mode == 'Mono8':
+                frames.append(img.reshape(self.sy, self.sx, 1))
+            elif self.mode == 'RGB8':
+                frames.append(np.stack([img, img // 2 + 64, 255 - img], axis=2))
+            else: # RGGB mosaic
+                raw = img.copy()
+                raw[0::2, 0::2] //= 2
+                raw[1::2, 1::2] = 255 - raw[1::2, 1::2]
+                frames.append(raw)
+        return frames
+
+    def _next_frame(self):
+        """Returns (frame, seconds until the frame after it is due), or (None, 0) at the end."""
+        frame = self._frames[self._frame_index]
+        self._frame_index = (self._frame_index + 1) % len(self._frames)
+        return frame, 1 / self.frame_rate
+
+    def _wait_until_due(self, period):
+        now = time.monotonic()
+        if self._free_run or self._next_frame_time is None:
+            self._next_frame_time = now
+        elif self._next_frame_time > now:
+            time.sleep(self._next_frame_time - now)
+        elif now - self._next_frame_time > period: # we fell behind - a real camera would drop
+            self._frames_late += 1
+            self._next_frame_time = now
+        self._next_frame_time += period
+
+    def start_acquisition(self):
+        print('Acquisiton')
+        return
+
+    def stop_acquisition(self):
+        if self._demosaic is not None:
+            self._demosaic.shutdown()
+        print('{} frames published, {} late'.format(self._frames_published, self._frames_late))
+        return
+
+    def get_frame(self):
+        while not self._stop_signal.value:
+            if self._demosaic is not None:
+                converted = self._demosaic.pop(timeout=None if self._demosaic.full() else 0)
+                if converted is not None:
+                    self._demosaiced_frame, self.current_frame_timestamp = converted
+                    self.current_frame_data = self._demosaiced_frame
+                    return True
+
+            frame, period = self._next_frame()
+            if frame is None:
+                return False
+            self._wait_until_due(period)
+            timestamp = time.monotonic_ns()
+
+            if self._demosaic is not None:
+                self._demosaic.submit(frame, timestamp)
+            else:
+                self.current_frame_data = frame if self._binned is None else bin_2x2(frame, self._binned)
+                self.current_frame_timestamp = timestamp
+                return True
+
+        return False
+
+    def post_queue(self):
+        if self._demosaiced_frame is not None:
+            self._demosaic.release(self._demosaiced_frame)
+            self._demosaiced_frame = None
+
+        self._frames_published += 1
+        self._report_frames += 1
+        now = time.monotonic()
+        if now - self._report_time >= 5:
+            print('Camera rate: {:.1f} fps ({} late)'.format(
+                self._report_frames / (now - self._report_time), self._frames_late))
+            self._report_time = now
+            self._report_frames = 0
+        return
+
+
+class ReplayCameraInterface(SyntheticCameraInterface):
+    """Replays a .mjpeg, .raw or .zraw recording made by VideoWriter.
+
+    ReplayRate: 'recorded' (default) reproduces the recorded frame intervals, 'max'
+    replays as fast as possible and anything else uses FrameRate. Set ReplayLoop to
+    False to stop at the end of the file.
+    """
+    _raw_bayer = False # recordings hold frames that were already converted
+
+    def _open_source(self, config):
+        filename = config['ReplayFile']
+        self._loop = config.get('ReplayLoop', True)
+        self._use_recorded_rate = (config.get('ReplayRate', 'recorded') == 'recorded')
+        self._frame_index = 0
+
+        if os.path.splitext(filename)[1] == '.mjpeg':
+            if not os.path.exists(index_filename(filename)):
+                print('Indexing {}'.format(filename))
+                rebuild_index(filename)
+            self._reader = MJPEGReader(filename)
+            self._colorspace = JPEG_COLORSPACES[self.mode]
+            self._num_frames = len(self._reader)
+            timestamps = self._reader.timestamps
+        else:
+            self._reader = None
+            if os.path.splitext(filename)[1] == '.zraw':
+                self._frames = chunked_container.ChunkedRecording(filename)
+            else:
+                self._frames = RawRecording(filename, shape=frame_shape(config)).frames # shape for headerless files
+            self._num_frames = len(self._frames)
+            recorded = read_timestamps(filename)
+            timestamps = recorded['camera_timestamp'] if recorded is not None else np.zeros(0)
+
+        if self._num_frames == 0:
+            raise ValueError('No frames found in {}'.format(filename))
+        if self._use_recorded_rate and len(timestamps) >= self._num_frames and self._num_frames > 1:
+            self._periods = np.diff(timestamps[:self._num_frames]) / 1e9
+            self._periods = np.append(self._periods, np.median(self._periods)) # wrap around
+        else:
+            if self._use_recorded_rate:
+                print('No recorded timestamps - replaying at FrameRate.')
+            self._periods = np.full(self._num_frames, 1 / self.frame_rate)
+        print('Replaying {} frames from {}'.format(self._num_frames, filename))
+
+    def _next_frame(self):
+        if self._frame_index >= self._num_frames:
+            if not self._loop:
+                return None, 0
+            self._frame_index = 0
+
+        n = self._frame_index
+        self._frame_index += 1
+        if self._reader is not None:
+            frame = self._reader.read_frame(n, colorspace=self._colorspace)
+        else:
+            frame = self._frames[n]
+        return frame, self._periods[n]
+
+    def stop_acquisition(self):
+        super().stop_acquisition()
+        if self._reader is not None:
+            self._reader.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Per-frame timestamp logs.
+
+VideoWriter logs every frame it writes, either as the original two column
+<name>_timestamps.csv (camera timestamp, host CLOCK_MONOTONIC ns when written) or
+as a binary <name>_timestamps.bin (TimestampFormat: 'binary' or 'both'). Only the
+binary log has the camera's frame numbers (camera_frame), so it is also written for streams that skip frames
+(MotionThreshold, FrameDecimation) when TimestampFormat is 'csv'.
+
+The binary log is a HEADER_SIZE byte header followed by fixed-size records. The
+header stores the record layout, which can have fields after the TIMESTAMP_DTYPE
+ones (e.g., hardware_timestamp for GigE cameras), so load a session with
+load_timestamps(filename) rather than with TIMESTAMP_DTYPE.
+"""
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+try:
+    from cherubim.segments import manifest_filename, segment_filename, read_manifest
+except ModuleNotFoundError:
+    from segments import manifest_filename, segment_filename, read_manifest
+
+TIMESTAMP_MAGIC = b'CHRBTS01'
+HEADER_SIZE = 512
+# frame_index counts the frames written to the log's file; camera_frame is the camera's
+# frame number (its ring sequence number), which has gaps where frames weren't recorded
+TIMESTAMP_DTYPE = np.dtype([('frame_index', '<i8'), ('camera_frame', '<i8'), ('camera_timestamp', '<i8'),
+                            ('host_timestamp', '<i8'), ('encoded_size', '<u4')])
+
+
+def timestamp_dtype(extra_fields=()):
+    return np.dtype(TIMESTAMP_DTYPE.descr + list(extra_fields))
+
+
+class BinaryTimestampLog():
+    """Collects per-frame records in a preallocated block and appends full blocks to disk."""
+    def __init__(self, filename, extra_fields=(), block_size=1024):
+        self.dtype = timestamp_dtype(extra_fields)
+        description = json.dumps({'dtype': self.dtype.descr}).encode()
+        header = TIMESTAMP_MAGIC + struct.pack('<I', len(description)) + description
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Too many timestamp fields.')
+        self._file = open(filename, 'wb')
+        self._file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self._records = np.zeros(block_size, dtype=self.dtype)
+        self._count = 0
+
+    def log(self, frame_index, camera_frame, camera_timestamp, host_timestamp, encoded_size, **extra):
+        record = self._records[self._count]
+        record['frame_index'] = frame_index
+        record['camera_frame'] = camera_frame
+        record['camera_timestamp'] = camera_timestamp
+        record['host_timestamp'] = host_timestamp
+        record['encoded_size'] = encoded_size
+        for field, value in extra.items():
+            record[field] = value
+        self._count += 1
+        if self._count == len(self._records):
+            self.flush()
+
+    def flush(self):
+        self._records[:self._count].tofile(self._file)
+        self._file.flush()
+        self._count = 0
+
+    def close(self):
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+class CSVTimestampLog():
+    """The original text log: one 'camera timestamp, host timestamp[, extra...]' row per frame.
+
+    With extra fields, the first line is a comment naming the columns (and the extra
+    fields' dtypes), e.g. '#camera_timestamp,host_timestamp,hardware_timestamp:<i8'.
+    """
+    def __init__(self, filename, extra_fields=()):
+        self._file = open(filename, 'w')
+        self._writer = csv.writer(self._file, delimiter=',')
+        self._extra_fields = [field[0] for field in extra_fields]
+        if extra_fields:
+            self._file.write('#' + ','.join(['camera_timestamp', 'host_timestamp']
+                                            + ['{}:{}'.format(*field) for field in extra_fields]) + '\n')
+
+    def log(self, frame_index, camera_frame, camera_timestamp, host_timestamp, encoded_size, **extra):
+        self._writer.writerow([camera_timestamp, host_timestamp] + [extra[f] for f in self._extra_fields])
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def skips_frames(config):
+    """True if a writer config records only some of the camera's frames (MotionThreshold or
+    FrameDecimation), so the frame numbers have to be logged to tell which ones."""
+    return config.get('MotionThreshold', None) is not None or int(config.get('FrameDecimation', 1)) > 1
+
+
+def timestamp_format(config):
+    """TimestampFormat of a writer config. The CSV log has no frame numbers, so streams
+    that skip frames get the binary log as well."""
+    configured = config.get('TimestampFormat', 'csv')
+    if configured == 'csv' and skips_frames(config):
+        return 'both'
+    return configured
+
+
+class TimestampLogs():
+    """Fans each frame out to the logs selected by TimestampFormat ('csv', 'binary' or 'both')."""
+    def __init__(self, base_filename, timestamp_format='csv', extra_fields=()):
+        if timestamp_format not in ['csv', 'binary', 'both']:
+            raise ValueError('Unsupported TimestampFormat. ({})'.format(timestamp_format))
+        self._logs = []
+        if timestamp_format in ['csv', 'both']:
+            self._logs.append(CSVTimestampLog('{}_timestamps.csv'.format(base_filename), extra_fields))
+        if timestamp_format in ['binary', 'both']:
+            self._logs.append(BinaryTimestampLog('{}_timestamps.bin'.format(base_filename), extra_fields))
+
+    def log(self, frame_index, camera_frame, camera_timestamp, encoded_size, **extra):
+        """Logs a frame as written now; returns the host timestamp used."""
+        host_timestamp = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        for timestamp_log in self._logs:
+            timestamp_log.log(frame_index, camera_frame, camera_timestamp, host_timestamp, encoded_size, **extra)
+        return host_timestamp
+
+    def close(self):
+        for timestamp_log in self._logs:
+            timestamp_log.close()
+        self._logs = []
+
+
+def load_timestamps(filename):
+    """Load a binary timestamp log as a structured array."""
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(TIMESTAMP_MAGIC)] != TIMESTAMP_MAGIC:
+        raise ValueError('{} is not a cherubim timestamp log.'.format(filename))
+    (length,) = struct.unpack_from('<I', header, len(TIMESTAMP_MAGIC))
+    start = len(TIMESTAMP_MAGIC) + 4
+    descr = [tuple(field) for field in json.loads(header[start:start + length])['dtype']]
+    timestamps = np.fromfile(filename, dtype=np.dtype(descr), offset=HEADER_SIZE)
+    if 'camera_frame' in timestamps.dtype.names:
+        return timestamps
+    # Older logs kept the camera's frame number in frame_index
+    upgraded = np.zeros(len(timestamps), timestamp_dtype(field for field in descr
+                                                         if field[0] not in TIMESTAMP_DTYPE.names))
+    for name in timestamps.dtype.names:
+        upgraded[name] = timestamps[name]
+    upgraded['camera_frame'] = timestamps['frame_index']
+    upgraded['frame_index'] = np.arange(len(timestamps))
+    return upgraded
+
+
+def read_timestamps_csv(filename):
+    """A _timestamps.csv file as a structured array with the TIMESTAMP_DTYPE fields and
+    any extra fields named in its first line. frame_index is the row, camera_frame is
+    -1 and encoded_size is 0 (the CSV log doesn't have them)."""
+    to_ns = lambda value: int(float(value) * 1e9) if '.' in value else int(value) # old WebCam files used seconds
+    with open(filename, 'r') as f:
+        rows = [row for row in csv.reader(f) if row]
+    extra_fields = []
+    if rows and rows[0][0].startswith('#'):
+        extra_fields = [tuple(column.split(':')) for column in rows.pop(0)[2:]]
+    timestamps = np.zeros(len(rows), dtype=timestamp_dtype(extra_fields))
+    timestamps['frame_index'] = np.arange(len(rows))
+    timestamps['camera_frame'] = -1
+    for column, (name, _) in enumerate(extra_fields, 2):
+        timestamps[name] = [int(row[column]) for row in rows]
+    if rows:
+        timestamps['camera_timestamp'] = [to_ns(row[0]) for row in rows]
+        timestamps['host_timestamp'] = [to_ns(row[1]) for row in rows]
+    return timestamps
+
+
+def read_timestamps(filename):
+    """Timestamps as a structured array with (at least) the TIMESTAMP_DTYPE fields.
+
+    filename is a _timestamps.bin or _timestamps.csv log, or a recording (or its base
+    name), in which case whichever of its logs exists is read - for a segmented
+    recording, those of all its segments. Returns None if there is none. frame_index
+    counts the frames written (over all segments). CSV logs don't have camera_frame or
+    encoded_size, which are -1 and 0 for their frames (see read_timestamps_csv()).
+    """
+    if not filename.endswith(('_timestamps.bin', '_timestamps.csv')):
+        base_filename = filename
+        if filename.endswith(('.mjpeg', '.raw', '.zraw', '.mkv')):
+            base_filename = os.path.splitext(filename)[0]
+        filename = '{}_timestamps.bin'.format(base_filename)
+        if not os.path.exists(filename):
+            filename = '{}_timestamps.csv'.format(base_filename)
+        if not os.path.exists(filename) and os.path.exists(manifest_filename(base_filename)):
+            return _read_segment_timestamps(base_filename)
+    if not os.path.exists(filename):
+        return None
+    if filename.endswith('.bin'):
+        return load_timestamps(filename)
+    return read_timestamps_csv(filename)
+
+
+def _read_segment_timestamps(base_filename):
+    parts = []
+    for segment in read_manifest(base_filename):
+        segment_base = segment_filename(base_filename, segment['segment'])
+        timestamps = read_timestamps(segment_base)
+        if timestamps is None:
+            continue
+        timestamps['frame_index'] += segment['first_frame'] # logs are numbered per segment
+        parts.append(timestamps)
+    return np.concatenate(parts) if parts else None
+
+
+def export_csv(filename, out_filename, all_fields=False):
+    """Write a binary log as CSV: the original two columns, or every field with a header row."""
+    timestamps = load_timestamps(filename)
+    fields = list(timestamps.dtype.names) if all_fields else ['camera_timestamp', 'host_timestamp']
+    np.savetxt(out_filename, np.column_stack([timestamps[f] for f in fields]), fmt='%d', delimiter=',',
+               header=','.join(fields) if all_fields else '', comments='')
+    return len(timestamps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export cherubim binary timestamp logs to CSV.')
+    parser.add_argument('logs', nargs='+', help='_timestamps.bin files')
+    parser.add_argument('--all-fields', action='store_true',
+                        help='write every field with a header row (default: the two column _timestamps.csv format)')
+    args = parser.parse_args()
+
+    for filename in args.logs:
+        if not os.path.exists(filename):
+            print('{} not found.'.format(filename))
+            sys.exit(1)
+        out_filename = '{}.csv'.format(os.path.splitext(filename)[0])
+        count = export_csv(filename, out_filename, args.all_fields)
+        print('{}: {} frames written to {}'.format(filename, count, out_filename))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Offline transcoding of recordings to H.264 MP4 files (cherubim-transcode).
+
+    cherubim-transcode session.mjpeg session_cam2.raw --workers 64
+
+A recording (.mjpeg, .raw or .zraw, or the base name of a segmented recording) is
+split into pieces of --piece-frames frames, which are decoded and encoded by ffmpeg
+(one single-threaded libx264 per piece by default) on a pool of worker processes,
+so every core is busy. Each piece starts with a keyframe, and the pieces are stitched
+into <name>.mp4 by ffmpeg without re-encoding. The frame times are then set from the
+recording's timestamp log (camera timestamps), so dropped, decimated or motion-gated
+frames keep their real times (variable frame rate). Frames are encoded without
+B-frames, so presentation order is decode order and only the sample durations of the
+MP4 need rewriting.
+
+Finished pieces are kept in <name>.mp4.pieces until the MP4 is complete, so an
+interrupted run picks up where it stopped when started again with the same options.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+import numpy as np
+import yaml
+
+try:
+    from cherubim.batch_reader import recording_files, open_video, video_info
+    from cherubim.ffmpeg_writer import FFmpegWriter
+    from cherubim.mjpeg_index import MJPEGReader, JPEG_COLORSPACES
+    from cherubim.timestamp_log import read_timestamps
+except ModuleNotFoundError:
+    from batch_reader import recording_files, open_video, video_info
+    from ffmpeg_writer import FFmpegWriter
+    from mjpeg_index import MJPEGReader, JPEG_COLORSPACES
+    from timestamp_log import read_timestamps
+
+MP4_TIMESCALE = 90000 # ticks per second of the video track
+
+
+def _encode_piece(piece):
+    """Encode frames [start, stop) of a video file into piece['filename'] (worker process)."""
+    begin = time.monotonic()
+    partial = piece['filename'] + '.partial.mkv'
+    writer = FFmpegWriter(partial, piece['shape'], piece['mode'], 'h264', piece['frame_rate'],
+                          threads=piece['threads'], preset=piece['preset'], crf=piece['crf'],
+                          ffmpeg=piece['ffmpeg'], output_arguments=['-bf', '0'])
+    video = open_video(piece['source'])
+    try:
+        if isinstance(video, MJPEGReader):
+            import simplejpeg
+            colorspace = JPEG_COLORSPACES[piece['mode']]
+            for n in range(piece['start'], piece['stop']):
+                writer.write(simplejpeg.decode_jpeg(video.read_jpeg(n), colorspace=colorspace))
+        else:
+            for n in range(piece['start'], piece['stop']):
+                writer.write(video[n])
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        if hasattr(video, 'close'):
+            video.close()
+    if writer.close() != 0:
+        raise RuntimeError('ffmpeg failed on frames {}-{} of {}.'.format(piece['start'], piece['stop'] - 1,
+                                                                          piece['source']))
+    os.replace(partial, piece['filename']) # only complete pieces are ever skipped on resume
+    return piece, time.monotonic() - begin
+
+
+class Transcode():
+    """The pieces of one recording and how to put them back together."""
+    def __init__(self, recording, args):
+        self.base, self.files = recording_files(recording)
+        directory = args.output_dir or os.path.dirname(self.base)
+        self.output = os.path.join(directory, os.path.basename(self.base) + '.mp4')
+        self.piece_directory = self.output + '.pieces'
+        self._ffmpeg = args.ffmpeg
+
+        self.timestamps = read_timestamps(self.base)
+        files = [(filename,) + video_info(filename) for filename in self.files]
+        self.num_frames = sum(count for _, count, _, _ in files)
+        self.frame_rate = args.frame_rate or self._nominal_frame_rate() or 30
+        self.pieces = []
+        for filename, count, shape, mode in files: # pieces never span segments
+            for start in range(0, count, args.piece_frames):
+                self.pieces.append({'source': filename, 'start': start, 'stop': min(start + args.piece_frames, count),
+                                    'shape': shape, 'mode': mode, 'frame_rate': self.frame_rate,
+                                    'threads': args.encoder_threads, 'preset': args.preset, 'crf': args.crf,
+                                    'ffmpeg': args.ffmpeg, 'output': self.output,
+                                    'filename': os.path.join(self.piece_directory,
+                                                             'piece_{:05d}.mkv'.format(len(self.pieces)))})
+        self._job = {'Files': self.files, 'Frames': self.num_frames, 'PieceFrames': args.piece_frames,
+                     'Preset': args.preset, 'CRF': args.crf, 'FrameRate': self.frame_rate}
+
+    def _nominal_frame_rate(self):
+        if self.timestamps is None or len(self.timestamps) < 2:
+            return None
+        intervals = np.diff(self.timestamps['camera_timestamp'])
+        intervals = intervals[intervals > 0]
+        return round(1e9 / float(np.median(intervals)), 3) if len(intervals) else None
+
+    def todo(self):
+        """Pieces still to encode (those finished by an earlier run with the same options are kept)."""
+        job_filename = os.path.join(self.piece_directory, 'job.yaml')
+        if os.path.exists(job_filename):
+            with open(job_filename, 'r') as f:
+                if yaml.safe_load(f) != self._job:
+                    print('{}: options or recording changed - starting over.'.format(self.output))
+                    shutil.rmtree(self.piece_directory)
+        if not os.path.exists(job_filename):
+            os.makedirs(self.piece_directory, exist_ok=True)
+            with open(job_filename, 'w') as f:
+                yaml.safe_dump(self._job, f, sort_keys=False)
+        return [piece for piece in self.pieces if not os.path.exists(piece['filename'])]
+
+    def stitch(self, keep_pieces=False):
+        """Concatenate the pieces (no re-encoding) and set the frame times."""
+        concat_filename = os.path.join(self.piece_directory, 'pieces.txt')
+        with open(concat_filename, 'w') as f:
+            f.writelines("file '{}'\n".format(os.path.basename(piece['filename'])) for piece in self.pieces)
+        partial = self.output + '.partial.mp4'
+        subprocess.run([self._ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0',
+                        '-i', concat_filename, '-c', 'copy', '-video_track_timescale', str(MP4_TIMESCALE),
+                        partial], check=True)
+
+        times = self.timestamps['camera_timestamp'] if self.timestamps is not None else None
+        if times is None or len(times) != self.num_frames or np.any(np.diff(times) <= 0):
+            print('{}: no usable timestamps - frames are {:g} fps apart.'.format(self.output, self.frame_rate))
+        else:
+            try:
+                set_mp4_frame_times(partial, ns_to_ticks(times - times[0]))
+            except ValueError as e: # the file is left as ffmpeg wrote it
+                print('Warning: {} Frames are {:g} fps apart.'.format(e, self.frame_rate))
+        os.replace(partial, self.output)
+        if not keep_pieces:
+            shutil.rmtree(self.piece_directory)
+
+
+# MP4 boxes that only hold other boxes (on the path to the sample table)
+_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts'}
+
+
+def _boxes(data, start=0, end=None):
+    """(type, start, header size, end) of each box in data[start:end]."""
+    end = len(data) if end is None else end
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, position)
+        header = 8
+        if size == 1:
+            size, header = struct.unpack_from('>Q', data, position + 8)[0], 16
+        elif size == 0:
+            size = end - position
+        yield kind, position, header, position + size
+        position += size
+
+
+def _walk(data, start=0, end=None):
+    """Like _boxes, but also yields the boxes inside _CONTAINER_BOXES."""
+    for kind, box_start, header, box_end in _boxes(data, start, end):
+        yield kind, box_start, header, box_end
+        if kind in _CONTAINER_BOXES:
+            yield from _walk(data, box_start + header, box_end)
+
+
+def _box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _full_box_times(kind, body, duration):
+    """mvhd, tkhd or mdhd with a new duration (always written as version 1)."""
+    version = body[0]
+    fields = '>QQ' if version == 1 else '>II'
+    created, modified = struct.unpack_from(fields, body, 4)
+    rest = body[4 + struct.calcsize(fields):]
+    if kind == b'tkhd': # track id, reserved, duration
+        track_id = struct.unpack_from('>I', rest)[0]
+        rest = rest[8 + (8 if version == 1 else 4):]
+        middle = struct.pack('>IIQ', track_id, 0, duration)
+    else: # timescale, duration
+        timescale = struct.unpack_from('>I', rest)[0]
+        rest = rest[4 + (8 if version == 1 else 4):]
+        middle = struct.pack('>IQ', timescale, duration)
+    return _box(kind, b'\x01' + body[1:4] + struct.pack('>QQ', created, modified) + middle + rest)
+
+
+def ns_to_ticks(ns):
+    """Times in ns as MP4_TIMESCALE ticks (divided first, so long recordings don't overflow int64)."""
+    return ns // 10**9 * MP4_TIMESCALE + ns % 10**9 * MP4_TIMESCALE // 10**9
+
+
+def set_mp4_frame_times(filename, times):
+    """Give the frames of a single video track MP4 (moov after mdat, as ffmpeg writes it,
+    and no B-frames) the presentation times times (in the track's timescale).
+
+    Raises ValueError, without changing the file, if it can't: e.g., if there isn't a
+    time for every sample (stsz) of the track.
+    """
+    with open(filename, 'r+b') as f:
+        position, size = 0, os.fstat(f.fileno()).st_size
+        moov = None
+        while position < size: # find moov without reading mdat
+            f.seek(position)
+            header = f.read(16)
+            box_size, kind = struct.unpack_from('>I4s', header)
+            if box_size == 1:
+                box_size = struct.unpack_from('>Q', header, 8)[0]
+            elif box_size == 0:
+                box_size = size - position
+            if kind == b'moov':
+                moov = position
+                if position + box_size != size:
+                    raise ValueError('{}: moov must be the last box.'.format(filename))
+            position += box_size
+        if moov is None:
+            raise ValueError('{} has no moov box.'.format(filename))
+        f.seek(moov)
+        data = f.read()
+        sample_counts = [struct.unpack_from('>I', data, start + header + 8)[0]
+                         for kind, start, header, _ in _walk(data) if kind == b'stsz']
+        if len(sample_counts) != 1:
+            raise ValueError('{} has {} tracks - frame times were not set.'.format(filename, len(sample_counts)))
+        if sample_counts[0] != len(times):
+            raise ValueError('{} has {} frames but {} frame times - frame times were not set.'.format(
+                filename, sample_counts[0], len(times)))
+
+        durations = np.append(np.diff(times), int(np.median(np.diff(times))) if len(times) > 1 else 1)
+        if durations.min() < 0 or durations.max() > 0xFFFFFFFF: # stts durations are 32 bit
+            raise ValueError('{}: frame durations out of range - frame times were not set.'.format(filename))
+        starts = np.flatnonzero(np.diff(durations, prepend=-1)) # runs of equal durations
+        counts = np.diff(np.append(starts, len(durations)))
+        stts = np.empty((len(starts), 2), '>u4')
+        stts[:, 0], stts[:, 1] = counts, durations[starts]
+        media_duration = int(durations.sum())
+        timescales = {}
+
+        def rebuild(kind, start, header, end):
+            body = data[start + header:end]
+            if kind in _CONTAINER_BOXES:
+                return _box(kind, b''.join(rebuild(*child) for child in _boxes(data, start + header, end)))
+            if kind == b'ctts':
+                raise ValueError('{} has B-frames - frame times were not set.'.format(filename))
+            if kind == b'stts':
+                return _box(kind, struct.pack('>II', 0, len(stts)) + stts.tobytes())
+            if kind in [b'mvhd', b'mdhd']:
+                offset = 4 + (16 if body[0] == 1 else 8)
+                timescales[kind] = struct.unpack_from('>I', body, offset)[0]
+            if kind == b'mdhd':
+                return _full_box_times(kind, body, media_duration)
+            if kind in [b'mvhd', b'tkhd']: # in the movie's timescale
+                movie_duration = media_duration * timescales[b'mvhd'] // MP4_TIMESCALE
+                return _full_box_times(kind, body, movie_duration)
+            if kind == b'elst': # one edit covering the whole track
+                movie_duration = media_duration * timescales[b'mvhd'] // MP4_TIMESCALE
+                return _box(kind, struct.pack('>IIQqHH', 1 << 24, 1, movie_duration, 0, 1, 0))
+            return data[start:end]
+
+        new_moov = b''.join(rebuild(*box) for box in _boxes(data))
+        f.seek(moov)
+        f.write(new_moov)
+        f.truncate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Transcode cherubim recordings to H.264 MP4 files on all cores.')
+    parser.add_argument('recordings', nargs='+',
+                        help='.mjpeg, .raw or .zraw files, or base names of segmented recordings')
+    parser.add_argument('--output-dir', default=None, help='Where to put the MP4 files (default: next to each recording)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Pieces encoded at once (default: all cores)')
+    parser.add_argument('--encoder-threads', type=int, default=1, help='libx264 threads per piece (default 1)')
+    parser.add_argument('--piece-frames', type=int, default=2000, help='Frames per piece (default 2000)')
+    parser.add_argument('--preset', default='medium', help='libx264 preset (default medium)')
+    parser.add_argument('--crf', type=int, default=20, help='libx264 CRF (default 20)')
+    parser.add_argument('--frame-rate', type=float, default=None,
+                        help='Nominal frame rate (default: from the timestamps, else 30)')
+    parser.add_argument('--keep-pieces', action='store_true', help="Don't delete the pieces afterwards")
+    parser.add_argument('--ffmpeg', default='ffmpeg', help='ffmpeg executable')
+    args = parser.parse_args()
+
+    if shutil.which(args.ffmpeg) is None:
+        print('[{}] was not found.'.format(args.ffmpeg))
+        sys.exit(1)
+    transcodes = []
+    for recording in args.recordings:
+        transcode = Transcode(recording, args)
+        if os.path.exists(transcode.output):
+            print('{} exists - skipping.'.format(transcode.output))
+        elif transcode.num_frames == 0:
+            print('{} has no frames - skipping.'.format(recording))
+        else:
+            transcodes.append(transcode)
+
+    # Pieces of every recording share one pool; a recording is stitched as soon as its last piece is done
+    remaining = {}
+    todo = []
+    for transcode in transcodes:
+        pieces = transcode.todo()
+        remaining[transcode.output] = len(pieces)
+        todo += pieces
+        print('{}: {} frames in {} pieces ({} done before).'.format(
+            transcode.output, transcode.num_frames, len(transcode.pieces), len(transcode.pieces) - len(pieces)))
+    by_output = {transcode.output: transcode for transcode in transcodes}
+    for transcode in transcodes:
+        if remaining[transcode.output] == 0:
+            transcode.stitch(args.keep_pieces)
+
+    begin = time.monotonic()
+    with multiprocessing.Pool(args.workers) as pool:
+        for done, (piece, seconds) in enumerate(pool.imap_unordered(_encode_piece, todo), start=1):
+            output = piece['output']
+            print('[{}/{}] {} frames {}-{} ({:.1f} fps)'.format(done, len(todo), piece['source'], piece['start'],
+                  piece['stop'] - 1, (piece['stop'] - piece['start']) / seconds))
+            remaining[output] -= 1
+            if remaining[output] == 0:
+                by_output[output].stitch(args.keep_pieces)
+                print('Wrote {}.'.format(output))
+    if todo:
+        frames = sum(piece['stop'] - piece['start'] for piece in todo)
+        print('{} frames in {:.1f} s ({:.1f} fps).'.format(frames, time.monotonic() - begin,
+                                                           frames / (time.monotonic() - begin)))
+
+
+if __name__ == "__main__":
+    main()
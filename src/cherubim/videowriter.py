@@ -1,88 +1,421 @@
 from multiprocessing.sharedctypes import Value
 import os, setproctitle, time
+import yaml
 
 # import skvideo.io # scikit-video
 import simplejpeg
 
 import multiprocessing
 import queue
-import csv
+import collections
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from cherubim.frame_buffer import SharedFrameBuffer
+    from cherubim.mjpeg_index import MJPEGIndexWriter, index_filename, jpeg_encode_kwargs, JPEG_COLORSPACES
+    from cherubim.raw_container import RawContainerWriter
+    from cherubim.timestamp_log import TimestampLogs, timestamp_format
+    from cherubim.journal import JournalFrame
+    from cherubim.pretrigger import EncodedFrame
+    from cherubim.ffmpeg_writer import FFmpegWriter, FFMPEG_CODECS
+    from cherubim.chunked_container import ChunkedContainerWriter, LOSSLESS_CODECS, chunk_index_filename
+    from cherubim.segments import SegmentManifest, manifest_filename, segment_filename
+    from cherubim.metrics import ProcessMetrics
+    from cherubim.streams import stream_shape, stream_converter
+    from cherubim.quality_control import QualityController
+except ModuleNotFoundError:
+    from frame_buffer import SharedFrameBuffer
+    from mjpeg_index import MJPEGIndexWriter, index_filename, jpeg_encode_kwargs, JPEG_COLORSPACES
+    from raw_container import RawContainerWriter
+    from timestamp_log import TimestampLogs, timestamp_format
+    from journal import JournalFrame
+    from pretrigger import EncodedFrame
+    from ffmpeg_writer import FFmpegWriter, FFMPEG_CODECS
+    from chunked_container import ChunkedContainerWriter, LOSSLESS_CODECS, chunk_index_filename
+    from segments import SegmentManifest, manifest_filename, segment_filename
+    from metrics import ProcessMetrics
+    from streams import stream_shape, stream_converter
+    from quality_control import QualityController
+
+class _Segment():
+    """Video file, frame index and timestamp logs of one segment of a recording."""
+    def __init__(self, number, video_filename, writer, write, timestamps, index=None, truncate=False,
+                 filenames=()):
+        self.number = number
+        self.video_filename = video_filename
+        self.writer = writer
+        self.write = write # frame -> bytes written
+        self.timestamps = timestamps
+        self.index = index
+        self.filenames = [video_filename] + list(filenames) # everything created for the segment
+        self._truncate = truncate # file was preallocated
+        self.frames = 0
+        self.nbytes = 0
+        self.first_frame = self.first_timestamp = self.last_timestamp = None
+
+    def log(self, frame_number, seq, timestamp, nbytes, **extra):
+        write_timestamp = self.timestamps.log(self.frames, seq, timestamp, nbytes, **extra)
+        if self.index:
+            self.index.append(nbytes, timestamp, write_timestamp)
+        if self.frames == 0:
+            self.first_frame, self.first_timestamp = frame_number, timestamp
+        self.last_timestamp = timestamp
+        self.frames += 1
+        self.nbytes += nbytes
+
+    def size(self):
+        """Bytes written so far (read from the file for encoders that don't report them)."""
+        return self.nbytes or os.path.getsize(self.video_filename)
+
+    def close(self):
+        if self.writer:
+            if self._truncate:
+                self.writer.truncate() # drop unused preallocation
+            self.writer.close()
+            self.writer = None
+        if self.timestamps:
+            self.timestamps.close()
+            self.timestamps = None
+        if self.index:
+            self.index.close()
+            self.index = None
+
+    def discard(self):
+        """Close and delete a segment that was opened ahead but never used."""
+        if isinstance(self.writer, FFmpegWriter):
+            self.writer.abort()
+        self.close()
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
 
 class VideoWriter():
-    def __init__(self, config, frame_queue, done_signal, filename):
+    def __init__(self, config, frame_queue, done_signal, filename, frame_buffer, journal=None, metrics=None,
+                 health=None):
         self._done_signal = done_signal
 
         self._frame_queue = frame_queue
+        self._frame_buffer = frame_buffer
+        # With Streams, this writer is one of several readers of the ring, and records a
+        # crop (or a grayscale version) of the frames - see streams.py
+        self._reader = config.get('StreamReader', SharedFrameBuffer.WRITER_READER)
+        self._convert = stream_converter(config)
+        self._convert_journal = stream_converter(config, crop=False) # journal frames are already cropped
+        self._journal = journal # frames the camera couldn't fit in the ring arrive as JournalFrames
+        self._journal_frame = np.empty(journal.shape, journal.dtype) if journal is not None else None
+        self._health = health # frames and packets the camera lost (saved in the metadata)
+        # GigE cameras' own clock is logged next to the host's (the hardware_timestamp field)
+        self._timestamp_fields = []
+        self._hardware_timestamps = config.get('Interface', 'WebCam') == 'GigE'
+        if self._hardware_timestamps:
+            self._timestamp_fields.append(('hardware_timestamp', '<i8'))
+        # 'csv' (default), 'binary' (block-written _timestamps.bin) or 'both'
+        self._timestamp_format = timestamp_format(config)
+        if self._timestamp_format != config.get('TimestampFormat', 'csv'):
+            print('Also writing binary timestamp logs, which record the frame numbers of the frames kept '
+                  '(MotionThreshold/FrameDecimation).')
+        self._frames_written = 0
+        self._encoder_workers = config.get('EncoderWorkers', 1) # > 1 encodes JPEGs in a process pool
+        self._metrics = metrics # ProcessMetrics (see metrics.py) or None
+        self._encode_ns = 0
+        self._finished_bytes = 0 # bytes in segments that have been rotated out
 
         log_directory = config.get('LogDirectory', os.getcwd())
         if not os.path.isdir(log_directory):
             raise(ValueError('VideoWriter LogDirectory [{}] not found.'.format(log_directory)))
 
-        self.sx = config['ResX'] 
-        self.sy = config['ResY']
+        self._config = config
+        self.sy, self.sx = stream_shape(config)[:2] # after any superpixel demosaic, binning or crop
         self.framerate = config.get('FrameRate', 30) # TODO: sync defaults across processes
-        mode = config.get('Mode', 'Mono8') 
+        self._camera_mode = config.get('Mode', 'Mono8')
+        self._mode = config.get('OutputMode', self._camera_mode) # of the frames written
         quality = config.get('CompressionQuality', 85)
-        self._compressed = None
-        if config.get('Compress',True):
-            self._compressed = True
-            video_filename = os.path.join(log_directory, '{}.mjpeg'.format(filename))
-            self._writer = open(video_filename, 'wb')
-            if mode == 'Mono8':
-                self.write = lambda img: self._writer.write(
-                        simplejpeg.encode_jpeg(img, quality=quality,
-                            colorspace='Gray', colorsubsampling='Gray'))
-            elif mode == 'Bayer_RG8':
-                self.write = lambda img: self._writer.write(
-                        simplejpeg.encode_jpeg(img, quality=quality,
-                        colorspace='BGR', colorsubsampling='444'))
-            elif mode == 'RGB8':
-                self.write = lambda img: self._writer.write(
-                        simplejpeg.encode_jpeg(img, quality=quality,
-                        colorspace='RGB', colorsubsampling='444'))
-            else:
-                raise ValueError('Unsupported video mode. ({})'.format(mode))
+        codec = config.get('Codec', 'mjpeg') if config.get('Compress', True) else None
+        self._codec = codec
+        self._compressed = codec is not None
+        self._quality = None # QualityController (AdaptiveQuality, see quality_control.py) or None
+        if codec == 'mjpeg':
+            self._encode_kwargs = jpeg_encode_kwargs(self._mode, quality)
+            if config.get('AdaptiveQuality', False):
+                self._quality = QualityController(config, self._mode, frame_buffer, self._reader, journal,
+                                                  self._encoder_workers)
+                self._timestamp_fields += self._quality.fields
+        elif codec is not None and codec not in FFMPEG_CODECS + LOSSLESS_CODECS:
+            raise ValueError('Unsupported Codec. ({})'.format(codec))
 
-            # self._writer = skvideo.io.FFmpegWriter(video_filename, outputdict={
-            #     #'-vcodec': 'libx264', '-b': '300000000'
-            #     # '-vcodec': 'libx264', '-crf': '27', '-preset': 'veryfast'
-            #     '-vcodec': 'mjpeg'
-            # })
+        # Recordings are split into segments after SegmentDuration seconds or SegmentSize MB.
+        # The next segment is always opened (and preallocated) ahead of time in the background,
+        # and finished segments are closed in the background, so no frame waits at a boundary.
+        self._base_filename = os.path.join(log_directory, filename)
+        self._segment_duration = config.get('SegmentDuration', None)
+        self._segment_size = config.get('SegmentSize', None)
+        self._manifest = None
+        self._background = None
+        self._next_segment = None
+        if self._segment_duration or self._segment_size:
+            self._manifest = SegmentManifest(manifest_filename(self._base_filename))
+            self._background = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            preallocate = int(self._segment_size * 1024**2) if self._segment_size else 0
+            self._segment = self._open_segment(0, preallocate)
+            self._next_segment = self._background.submit(self._open_segment, 1, preallocate)
         else:
-            self._compressed = False
-            video_filename = os.path.join(log_directory, '{}.raw'.format(filename))
-            self._writer = open(video_filename, 'wb')
-            self.write = self._writer.write
+            self._segment = self._open_segment(None)
 
-        timestamps_filename = os.path.join(log_directory, '{}_timestamps.csv'.format(filename))
-        self._ts_file = open(timestamps_filename, 'w')
-        self._ts_writer = csv.writer(self._ts_file, delimiter=',')
+        self._metadata_filename = '{}_metadata.yaml'.format(self._base_filename)
+
+        if metrics is not None:
+            metrics.gauge('writer_queue', frame_queue.qsize)
+            if codec in FFMPEG_CODECS + LOSSLESS_CODECS: # frames aren't sized one by one
+                metrics.byte_count(self._bytes_written)
+            if self._quality is not None:
+                metrics.gauge('jpeg_quality', lambda: self._quality.quality)
+
+    def _open_segment(self, number, preallocate_bytes=0):
+        """Open the files of segment number (None for an unsegmented recording)."""
+        config, mode = self._config, self._mode
+        base = self._base_filename if number is None else segment_filename(self._base_filename, number)
+        truncate = False
+        filenames = []
+        if self._codec == 'mjpeg':
+            video_filename = '{}.mjpeg'.format(base)
+            writer = open(video_filename, 'wb')
+            if preallocate_bytes and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(writer.fileno(), 0, preallocate_bytes)
+                truncate = True
+            index = MJPEGIndexWriter(index_filename(video_filename)) # offsets for random access
+            filenames.append(index_filename(video_filename))
+            write = lambda img: writer.write(self._encode(img))
+        elif self._codec in FFMPEG_CODECS: # inter-frame (h264) or lossless (ffv1) encoding in ffmpeg
+            video_filename = '{}.mkv'.format(base)
+            writer = FFmpegWriter(video_filename, stream_shape(config), mode, self._codec, self.framerate,
+                                  threads=config.get('EncoderThreads', 0),
+                                  preset=config.get('H264Preset', 'veryfast'),
+                                  crf=config.get('H264CRF', 23),
+                                  ffmpeg=config.get('FFmpegPath', 'ffmpeg'))
+            index, write = None, writer.write
+        elif self._codec in LOSSLESS_CODECS: # chunks of frames compressed on a thread pool
+            video_filename = '{}.zraw'.format(base)
+            writer = ChunkedContainerWriter(video_filename, stream_shape(config), mode=mode,
+                                            frame_rate=self.framerate, codec=self._codec,
+                                            level=config.get('CompressionLevel', 1),
+                                            chunk_frames=config.get('ChunkFrames', 16),
+                                            num_threads=config.get('EncoderThreads', 0) or 2)
+            filenames.append(chunk_index_filename(video_filename))
+            index, write = None, writer.write
+        else:
+            video_filename = '{}.raw'.format(base)
+            if config.get('RawHeader', True): # self-describing, preallocated, batched writes
+                writer = RawContainerWriter(video_filename, stream_shape(config), mode=mode,
+                                            frame_rate=self.framerate)
+                write = writer.write
+            else:
+                writer = open(video_filename, 'wb')
+                write = lambda img: writer.write(np.ascontiguousarray(img)) # crops aren't contiguous
+            index = None
+
+        timestamps = TimestampLogs(base, self._timestamp_format, self._timestamp_fields)
+        filenames += ['{}_timestamps.{}'.format(base, extension) for extension in ['csv', 'bin']]
+        return _Segment(number, video_filename, writer, write, timestamps, index, truncate, filenames)
 
     def run(self):
-        t_write = 0
         print ("Writing")
 
+        if self._codec == 'mjpeg' and self._encoder_workers > 1:
+            self._run_encoder_pool()
+        else:
+            self._run_serial()
+
+        self.close()
+
+    def _queued_slots(self):
         while True:
             queued_value = self._frame_queue.get(0.02)
 
             if queued_value is None: # our camera interface is finished
                 print('Got a None in writer')
-                break
+                return
 
-            (img, timestamp) = queued_value
-            self.write(img)
-            self._ts_writer.writerow([timestamp, time.clock_gettime_ns(time.CLOCK_MONOTONIC)])
-            # t_write = time.time() - t0
+            if self._metrics is not None and isinstance(queued_value, int):
+                self._metrics.record('queue', time.monotonic_ns() - self._frame_buffer.published(queued_value))
+            yield queued_value # frames are read in place from the shared ring buffer
 
-        self.close()
+    def _stamps(self, item):
+        """(seq, timestamp, hardware timestamp) of a queued slot index, JournalFrame or EncodedFrame."""
+        if isinstance(item, (JournalFrame, EncodedFrame)):
+            return item.seq, item.timestamp, item.hardware_timestamp
+        frame_buffer = self._frame_buffer
+        return frame_buffer.seq(item), frame_buffer.timestamp(item), frame_buffer.hardware_timestamp(item)
+
+    def _frame(self, item):
+        """The frame to write for a queued slot index, JournalFrame or EncodedFrame."""
+        if isinstance(item, JournalFrame):
+            frame = self._journal.read(item, self._journal_frame)
+            return frame if self._convert_journal is None else self._convert_journal(frame)
+        if isinstance(item, EncodedFrame): # compressed pre-trigger frame
+            frame = simplejpeg.decode_jpeg(item.jpeg, colorspace=JPEG_COLORSPACES[self._camera_mode])
+        else:
+            frame = self._frame_buffer.frame(item)
+        return frame if self._convert is None else self._convert(frame)
+
+    def _release(self, item):
+        if isinstance(item, JournalFrame):
+            self._journal.recovered()
+        elif not isinstance(item, EncodedFrame):
+            self._frame_buffer.release(item, self._reader)
+
+    def _encode(self, img):
+        if self._metrics is None:
+            return simplejpeg.encode_jpeg(img, **self._encode_kwargs)
+        start = time.perf_counter_ns()
+        jpeg = simplejpeg.encode_jpeg(img, **self._encode_kwargs)
+        self._encode_ns = time.perf_counter_ns() - start
+        self._metrics.record('encode', self._encode_ns)
+        return jpeg
+
+    def write(self, img):
+        if self._metrics is None:
+            return self._segment.write(img)
+        self._encode_ns = 0
+        start = time.perf_counter_ns()
+        nbytes = self._segment.write(img)
+        self._metrics.record('write', time.perf_counter_ns() - start - self._encode_ns) # I/O (or pipe) only
+        return nbytes
+
+    def _write_encoded(self, jpeg):
+        """Append an already encoded JPEG to an MJPEG segment."""
+        start = time.perf_counter_ns()
+        nbytes = self._segment.writer.write(jpeg)
+        if self._metrics is not None:
+            self._metrics.record('write', time.perf_counter_ns() - start)
+        return nbytes
+
+    def _encode_setting(self):
+        """(simplejpeg arguments, extra timestamp log fields) for the next frame."""
+        return self._quality.setting if self._quality is not None else (self._encode_kwargs, {})
+
+    def _run_serial(self):
+        for item in self._queued_slots():
+            if isinstance(item, EncodedFrame) and self._codec == 'mjpeg' and self._convert is None: # already a JPEG
+                self._start_frame(item.timestamp)
+                log_fields = self._quality.full_setting[1] if self._quality is not None else {}
+                self._log_frame(self._stamps(item), self._write_encoded(item.jpeg), log_fields)
+                continue
+            start = time.perf_counter_ns()
+            stamps = self._stamps(item)
+            img = self._frame(item)
+            self._start_frame(stamps[1])
+            log_fields = {}
+            if self._codec == 'mjpeg':
+                self._encode_kwargs, log_fields = self._encode_setting()
+            nbytes = self.write(img)
+            self._release(item)
+            self._log_frame(stamps, nbytes, log_fields)
+            if self._quality is not None:
+                self._quality.frame(time.perf_counter_ns() - start)
+
+    def _run_encoder_pool(self):
+        # Workers encode straight out of the shared ring buffer and imap hands results
+        # back in submission order, so the file and the timestamps stay in frame order.
+        # (The ring buffer bounds how many frames can be in flight.)
+        # Each frame is sent with the encoder arguments of the moment (AdaptiveQuality).
+        pending = collections.deque() # (item, stamps, log fields) in submission order
+
+        def submitted_slots():
+            for item in self._queued_slots():
+                encode_kwargs, log_fields = self._encode_setting()
+                if isinstance(item, EncodedFrame) and self._quality is not None:
+                    log_fields = self._quality.full_setting[1] # encoded by the camera process
+                pending.append((item, self._stamps(item), log_fields))
+                yield item, encode_kwargs
+
+        with multiprocessing.Pool(self._encoder_workers, initializer=_init_encoder,
+                                  initargs=(self._frame_buffer, self._journal, self._config)) as pool:
+            if self._metrics is not None:
+                self._metrics.gauge('encoder_pending', pending.__len__)
+            for jpeg, encode_ns in pool.imap(_encode_slot, submitted_slots()):
+                item, stamps, log_fields = pending.popleft()
+                self._start_frame(stamps[1])
+                if self._metrics is not None and encode_ns:
+                    self._metrics.record('encode', encode_ns)
+                start = time.perf_counter_ns()
+                self._write_encoded(jpeg)
+                self._release(item)
+                self._log_frame(stamps, len(jpeg), log_fields)
+                if self._quality is not None:
+                    self._quality.frame(encode_ns, time.perf_counter_ns() - start)
+
+    def _start_frame(self, timestamp):
+        """Move on to the next segment if the current one is complete."""
+        segment = self._segment
+        if self._manifest is None or segment.frames == 0:
+            return
+        if (self._segment_duration and timestamp - segment.first_timestamp >= self._segment_duration * 1e9) \
+                or (self._segment_size and segment.size() >= self._segment_size * 1024**2):
+            self._segment = self._next_segment.result() # normally opened long ago
+            self._finished_bytes += segment.size()
+            self._background.submit(self._finish_segment, segment)
+            preallocate = int(self._segment_size * 1024**2) if self._segment_size else segment.size()
+            self._next_segment = self._background.submit(self._open_segment, self._segment.number + 1,
+                                                         preallocate)
+
+    def _finish_segment(self, segment):
+        segment.close()
+        if self._manifest is not None and segment.frames:
+            self._manifest.add(segment.number, segment.video_filename, segment.first_frame,
+                               segment.first_frame + segment.frames - 1,
+                               segment.first_timestamp, segment.last_timestamp)
+
+    def _bytes_written(self):
+        try:
+            return self._finished_bytes + (self._segment.size() if self._segment else 0)
+        except OSError: # encoder hasn't created the file yet
+            return self._finished_bytes
+
+    def _log_frame(self, stamps, nbytes, log_fields=None):
+        """Log a written frame by its (seq, timestamp, hardware timestamp) and any extra fields."""
+        seq, timestamp, hardware_timestamp = stamps
+        extra = dict(log_fields or {})
+        if self._hardware_timestamps:
+            extra['hardware_timestamp'] = hardware_timestamp
+        self._segment.log(self._frames_written, seq, timestamp, nbytes, **extra)
+        self._frames_written += 1
+        if self._metrics is not None:
+            self._metrics.frame(nbytes)
+
+    def _write_metadata(self):
+        metadata = {'FramesWritten': self._frames_written}
+        if self._manifest is not None:
+            metadata['Segments'] = self._segment.number + 1
+        if self._journal is not None:
+            metadata.update(self._journal.counts)
+        if self._health is not None:
+            metadata.update(self._health.counts)
+        with open(self._metadata_filename, 'w') as f:
+            yaml.safe_dump(metadata, f, sort_keys=False)
 
     def close(self):
-        if (self._writer):
-            self._writer.close()
-            self._writer = None
-        if (self._ts_file):
-            self._ts_file.close()
-            self._ts_file = None
+        if (self._background):
+            self._background.shutdown() # wait for segments that are being opened or closed
+            self._background = None
+        if (self._segment):
+            self._finish_segment(self._segment)
+        if (self._next_segment):
+            self._next_segment.result().discard()
+            self._next_segment = None
+        if (self._manifest):
+            self._manifest.close()
+        if (self._metadata_filename):
+            self._write_metadata()
+            self._metadata_filename = None
+        self._segment = None
+        if (self._journal):
+            self._journal.close()
+        if (self._metrics):
+            self._metrics.close()
+            self._metrics = None
 
     def __enter__(self):
         return self
@@ -93,10 +426,49 @@ class VideoWriter():
         print('Video writer exited')
 
 
-def start_writer(config, frame_queue, done_flag, filename):
+_encoder_frame_buffer = None
+_encoder_journal = None
+_encoder_convert = None
+_encoder_convert_journal = None
+
+def _init_encoder(frame_buffer, journal, config):
+    global _encoder_frame_buffer, _encoder_journal, _encoder_convert, _encoder_convert_journal
+    setproctitle.setproctitle("python3 JPEG Encoder")
+    _encoder_frame_buffer = frame_buffer
+    _encoder_journal = journal
+    _encoder_convert = stream_converter(config)
+    _encoder_convert_journal = stream_converter(config, crop=False)
+
+def _encode_slot(task):
+    """(jpeg, encoding time in ns) for a (queued item, simplejpeg arguments) task."""
+    item, encode_kwargs = task
+    if isinstance(item, EncodedFrame):
+        return item.jpeg, 0
+    start = time.perf_counter_ns()
+    if isinstance(item, JournalFrame):
+        frame, convert = _encoder_journal.read(item), _encoder_convert_journal
+    else:
+        frame, convert = _encoder_frame_buffer.frame(item), _encoder_convert
+    jpeg = simplejpeg.encode_jpeg(frame if convert is None else convert(frame), **encode_kwargs)
+    return jpeg, time.perf_counter_ns() - start
+
+
+def start_writer(config, frame_queue, done_flag, filename, frame_buffer, journal=None, metrics_queue=None,
+                 health=None):
     multiprocessing.current_process().name = "python3 VideoWriter"
+    if config.get('Name', None):
+        multiprocessing.current_process().name += " {}".format(config['Name'])
+    if config.get('StreamName', None):
+        multiprocessing.current_process().name += " {}".format(config['StreamName'])
     setproctitle.setproctitle(multiprocessing.current_process().name)
-    with VideoWriter(config, frame_queue, done_flag, filename) as vwriter:
+    if config.get('CPUs', None):
+        os.sched_setaffinity(0, config['CPUs']) # inherited by the encoder pool
+    metrics = None
+    if metrics_queue is not None:
+        label = '/'.join(name for name in [config.get('Name', None), config.get('StreamName', None)] if name)
+        metrics = ProcessMetrics('writer', label, metrics_queue, config.get('MetricsInterval', 1.0))
+    with VideoWriter(config, frame_queue, done_flag, filename, frame_buffer, journal, metrics,
+                     health) as vwriter:
         done_flag.value = False #  change our done state to False
         vwriter.run()
     done_flag.value = True
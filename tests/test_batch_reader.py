@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from cherubim.batch_reader import BatchReader
+from cherubim.chunked_container import ChunkedContainerWriter
+
+
+def write_zraw(filename, frames, chunk_frames):
+    pytest.importorskip('zstandard') # optional (cherubim[lossless])
+    writer = ChunkedContainerWriter(filename, frames.shape[1:], mode='Mono8', chunk_frames=chunk_frames)
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+
+
+def test_zraw_batches_decompress_each_chunk_once(tmp_path):
+    frames = np.random.default_rng(0).integers(0, 255, (100, 12, 16, 1), dtype=np.uint8)
+    filename = str(tmp_path / 'rec.zraw')
+    write_zraw(filename, frames, chunk_frames=16)
+
+    with BatchReader(filename, batch_size=40, step=3, min_width=8, num_threads=4) as reader:
+        decompressed = []
+        video = reader._videos[0]
+        read_chunk = video.read_chunk
+        video.read_chunk = lambda n: decompressed.append(n) or read_chunk(n)
+        batches = [batch for batch, _ in reader]
+
+    assert [len(batch) for batch in batches] == [34]
+    assert np.array_equal(batches[0], frames[::3, ::2, ::2])
+    assert sorted(decompressed) == list(range(7))
+
+
+def test_zraw_batches_across_chunk_boundaries(tmp_path):
+    frames = np.random.default_rng(1).integers(0, 255, (50, 8, 8, 1), dtype=np.uint8)
+    filename = str(tmp_path / 'rec.zraw')
+    write_zraw(filename, frames, chunk_frames=16)
+
+    with BatchReader(filename, batch_size=7, start=3, num_threads=3) as reader:
+        assert np.array_equal(np.concatenate([batch for batch, _ in reader]), frames[3:])
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from cherubim.chunked_container import ChunkedContainerWriter, ChunkedRecording, chunk_index_filename, \
+    load_chunk_index, read_header
+
+
+CODEC_MODULES = {'zstd': 'zstandard', 'lz4': 'lz4.frame'} # optional dependencies (cherubim[lossless])
+
+
+def random_frames(count, shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 32, (count,) + shape, dtype=np.uint8) # compressible
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4'])
+def test_round_trip(tmp_path, codec):
+    pytest.importorskip(CODEC_MODULES[codec])
+    filename = str(tmp_path / 'rec.zraw')
+    frames = random_frames(45, (12, 10, 3))
+    writer = ChunkedContainerWriter(filename, (12, 10, 3), mode='Bayer_RG8', frame_rate=30, codec=codec,
+                                    chunk_frames=8, num_threads=3)
+    for frame in frames:
+        assert writer.write(frame) == 0
+    writer.close()
+
+    header = read_header(filename)
+    assert header['codec'] == codec and header['mode'] == 'Bayer_RG8' and header['chunk_frames'] == 8
+    assert header['frame_count'] == 45
+    index = load_chunk_index(chunk_index_filename(filename))
+    assert list(index['first_frame']) == list(range(0, 45, 8))
+    assert list(index['num_frames']) == [8] * 5 + [5] # the last chunk is partial
+
+    with ChunkedRecording(filename, num_threads=2) as recording:
+        assert len(recording) == 45
+        assert all(np.array_equal(recording[n], frames[n]) for n in [0, 7, 8, 44, -1])
+        assert np.array_equal(recording.read(5, 30), frames[5:30])
+        assert np.array_equal(recording.read(40, 100), frames[40:])
+        assert np.array_equal(recording[3:20:4], frames[3:20:4])
+        assert np.array_equal(recording.read_chunk(2), frames[16:24])
+        with pytest.raises(IndexError):
+            recording[45]
+
+
+def test_chunks_are_compressed(tmp_path):
+    pytest.importorskip('zstandard')
+    filename = str(tmp_path / 'rec.zraw')
+    frames = np.zeros((32, 64, 64, 1), np.uint8)
+    writer = ChunkedContainerWriter(filename, (64, 64, 1), chunk_frames=16)
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+    index = load_chunk_index(chunk_index_filename(filename))
+    assert index['length'].sum() < frames.nbytes // 100
+
+
+def test_empty_recording(tmp_path):
+    pytest.importorskip('zstandard')
+    filename = str(tmp_path / 'rec.zraw')
+    ChunkedContainerWriter(filename, (4, 4, 1)).close()
+    with ChunkedRecording(filename) as recording:
+        assert len(recording) == 0
+        assert recording.read(0, 10).shape == (0, 4, 4, 1)
@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+
+from cherubim.demosaic import DemosaicStage, demosaic_superpixel
+from cherubim.metrics import LatencyHistogram
+
+
+def test_frames_come_back_in_order():
+    latency = LatencyHistogram()
+    stage = DemosaicStage((8, 8, 3), algorithm='nearest', num_threads=2, latency=latency)
+    raws = [np.full((8, 8), n, np.uint8) for n in range(stage.num_buffers)]
+    for n, raw in enumerate(raws):
+        assert not stage.full()
+        stage.submit(raw, n)
+    assert stage.full()
+    for n in range(len(raws)):
+        frame, timestamp = stage.pop(timeout=None)
+        assert timestamp == n and (frame == n).all()
+        stage.release(frame)
+    assert stage.pop() is None
+    assert sum(latency.counts) == len(raws)
+    stage.shutdown()
+
+
+def test_shutdown_with_unpopped_frames_returns():
+    stage = DemosaicStage((8, 8, 3), algorithm='nearest', num_threads=2)
+    raw = np.zeros((8, 8), np.uint8)
+    for n in range(3 * stage.num_buffers): # more than there are destinations, never popped
+        stage.submit(raw, n)
+    thread = threading.Thread(target=stage.shutdown)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+
+
+def test_superpixel():
+    raw = np.array([[10, 20], [30, 41]], np.uint8)
+    dst = np.empty((1, 1, 3), np.uint8)
+    assert list(demosaic_superpixel(raw, dst)[0, 0]) == [10, 25, 41]
@@ -0,0 +1,86 @@
+import pickle
+import types
+
+import numpy as np
+import pytest
+
+from cherubim.frame_buffer import SharedFrameBuffer, default_slot_count, frame_shape
+
+
+@pytest.fixture
+def ring():
+    frame_buffer = SharedFrameBuffer((3, 5, 1), 3, num_readers=3)
+    yield frame_buffer
+    frame_buffer.close()
+    frame_buffer.unlink()
+
+
+def test_write_and_read_slots(ring):
+    slot = ring.acquire()
+    frame = np.arange(15, dtype=np.uint8).reshape(3, 5, 1)
+    assert ring.write(slot, frame, 1234, hardware_timestamp=99) == 0
+    assert np.array_equal(ring.frame(slot), frame)
+    assert (ring.seq(slot), ring.timestamp(slot), ring.hardware_timestamp(slot)) == (0, 1234, 99)
+    assert ring.published(slot) > 0
+
+    slot = ring.acquire()
+    ring.frame(slot)[...] = 7 # written in place
+    assert ring.write(slot, None, 1235) == 1
+    assert (ring.frame(slot) == 7).all()
+
+
+def test_slots_are_page_aligned(ring):
+    assert ring.slot_nbytes % 4096 == 0
+    assert ring.frame(1).ctypes.data - ring.frame(0).ctypes.data == ring.slot_nbytes
+
+
+def test_blocking_readers_hold_slots(ring):
+    slots = [ring.acquire() for _ in range(3)]
+    assert slots == [0, 1, 2]
+    for slot in slots:
+        ring.write(slot, None, 0)
+    ring.claim(0, SharedFrameBuffer.WRITER_READER)
+    ring.claim(0, SharedFrameBuffer.WRITER_READER + 1)
+    assert ring.held(0) and ring.full()
+    assert ring.pending(SharedFrameBuffer.WRITER_READER) == 1
+
+    stop_signal = types.SimpleNamespace(value=True)
+    assert ring.acquire(stop_signal) is None # would have to wait for slot 0
+    ring.release(0, SharedFrameBuffer.WRITER_READER)
+    assert ring.full() # the second stream still holds it
+    ring.release(0, SharedFrameBuffer.WRITER_READER + 1)
+    assert not ring.full()
+    assert ring.acquire(stop_signal) == 0
+    assert ring.seq(0) == -1 # being rewritten
+
+
+def test_display_claims_are_advisory(ring):
+    slot = ring.acquire()
+    ring.write(slot, None, 0)
+    ring.claim(slot, SharedFrameBuffer.DISPLAY_READER)
+    assert not ring.held(slot)
+    assert ring.pending(SharedFrameBuffer.DISPLAY_READER) == 1
+    for _ in range(3):
+        ring.acquire()
+    assert ring.pending(SharedFrameBuffer.DISPLAY_READER) == 0 # dropped when the camera took the slot back
+
+
+def test_pickled_buffer_maps_the_same_memory(ring):
+    slot = ring.acquire()
+    ring.write(slot, np.full((3, 5, 1), 42, np.uint8), 10)
+    other = pickle.loads(pickle.dumps(ring))
+    try:
+        assert (other.frame(slot) == 42).all() and other.seq(slot) == 0
+        other.claim(slot, SharedFrameBuffer.WRITER_READER)
+        assert ring.held(slot)
+    finally:
+        other.close()
+        other.unlink() # a no-op for the process that didn't create it
+
+
+def test_slot_count_and_shape():
+    config = {'Interface': 'GigE', 'Mode': 'Bayer_RG8', 'ResX': 640, 'ResY': 480, 'FrameRate': 100}
+    assert frame_shape(config) == (480, 640, 3)
+    assert default_slot_count(config) == 200
+    assert default_slot_count(dict(config, FrameBufferMB=1)) == 4
+    assert default_slot_count(dict(config, FrameBufferSlots=7)) == 7
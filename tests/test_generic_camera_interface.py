@@ -0,0 +1,97 @@
+import copy
+import queue
+import types
+
+import numpy as np
+
+from cherubim.frame_buffer import SharedFrameBuffer
+from cherubim.generic_camera_interface import GenericCameraInterface
+from cherubim.journal import FrameJournal, JournalFrame, DEFERRED
+
+
+class ZeroCopyCamera(GenericCameraInterface):
+    """Publishes frames that are already in their ring slot, like GigE Mono8 stream buffers."""
+    def __init__(self, slots, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = list(slots)
+
+    def get_frame(self):
+        if not self._slots:
+            return False
+        self.current_frame_slot = self._slots.pop(0)
+        self.current_frame_timestamp = 0
+        return True
+
+    def post_queue(self):
+        self.current_frame_slot = None
+
+
+def test_zero_copy_frames_not_journaled_while_slot_0_is_held(tmp_path):
+    config = {'Interface': 'GigE', 'Mode': 'Mono8', 'ResX': 8, 'ResY': 4}
+    frame_buffer = SharedFrameBuffer((4, 8, 1), 8, num_readers=2)
+    journal = FrameJournal(str(tmp_path / 'journal.bin'), (4, 8, 1))
+    try:
+        frame_buffer.claim(0, SharedFrameBuffer.WRITER_READER) # the writer is still on slot 0
+        write_queue = queue.Queue()
+        camera = ZeroCopyCamera(range(1, 6), config, queue.Queue(), write_queue, types.SimpleNamespace(value=False),
+                                types.SimpleNamespace(value=True), frame_buffer, journal=journal)
+        camera.run()
+
+        queued = []
+        while not write_queue.empty():
+            queued.append(write_queue.get())
+        assert queued == [1, 2, 3, 4, 5, None] # every frame handed over in its slot
+        assert journal.counters[DEFERRED] == 0
+        assert [frame_buffer.seq(slot) for slot in range(1, 6)] == list(range(5))
+    finally:
+        journal.unlink()
+        frame_buffer.close()
+        frame_buffer.unlink()
+
+
+class CopyingCamera(GenericCameraInterface):
+    """Publishes frames from its own memory (copied into the ring), like a WebCam."""
+    def __init__(self, num_frames, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._remaining = num_frames
+
+    def get_frame(self):
+        if not self._remaining:
+            return False
+        self._remaining -= 1
+        self.current_frame_data = np.full((4, 8, 1), 10 - self._remaining, np.uint8)
+        self.current_frame_timestamp = 1000 + 10 - self._remaining
+        return True
+
+
+def test_frames_spill_to_the_journal_while_the_ring_is_full(tmp_path):
+    config = {'Interface': 'GigE', 'Mode': 'Mono8', 'ResX': 8, 'ResY': 4}
+    frame_buffer = SharedFrameBuffer((4, 8, 1), 4, num_readers=2)
+    journal = FrameJournal(str(tmp_path / 'journal.bin'), (4, 8, 1))
+    writer_journal = copy.copy(journal) # the writer process' copy
+    try:
+        write_queue = queue.Queue()
+        camera = CopyingCamera(10, config, queue.Queue(), write_queue, types.SimpleNamespace(value=False),
+                               types.SimpleNamespace(value=True), frame_buffer, journal=journal)
+        camera.run() # the writer never releases a slot
+
+        queued = []
+        while not write_queue.empty():
+            queued.append(write_queue.get())
+        assert queued[-1] is None
+        in_ring = [item for item in queued[:-1] if not isinstance(item, JournalFrame)]
+        assert 0 < len(in_ring) < 4 and in_ring == list(range(len(in_ring))) # until the writer's budget is used
+        records = queued[len(in_ring):-1]
+        assert all(isinstance(record, JournalFrame) for record in records)
+        assert [record.seq for record in records] == list(range(len(in_ring), 10))
+        assert [record.timestamp for record in records] == [1001 + record.seq for record in records]
+        for record in records: # recovered in order, with the frames' pixels
+            assert (writer_journal.read(record) == record.seq + 1).all()
+            writer_journal.recovered()
+        assert journal.counts == {'FramesDeferred': len(records), 'FramesRecovered': len(records),
+                                  'FramesDropped': 0}
+    finally:
+        writer_journal.close()
+        journal.unlink()
+        frame_buffer.close()
+        frame_buffer.unlink()
@@ -0,0 +1,53 @@
+import copy
+
+import numpy as np
+import pytest
+
+from cherubim.journal import DEFERRED, DROPPED, RECOVERED, FrameJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = FrameJournal(str(tmp_path / 'journal.bin'), (4, 6, 1), max_bytes=3 * 24)
+    yield journal
+    journal.unlink()
+
+
+@pytest.fixture
+def reader(journal):
+    """The writer process' copy of the journal (it opens the file itself)."""
+    reader = copy.copy(journal)
+    yield reader
+    reader.close()
+
+
+def frame(value):
+    return np.full((4, 6, 1), value, np.uint8)
+
+
+def test_spill_and_recover(journal, reader):
+    records = [journal.spill(frame(n), seq=10 + n, timestamp=100 + n, hardware_timestamp=7) for n in range(2)]
+    assert [(r.seq, r.timestamp, r.hardware_timestamp) for r in records] == [(10, 100, 7), (11, 101, 7)]
+
+    out = np.empty((4, 6, 1), np.uint8)
+    for n, record in enumerate(records):
+        assert (reader.read(record, out) == n).all()
+        reader.recovered()
+    assert journal.counts == {'FramesDeferred': 2, 'FramesRecovered': 2, 'FramesDropped': 0}
+
+
+def test_frames_are_dropped_when_the_journal_is_full(journal, reader):
+    records = [journal.spill(frame(n), n, n) for n in range(4)]
+    assert records[3] is None
+    assert (journal.counters[DEFERRED], journal.counters[DROPPED]) == (3, 1)
+    assert (reader.read(records[2]) == 2).all()
+
+
+def test_journal_is_rewound_once_drained(journal, reader):
+    for n in range(3):
+        reader.read(journal.spill(frame(n), n, n))
+        reader.recovered()
+    record = journal.spill(frame(9), 3, 3) # would not fit without rewinding
+    assert record.offset == 0
+    assert (reader.read(record) == 9).all()
+    assert journal.counters[RECOVERED] == 3 and journal.counters[DROPPED] == 0
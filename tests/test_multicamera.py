@@ -0,0 +1,23 @@
+import numpy as np
+
+from cherubim.multicamera import camera_configs, merge_timestamps
+
+
+def write_csv_log(filename, camera_timestamps):
+    with open(filename, 'w') as f:
+        f.writelines('{},{}\n'.format(t, t) for t in camera_timestamps)
+
+
+def test_merge_timestamps_across_clocks(tmp_path):
+    configs = camera_configs({'LogDirectory': str(tmp_path), 'FrameRate': 100,
+                              'Cameras': [{'Name': 'top', 'Interface': 'GigE'}, {'Name': 'side'}]})
+    offset = 1_700_000_000 * 10**9 # wall clock minus CLOCK_MONOTONIC
+    monotonic = 5 * 10**9 + np.arange(4) * 10**7
+    write_csv_log(tmp_path / 'rec_top_timestamps.csv', monotonic + offset)
+    write_csv_log(tmp_path / 'rec_side_timestamps.csv', monotonic[1:] + 10**6) # 1 ms later, first frame missing
+
+    merged = np.loadtxt(merge_timestamps(configs, 'rec', realtime_offset=offset), delimiter=',', skiprows=1,
+                        dtype=np.int64)
+    assert list(merged[:, 0]) == [0, 1, 2, 3]
+    assert list(merged[:, 2]) == [-1, 0, 1, 2]
+    assert list(merged[1:, 3]) == list(monotonic[1:] + 10**6 + offset)
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+
+from cherubim.raw_container import HEADER_SIZE, RawContainerWriter, RawRecording, read_header
+
+
+def random_frames(count, shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 255, (count,) + shape, dtype=np.uint8)
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'rec.raw')
+    frames = random_frames(100, (7, 9, 3)) # frames straddle the page aligned batches
+    writer = RawContainerWriter(filename, (7, 9, 3), mode='RGB8', frame_rate=50, batch_bytes=4096,
+                                preallocate_bytes=64 * 1024)
+    for frame in frames:
+        assert writer.write(frame) == frame.nbytes
+    writer.close()
+
+    header = read_header(filename)
+    assert header['shape'] == (7, 9, 3) and header['mode'] == 'RGB8' and header['frame_rate'] == 50
+    assert header['frame_count'] == 100
+    assert os.path.getsize(filename) == HEADER_SIZE + frames.nbytes # preallocation dropped
+    recording = RawRecording(filename)
+    assert len(recording) == 100
+    assert np.array_equal(recording.frames, frames)
+    assert np.array_equal(recording[42], frames[42])
+
+
+def test_frames_written_so_far_can_be_read(tmp_path):
+    filename = str(tmp_path / 'rec.raw')
+    frames = random_frames(60, (16, 16, 1))
+    writer = RawContainerWriter(filename, (16, 16, 1), batch_bytes=4096)
+    for frame in frames:
+        writer.write(frame)
+    recording = RawRecording(filename) # before close (e.g., after a crash)
+    assert 0 < len(recording) <= 60
+    assert np.array_equal(recording.frames, frames[:len(recording)])
+    writer.close()
+
+
+def test_empty_and_headerless_recordings(tmp_path):
+    filename = str(tmp_path / 'empty.raw')
+    RawContainerWriter(filename, (4, 4, 1)).close()
+    assert len(RawRecording(filename)) == 0
+
+    filename = str(tmp_path / 'old.raw')
+    frames = random_frames(5, (4, 6, 1))
+    frames.tofile(filename)
+    assert read_header(filename) is None
+    with pytest.raises(ValueError):
+        RawRecording(filename)
+    assert np.array_equal(RawRecording(filename, shape=(4, 6, 1)).frames, frames)
@@ -0,0 +1,67 @@
+import os
+import queue
+
+import numpy as np
+import pytest
+import yaml
+
+from cherubim.frame_buffer import SharedFrameBuffer
+from cherubim.raw_container import RawRecording
+from cherubim.segments import read_manifest, segment_filename
+from cherubim.timestamp_log import read_timestamps
+from cherubim.videowriter import VideoWriter
+
+
+@pytest.fixture
+def frame_buffer():
+    frame_buffer = SharedFrameBuffer((8, 8, 1), 16)
+    yield frame_buffer
+    frame_buffer.close()
+    frame_buffer.unlink()
+
+
+def record(tmp_path, frame_buffer, num_frames, **config):
+    """Record num_frames frames 100 ms apart (frame n is filled with n) with a raw VideoWriter."""
+    config = dict({'Interface': 'Synthetic', 'Mode': 'Mono8', 'ResX': 8, 'ResY': 8, 'Compress': False,
+                   'TimestampFormat': 'binary', 'LogDirectory': str(tmp_path)}, **config)
+    frame_queue = queue.Queue()
+    for n in range(num_frames):
+        slot = frame_buffer.acquire()
+        frame_buffer.write(slot, np.full((8, 8, 1), n, np.uint8), 10**9 + n * 10**8)
+        frame_buffer.claim(slot, SharedFrameBuffer.WRITER_READER)
+        frame_queue.put(slot)
+    frame_queue.put(None)
+    VideoWriter(config, frame_queue, None, 'rec', frame_buffer).run()
+    return str(tmp_path / 'rec')
+
+
+def test_segments_rotate_by_duration(tmp_path, frame_buffer):
+    base = record(tmp_path, frame_buffer, 10, SegmentDuration=0.35)
+
+    segments = read_manifest(base)
+    assert [(s['segment'], s['first_frame'], s['last_frame']) for s in segments] == [(0, 0, 3), (1, 4, 7), (2, 8, 9)]
+    assert [s['filename'] for s in segments] == ['rec_{:04d}.raw'.format(n) for n in range(3)]
+    assert segments[1]['first_timestamp'] == 10**9 + 4 * 10**8
+    assert segments[1]['last_timestamp'] == 10**9 + 7 * 10**8
+    for segment in segments:
+        frames = RawRecording(str(tmp_path / segment['filename'])).frames
+        assert list(frames[:, 0, 0, 0]) == list(range(segment['first_frame'], segment['last_frame'] + 1))
+    assert not os.path.exists(segment_filename(base, 3) + '.raw') # the segment opened ahead was discarded
+
+    timestamps = read_timestamps(base)
+    assert list(timestamps['frame_index']) == list(range(10))
+    assert list(timestamps['camera_frame']) == list(range(10))
+    with open(base + '_metadata.yaml') as f:
+        assert yaml.safe_load(f) == {'FramesWritten': 10, 'Segments': 3}
+    assert frame_buffer.pending(SharedFrameBuffer.WRITER_READER) == 0 # every slot was released
+
+
+def test_segments_rotate_by_size(tmp_path, frame_buffer):
+    base = record(tmp_path, frame_buffer, 10, SegmentSize=4 * 64 / 1024**2) # 4 frames of 64 bytes
+    assert [(s['first_frame'], s['last_frame']) for s in read_manifest(base)] == [(0, 3), (4, 7), (8, 9)]
+
+
+def test_unsegmented_recording(tmp_path, frame_buffer):
+    base = record(tmp_path, frame_buffer, 5)
+    assert not os.path.exists(base + '_segments.csv')
+    assert list(RawRecording(base + '.raw').frames[:, 0, 0, 0]) == list(range(5))
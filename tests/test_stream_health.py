@@ -0,0 +1,15 @@
+from cherubim.stream_health import FRAME_ID_WRAP, frame_id_gap
+
+
+def test_frame_id_gap():
+    assert frame_id_gap(10, 11) == 0
+    assert frame_id_gap(10, 14) == 3
+    assert frame_id_gap(FRAME_ID_WRAP, 1) == 0 # wrap
+    assert frame_id_gap(FRAME_ID_WRAP - 1, 2) == 2
+
+
+def test_repeated_or_restarted_frame_ids_are_not_lost_frames():
+    assert frame_id_gap(10, 10) == 0
+    assert frame_id_gap(500, 1) == 0 # the camera reset its counter
+    assert frame_id_gap(FRAME_ID_WRAP, FRAME_ID_WRAP) == 0
+    assert frame_id_gap(2**40, 1) == 0 # extended IDs
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import simplejpeg
+
+from cherubim.synthetic_interface import check_camera
+
+
+@pytest.mark.parametrize('colorspace, mode, replayed_mode', [
+    ('GRAY', 'RGB8', 'Mono8'), ('RGB', 'Mono8', 'RGB8'), ('BGR', 'Bayer_RG8', 'Bayer_RG8'), ('GRAY', None, 'Mono8')])
+def test_mjpeg_replay_takes_mode_and_size_from_the_jpeg(tmp_path, colorspace, mode, replayed_mode):
+    filename = str(tmp_path / 'rec.mjpeg')
+    channels = 1 if colorspace == 'GRAY' else 3
+    with open(filename, 'wb') as f:
+        f.write(simplejpeg.encode_jpeg(np.zeros((48, 64, channels), np.uint8), colorspace=colorspace))
+    config = {'Interface': 'Replay', 'ReplayFile': filename, 'ResX': 640, 'ResY': 480}
+    if mode is not None:
+        config['Mode'] = mode
+    assert check_camera(config) == (64, 48)
+    assert config['Mode'] == replayed_mode
@@ -0,0 +1,89 @@
+import json
+import struct
+
+import numpy as np
+
+from cherubim.segments import SegmentManifest, manifest_filename, segment_filename
+from cherubim.timestamp_log import BinaryTimestampLog, TimestampLogs, HEADER_SIZE, TIMESTAMP_DTYPE, TIMESTAMP_MAGIC, \
+    load_timestamps, read_timestamps, timestamp_format
+
+
+def test_streams_that_skip_frames_get_the_binary_log():
+    assert timestamp_format({}) == 'csv'
+    assert timestamp_format({'FrameDecimation': 1}) == 'csv'
+    assert timestamp_format({'MotionThreshold': 3}) == 'both'
+    assert timestamp_format({'FrameDecimation': 10}) == 'both'
+    assert timestamp_format({'TimestampFormat': 'binary', 'FrameDecimation': 2}) == 'binary'
+
+
+def test_load_timestamps_reads_extra_fields(tmp_path):
+    filename = str(tmp_path / 'session_timestamps.bin')
+    log = BinaryTimestampLog(filename, [('hardware_timestamp', '<i8'), ('jpeg_quality', '<u1')], block_size=2)
+    for n in range(3):
+        log.log(n, 10 + 2 * n, 1000 + n, 2000 + n, 100 + n, hardware_timestamp=3000 + n, jpeg_quality=80 - n)
+    log.close()
+
+    timestamps = load_timestamps(filename)
+    assert timestamps.dtype.names[:len(TIMESTAMP_DTYPE)] == TIMESTAMP_DTYPE.names
+    assert list(timestamps['frame_index']) == [0, 1, 2]
+    assert list(timestamps['camera_frame']) == [10, 12, 14]
+    assert list(timestamps['host_timestamp']) == [2000, 2001, 2002]
+    assert list(timestamps['hardware_timestamp']) == [3000, 3001, 3002]
+    assert list(timestamps['jpeg_quality']) == [80, 79, 78]
+
+
+def test_older_binary_logs_keep_the_camera_frame_number(tmp_path):
+    filename = str(tmp_path / 'session_timestamps.bin')
+    old_dtype = np.dtype([('frame_index', '<i8'), ('camera_timestamp', '<i8'), ('host_timestamp', '<i8'),
+                          ('encoded_size', '<u4'), ('hardware_timestamp', '<i8')])
+    description = json.dumps({'dtype': old_dtype.descr}).encode()
+    with open(filename, 'wb') as f:
+        f.write((TIMESTAMP_MAGIC + struct.pack('<I', len(description)) + description).ljust(HEADER_SIZE, b'\0'))
+        np.array([(5, 100, 200, 10, 300), (7, 101, 201, 11, 301)], old_dtype).tofile(f)
+
+    timestamps = load_timestamps(filename)
+    assert list(timestamps['frame_index']) == [0, 1]
+    assert list(timestamps['camera_frame']) == [5, 7]
+    assert list(timestamps['hardware_timestamp']) == [300, 301]
+
+
+def test_segmented_recordings_number_frames_the_same_for_both_formats(tmp_path):
+    base = str(tmp_path / 'rec')
+    manifest = SegmentManifest(manifest_filename(base))
+    for number, timestamp_format in enumerate(['csv', 'binary']):
+        logs = TimestampLogs(segment_filename(base, number), timestamp_format)
+        for n in range(3):
+            logs.log(n, 100 * number + 2 * n, 1000 * number + n, 0)
+        logs.close()
+        manifest.add(number, segment_filename(base, number) + '.mjpeg', 3 * number, 3 * number + 2,
+                     1000 * number, 1000 * number + 2)
+    manifest.close()
+
+    timestamps = read_timestamps(base)
+    assert list(timestamps['frame_index']) == list(range(6))
+    assert list(timestamps['camera_frame']) == [-1, -1, -1, 100, 102, 104]
+
+
+def test_csv_and_binary_logs_read_the_same(tmp_path):
+    extra_fields = [('hardware_timestamp', '<i8'), ('jpeg_quality', '<u1'), ('jpeg_subsampling', '<u2')]
+    logs = TimestampLogs(str(tmp_path / 'rec'), 'both', extra_fields)
+    for n in range(3):
+        logs.log(n, 2 * n, 1000 + n, 50, hardware_timestamp=7000 + n, jpeg_quality=90 - n, jpeg_subsampling=444)
+    logs.close()
+
+    binary = read_timestamps(str(tmp_path / 'rec_timestamps.bin'))
+    text = read_timestamps(str(tmp_path / 'rec_timestamps.csv'))
+    assert text.dtype == binary.dtype
+    for name in ['frame_index', 'camera_timestamp', 'host_timestamp'] + [name for name, _ in extra_fields]:
+        assert list(text[name]) == list(binary[name])
+    assert np.loadtxt(str(tmp_path / 'rec_timestamps.csv'), delimiter=',').shape == (3, 5)
+
+
+def test_two_column_csv_logs(tmp_path):
+    filename = str(tmp_path / 'rec_timestamps.csv')
+    with open(filename, 'w') as f:
+        f.write('1000,2000\n1.5,2.5\n') # old WebCam logs used seconds
+    timestamps = read_timestamps(filename)
+    assert list(timestamps['camera_timestamp']) == [1000, 1500000000]
+    assert list(timestamps['host_timestamp']) == [2000, 2500000000]
+    assert list(timestamps['camera_frame']) == [-1, -1]
@@ -0,0 +1,75 @@
+import struct
+
+import numpy as np
+import pytest
+
+from cherubim.transcode import _box, _walk, ns_to_ticks, set_mp4_frame_times
+
+
+def full_box(kind, *fields):
+    return _box(kind, struct.pack('>I', 0) + b''.join(fields)) # version 0, no flags
+
+
+def minimal_mp4(num_samples, timescale=90000, frame_duration=3000):
+    """ftyp, mdat and a moov with one video track of num_samples constant-rate samples."""
+    duration = num_samples * frame_duration
+    stbl = _box(b'stbl', full_box(b'stts', struct.pack('>III', 1, num_samples, frame_duration))
+                + full_box(b'stsz', struct.pack('>II', 0, num_samples), struct.pack('>I', 10) * num_samples))
+    mdia = _box(b'mdia', full_box(b'mdhd', struct.pack('>IIII', 0, 0, timescale, duration), b'\0' * 4)
+                + _box(b'minf', stbl))
+    edts = _box(b'edts', full_box(b'elst', struct.pack('>IIiHH', 1, 1000 * num_samples // 30, 0, 1, 0)))
+    trak = _box(b'trak', full_box(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0, 1000 * num_samples // 30),
+                                  b'\0' * 60) + edts + mdia)
+    moov = _box(b'moov', full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, 1000 * num_samples // 30),
+                                  b'\0' * 80) + trak)
+    return _box(b'ftyp', b'isom' + b'\0' * 4) + _box(b'mdat', b'\0' * 10 * num_samples) + moov
+
+
+def moov_box(data, kind):
+    (start, header), = [(start, header) for box, start, header, _ in _walk(data) if box == kind]
+    return data[start + header:]
+
+
+def test_set_mp4_frame_times(tmp_path):
+    filename = str(tmp_path / 'video.mp4')
+    with open(filename, 'wb') as f:
+        f.write(minimal_mp4(5))
+    set_mp4_frame_times(filename, np.array([0, 3000, 6000, 12000, 15000]))
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    stts = moov_box(data, b'stts')
+    count = struct.unpack_from('>I', stts, 4)[0]
+    assert [struct.unpack_from('>II', stts, 8 + 8 * n) for n in range(count)] == [(2, 3000), (1, 6000), (2, 3000)]
+    mdhd = moov_box(data, b'mdhd')
+    assert mdhd[0] == 1 # rewritten as version 1
+    assert struct.unpack_from('>IQ', mdhd, 20) == (90000, 18000)
+    mvhd = moov_box(data, b'mvhd')
+    assert struct.unpack_from('>IQ', mvhd, 20) == (1000, 200)
+
+
+def test_mismatched_frame_times_leave_the_file_alone(tmp_path):
+    filename = str(tmp_path / 'video.mp4')
+    original = minimal_mp4(5)
+    with open(filename, 'wb') as f:
+        f.write(original)
+    with pytest.raises(ValueError, match='5 frames but 4 frame times'):
+        set_mp4_frame_times(filename, np.array([0, 3000, 6000, 9000]))
+    with open(filename, 'rb') as f:
+        assert f.read() == original
+
+
+def test_ns_to_ticks_for_long_recordings():
+    ns = np.array([0, 11111, 10**9, 40 * 3600 * 10**9 + 1], np.int64) # 40 h
+    assert list(ns_to_ticks(ns)) == [0, 0, 90000, 40 * 3600 * 90000]
+
+
+def test_out_of_range_durations_leave_the_file_alone(tmp_path):
+    filename = str(tmp_path / 'video.mp4')
+    original = minimal_mp4(3)
+    with open(filename, 'wb') as f:
+        f.write(original)
+    with pytest.raises(ValueError, match='out of range'):
+        set_mp4_frame_times(filename, np.array([0, 3000, 3000 + 2**32]))
+    with open(filename, 'rb') as f:
+        assert f.read() == original